@@ -0,0 +1,170 @@
+from pydantic_core import to_json
+from typing import Any
+from uuid import UUID
+import apiserver.metrics as metrics
+import asyncio
+import os
+import threading
+
+# 'local' publishes the writes of this process, 'changefeed' the rows
+# of a CockroachDB changefeed, so that every process sees all writes
+STREAM_SOURCE = os.getenv("STREAM_SOURCE", "local").lower()
+# changes a subscriber can fall behind before its buffer is dropped
+STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", 100))
+STREAM_KEEPALIVE_SECONDS = int(os.getenv("STREAM_KEEPALIVE_SECONDS", 15))
+
+# tells a subscriber that it missed changes and must refetch
+RESET = "event: reset\ndata: {}\n\n"
+
+
+class Subscription:
+    """
+    The filters and the buffer of one client of the change stream.
+    """
+
+    def __init__(
+        self,
+        model_name: str | None,
+        id: UUID | None,
+        parent_type: str | None,
+        parent_id: UUID | None,
+        loop: asyncio.AbstractEventLoop,
+    ) -> None:
+        self.model_name = model_name
+        self.id = id
+        self.parent_type = parent_type
+        self.parent_id = parent_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFER_SIZE)
+
+    def matches(self, id: Any, parent_type: str | None, parent_id: Any) -> bool:
+        # ids are UUIDs on the write path, strings in the changefeed
+        if self.id and str(self.id) != str(id):
+            return False
+        if self.parent_type and self.parent_type != parent_type:
+            return False
+        if self.parent_id and str(self.parent_id) != str(parent_id):
+            return False
+        return True
+
+
+# subscriptions by model name, None for the ones to all models
+subscriptions: dict[str | None, set[Subscription]] = {}
+subscriptions_lock = threading.Lock()
+
+
+def subscribe(
+    model_name: str | None,
+    id: UUID | None = None,
+    parent_type: str | None = None,
+    parent_id: UUID | None = None,
+) -> Subscription:
+    # must be called on the event loop that reads the queue
+    sub = Subscription(
+        model_name, id, parent_type, parent_id, asyncio.get_running_loop()
+    )
+
+    with subscriptions_lock:
+        subscriptions.setdefault(model_name, set()).add(sub)
+
+    metrics.STREAM_SUBSCRIBERS.inc()
+    return sub
+
+
+def unsubscribe(sub: Subscription) -> None:
+    with subscriptions_lock:
+        subs = subscriptions.get(sub.model_name)
+        if subs:
+            subs.discard(sub)
+            if not subs:
+                subscriptions.pop(sub.model_name)
+
+    metrics.STREAM_SUBSCRIBERS.dec()
+
+
+def __deliver(sub: Subscription, msg: str) -> None:
+    try:
+        sub.queue.put_nowait(msg)
+    except asyncio.QueueFull:
+        # the client reads too slowly: rather than buffering without limit
+        # or blocking the writers, drop its backlog and make it refetch
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(RESET)
+        metrics.STREAM_RESETS.inc()
+
+
+def publish(model_name: str, action: str, data: dict[str, Any]) -> None:
+    """
+    Fans out a change to the matching subscribers.
+    'data' is the row after the change, or the last row on delete.
+    Thread safe: the queues are only touched on their event loop.
+    """
+    id, parent_type, parent_id = (
+        data.get("id"),
+        data.get("parent_type"),
+        data.get("parent_id"),
+    )
+
+    with subscriptions_lock:
+        subs = [
+            sub
+            for sub in subscriptions.get(model_name, set())
+            | subscriptions.get(None, set())
+            if sub.matches(id, parent_type, parent_id)
+        ]
+
+    if not subs:
+        return
+
+    # serialized once for all subscribers
+    msg = (
+        f"event: {action}\ndata: "
+        + to_json({"model": model_name, "data": data}, fallback=str).decode()
+        + "\n\n"
+    )
+
+    for sub in subs:
+        sub.loop.call_soon_threadsafe(__deliver, sub, msg)
+
+    metrics.STREAM_MESSAGES.labels(model_name).inc(len(subs))
+
+
+def publish_instance(model_name: str, action: str, x: Any) -> None:
+    # with the changefeed, the writes of all processes come from there
+    if STREAM_SOURCE != "local":
+        return
+
+    # don't dump the instance for nobody
+    if not subscriptions.get(model_name) and not subscriptions.get(None):
+        return
+
+    publish(model_name, action, x.model_dump())
+
+
+def publish_row(
+    model_name: str, before: dict[str, Any] | None, after: dict[str, Any] | None
+) -> None:
+    # a row of the changefeed
+    if after is None:
+        publish(model_name, "delete", before or {})
+    else:
+        publish(model_name, "create" if before is None else "update", after)
+
+
+async def listen(sub: Subscription):
+    """
+    The SSE messages of a subscription, with a comment line
+    to keep the connection open when there are no changes.
+    """
+    try:
+        while True:
+            try:
+                yield await asyncio.wait_for(
+                    sub.queue.get(), STREAM_KEEPALIVE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        # also runs when the client disconnects
+        unsubscribe(sub)
@@ -1,21 +1,89 @@
+from collections import OrderedDict
 from psycopg_pool import ConnectionPool
 from psycopg.types.array import ListDumper
 from psycopg.types.json import Jsonb, JsonbDumper
-from typing import Any, Type
+from typing import Any, Callable, Type, get_args, get_origin
 from uuid import UUID
+import functools
+import hashlib
+import json
+import logging
 import os
+import psycopg
+import random
+import re
+import socket
+import threading
+import time
 import datetime as dt
+import apiserver.tracing as tracing
 from apiserver.models import (
+    AttachmentInfo,
+    AuditFields,
+    Descendant,
+    Event,
     Model,
+    MultipartUpload,
     Report,
-    pyd_models,
+    SchemaJob,
+    Skema,
     BaseFields,
 )
+import apiserver.models as mdl
 
 
 DB_URL = os.getenv("DB_URL")
 DB_URL_DML = os.getenv("DB_URL_DML")
 DB_URL_SELECT = os.getenv("DB_URL_SELECT")
+# instance reads can be served by a different gateway or region
+DB_URL_READ = os.getenv("DB_URL_READ", DB_URL)
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 4))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_READ_POOL_MIN_SIZE = int(os.getenv("DB_READ_POOL_MIN_SIZE", 4))
+DB_READ_POOL_MAX_SIZE = int(os.getenv("DB_READ_POOL_MAX_SIZE", 10))
+
+# retries of serialization failures (SQLSTATE 40001)
+SERIALIZATION_FAILURE = "40001"
+DB_MAX_RETRIES = int(os.getenv("DB_MAX_RETRIES", 5))
+DB_RETRY_BASE_DELAY_MS = int(os.getenv("DB_RETRY_BASE_DELAY_MS", 10))
+DB_RETRY_MAX_DELAY_MS = int(os.getenv("DB_RETRY_MAX_DELAY_MS", 1000))
+
+# statements slower than the threshold are logged, sampled at the given rate
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 500))
+SLOW_QUERY_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_SAMPLE_RATE", 1.0))
+
+# rows of the instance tables are built without validation,
+# as psycopg already returns them with the right types
+DB_TRUSTED_HYDRATION = (
+    True
+    if os.getenv("DB_TRUSTED_HYDRATION", "True").lower()
+    in ["true", "1", "t", "y", "yes", "on"]
+    else False
+)
+
+# schema changes of the models run as background jobs
+SCHEMA_JOB_INTERVAL_SECONDS = int(os.getenv("SCHEMA_JOB_INTERVAL_SECONDS", 5))
+SCHEMA_JOB_LEASE_SECONDS = int(os.getenv("SCHEMA_JOB_LEASE_SECONDS", 60))
+SCHEMA_JOB_POLL_SECONDS = int(os.getenv("SCHEMA_JOB_POLL_SECONDS", 2))
+
+# the audit events of the instances hold the changed fields only,
+# with a full snapshot on create and at least every N updates.
+# Values whose JSON is longer than the threshold are compressed
+EVENTS_SNAPSHOT_EVERY = int(os.getenv("EVENTS_SNAPSHOT_EVERY", 20))
+EVENTS_COMPRESS_MIN_BYTES = int(os.getenv("EVENTS_COMPRESS_MIN_BYTES", 1024))
+
+# the tag counts are cached until the model is written to
+# by this process, or at most for the TTL
+TAG_COUNTS_CACHE_TTL_SECONDS = int(os.getenv("TAG_COUNTS_CACHE_TTL_SECONDS", 60))
+
+# phases of a statement call that are timed
+STMT_PHASES = ["pool_wait", "execute", "fetch", "hydrate"]
+# statements with stats, the least recently called are evicted
+STMT_STATS_MAX_SIZE = int(os.getenv("STMT_STATS_MAX_SIZE", 500))
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger(f"{__name__}.slow_query")
 
 SQL_RESERVED_WORDS = [
     "all",
@@ -116,26 +184,75 @@ RESERVED_WORDS = [
     "attachments",
 ] + SQL_RESERVED_WORDS
 
+# 'strong' reads go to the leaseholder, 'follower' reads use
+# follower_read_timestamp(), and an interval such as '10s' or '500ms'
+# allows reading data up to that old.
+STALENESS_RE = re.compile(r"^(strong|follower|\d+(ms|s|m))$")
+STALENESS_UNITS = {"ms": 0.001, "s": 1, "m": 60}
+
+# the cluster clock and follower_read_timestamp(), refetched at most once a
+# second, to pin the stale reads to a timestamp that can be reported
+cluster_clock: dict[str, Any] = {}
+cluster_clock_lock = threading.Lock()
+
 if not DB_URL:
     raise EnvironmentError("DB_URL env variable not found!")
 
 
-# the pool starts connecting immediately.
-pool = ConnectionPool(DB_URL, kwargs={"autocommit": True})
-dml_pool = ConnectionPool(DB_URL_DML, kwargs={"autocommit": True})
-select_pool = ConnectionPool(DB_URL_SELECT, kwargs={"autocommit": True})
+# the pools are opened on first use, so that startup doesn't wait on the db.
+# writes go to 'pool', reads of instances and reports go to 'read_pool'
+# so that heavy read traffic cannot starve writes of connections.
+pool = ConnectionPool(
+    DB_URL,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    kwargs={"autocommit": True},
+    name="pool",
+    open=False,
+)
+read_pool = ConnectionPool(
+    DB_URL_READ,
+    min_size=DB_READ_POOL_MIN_SIZE,
+    max_size=DB_READ_POOL_MAX_SIZE,
+    kwargs={"autocommit": True},
+    name="read_pool",
+    open=False,
+)
+dml_pool = ConnectionPool(
+    DB_URL_DML, kwargs={"autocommit": True}, name="dml_pool", open=False
+)
+select_pool = ConnectionPool(
+    DB_URL_SELECT, kwargs={"autocommit": True}, name="select_pool", open=False
+)
+pool_open_lock = threading.Lock()
+
+
+# per-statement stats, keyed by statement fingerprint, in LRU order
+stmt_stats: OrderedDict[str, dict] = OrderedDict()
+stmt_stats_lock = threading.Lock()
+
+
+def get_pool_stats() -> dict[str, dict]:
+    return {p.name: p.get_stats() for p in [pool, read_pool, dml_pool, select_pool]}
 
 
 def log_event(
-    model_name: str, ts: dt.datetime, username: str, action: str, details: str
+    model_name: str,
+    ts: dt.datetime,
+    username: str,
+    action: str,
+    details: str | None,
+    instance_id: UUID | None = None,
+    kind: str | None = None,
 ):
+    # each event has its own id, so a plain INSERT never overwrites
     execute_stmt(
-        """UPSERT INTO 
-            internal.events (object, ts, username, action, details) 
+        """INSERT INTO 
+            internal.events (object, instance_id, ts, username, action, kind, details) 
         VALUES 
-            (%s, %s, %s, %s, %s)
+            (%s, %s, %s, %s, %s, %s, %s)
         """,
-        (model_name, ts, username, action, details),
+        (model_name, instance_id, ts, username, action, kind, details),
         returning_rs=False,
     )
 
@@ -156,14 +273,121 @@ def load_schema(ddl_filename):
         execute_stmt(f.read(), returning_rs=False)
 
 
+def is_valid_staleness(staleness: str) -> bool:
+    return bool(STALENESS_RE.match(staleness))
+
+
+def __get_cluster_clock() -> dict[str, Any]:
+    with cluster_clock_lock:
+        if time.monotonic() - cluster_clock.get("fetched_at", -1.0) > 1:
+            now, follower_ts = execute_stmt(
+                "SELECT now(), follower_read_timestamp()", read_only=True
+            )
+            cluster_clock.update(
+                fetched_at=time.monotonic(), now=now, follower_ts=follower_ts
+            )
+
+        return dict(cluster_clock)
+
+
+def get_read_timestamp(
+    staleness: str | None, point_lookup: bool = False
+) -> dt.datetime | None:
+    """
+    The timestamp a stale read is pinned to, by the cluster clock.
+    None for strong reads and for bounded staleness point lookups,
+    whose timestamp is picked by the db.
+    """
+    if not staleness or staleness == "strong":
+        return None
+
+    if not is_valid_staleness(staleness):
+        raise ValueError(f"Invalid staleness '{staleness}'")
+
+    if point_lookup and staleness != "follower":
+        return None
+
+    clock = __get_cluster_clock()
+    if staleness == "follower":
+        return clock["follower_ts"]
+
+    unit = "ms" if staleness.endswith("ms") else staleness[-1]
+    seconds = int(staleness[: -len(unit)]) * STALENESS_UNITS[unit]
+    now = clock["now"] + dt.timedelta(seconds=time.monotonic() - clock["fetched_at"])
+
+    return now - dt.timedelta(seconds=seconds)
+
+
+def get_as_of_clause(staleness: str | None, point_lookup: bool = False) -> str:
+    """
+    Returns the AS OF SYSTEM TIME clause for the requested staleness,
+    or for the timestamp it was pinned to (see get_read_timestamp()).
+    Bounded staleness reads (with_max_staleness) are only allowed
+    for single-row lookups, so scans use an exact staleness instead.
+    """
+    if not staleness or staleness == "strong":
+        return ""
+
+    if not is_valid_staleness(staleness):
+        try:
+            # formatted again, so that nothing but a timestamp gets in
+            ts = dt.datetime.fromisoformat(staleness)
+        except ValueError:
+            raise ValueError(f"Invalid staleness '{staleness}'")
+
+        return f"AS OF SYSTEM TIME '{ts.isoformat()}'"
+
+    if staleness == "follower":
+        return "AS OF SYSTEM TIME follower_read_timestamp()"
+
+    if point_lookup:
+        return f"AS OF SYSTEM TIME with_max_staleness('{staleness}')"
+
+    return f"AS OF SYSTEM TIME '-{staleness}'"
+
+
 def get_fields(model) -> str:
     return ", ".join([x for x in model.__fields__.keys()])
 
 
+def get_projection(model, fields: list[str] | None = None) -> str:
+    """
+    The columns to select for a model,
+    or only 'id' and the requested fields, if any.
+    """
+    if fields is None:
+        return get_fields(model)
+
+    return ", ".join(["id"] + [x for x in dict.fromkeys(fields) if x != "id"])
+
+
 def get_placeholders(model) -> str:
     return ("%s, " * len(tuple(model.__fields__.keys())))[:-2]
 
 
+def get_tags_clause(
+    tag_filter: dict[str, list[str]] | None, table_name: str
+) -> tuple[list[str], tuple]:
+    """
+    The conditions of 'tag_filter', both served by the inverted index:
+    'tags' are all contained in the tags of the row, 'tags_any' overlap them.
+    """
+    where: list[str] = []
+    bind_params: list[Any] = []
+
+    if not tag_filter:
+        return where, ()
+
+    if tag_filter.get("tags"):
+        where.append(f"{table_name}.tags @> %s")
+        bind_params.append(tag_filter["tags"])
+    if tag_filter.get("tags_any"):
+        where.append(f"{table_name}.tags && %s")
+        bind_params.append(tag_filter["tags_any"])
+
+    return where, tuple(bind_params)
+
+
 def __get_where_clause(
     filters, table_name: str, include_where: bool = True
 ) -> tuple[str, tuple]:
@@ -210,14 +434,19 @@ MODEL_PLACEHOLDERS = get_placeholders(Model)
 
 def get_type(json_data_type: str) -> str:
     """
-    Maps a python type to a column data type
+    Maps a skema field type to a column data type.
+    Other types, e.g. 'decimal', are used as the column type.
     """
     return {
         "string": "STRING",
+        "markdown": "STRING",
+        "enum": "STRING",
         "integer": "INT8",
+        "decimal": "DECIMAL",
         "datetime": "TIMESTAMPTZ",
+        "timestamp": "TIMESTAMPTZ",
         "date": "DATE",
-    }[json_data_type]
+    }.get(json_data_type, json_data_type)
 
 
 def get_all_models() -> list[Model]:
@@ -244,11 +473,6 @@ def get_model(name: str) -> Model:
 
 
 def create_model(model: Model) -> Model | None:
-    def get_type(x):
-        return {"markdown": "STRING", "enum": "STRING", "timestamp": "TIMESTAMPTZ"}.get(
-            x, x
-        )
-
     # build the CREATE TABLE stmt
     additions: dict[str, str] = {}
 
@@ -310,6 +534,7 @@ def create_model(model: Model) -> Model | None:
         stmt_prefix + stmt + stmt_suffix,
         (),
         returning_rs=False,
+        model_name=model.name,
     )
 
     new_model = execute_stmt(
@@ -329,53 +554,352 @@ def create_model(model: Model) -> Model | None:
     return new_model
 
 
-def update_model(model: Model) -> Model | None:
-    old_model = get_model(model.name)
+def get_schema_change_stmts(model: Model, skema: Skema) -> list[str]:
+    """
+    The DDL migrating the table of a model to the new skema.
+    The indexes that changed are dropped first, then all column changes
+    run as one ALTER TABLE, that is one schema change job,
+    so that they are applied all or none.
+    The stmts can be run again if a job is retried.
+    """
+    old_fields = {f["name"]: f for f in model.skema.fields}
+    new_fields = {f["name"]: f for f in skema.fields}
+
+    stmts = []
+
+    # the new indexes are built by create_indexes() once the job succeeds
+    old_indexes = get_index_defs(model.name, model.skema)
+    new_indexes = get_index_defs(model.name, skema)
+    dropped = [k for k, v in old_indexes.items() if new_indexes.get(k) != v]
+    if dropped:
+        stmts.append(
+            "DROP INDEX IF EXISTS " + ", ".join(f"{model.name}@{x}" for x in dropped)
+        )
 
-    print(old_model)
-    print(model.name)
+    cmds = [f"DROP COLUMN IF EXISTS {k}" for k in old_fields if k not in new_fields]
+    cmds += [
+        f"ADD COLUMN IF NOT EXISTS {k} {get_type(v['type'])}"
+        for k, v in new_fields.items()
+        if k not in old_fields
+    ]
+    if cmds:
+        stmts.append(f"ALTER TABLE {model.name} " + ", ".join(cmds))
 
-    additions: dict[str, str] = {}
-    removals: list[str] = []
+    return stmts
 
-    for k in old_model.fields.properties.keys():
-        if k not in model.fields.properties.keys():
-            removals.append(k)
 
-    for k, v in model.fields.properties.items():
-        if k not in old_model.fields.properties.keys():
-            additions[k] = v["type"]
+def execute_ddl(stmts: list[str]) -> None:
+    """
+    Runs the stmts on one connection, blocking until their schema change
+    jobs are done. Errors are raised to the caller.
+    """
+    with __get_pool(pool).connection() as conn:
+        # needed to drop columns
+        conn.execute("SET sql_safe_updates = false")
+        try:
+            for x in stmts:
+                conn.execute(x)
+        finally:
+            conn.execute("SET sql_safe_updates = true")
 
-    # drop column stmts have to be executed in their own transaction
-    for x in removals:
-        execute_stmt(
-            f"""SET sql_safe_updates = false;
-            ALTER TABLE {model.name} DROP COLUMN {x};
-            SET sql_safe_updates = true;
-            """,
-            returning_rs=False,
+
+#############
+#  INDEXES  #
+#############
+# the overview columns, besides the pk, stored by default in the indexes
+INDEX_STORING_COLS = [
+    k
+    for k in (BaseFields.model_fields | AuditFields.model_fields).keys()
+    if k != "id"
+]
+
+
+def get_index_defs(model_name: str, skema: Skema) -> dict[str, str]:
+    """
+    The CREATE INDEX stmts of the fields declared 'indexed' or 'unique',
+    keyed by index name.
+    Unless the field sets 'storing' to false or to a list of columns,
+    the index stores the overview columns, so that listings filtered
+    or sorted on the field are served by the index alone.
+    """
+    overview = INDEX_STORING_COLS + [
+        f["name"] for f in skema.fields if f["in_overview"]
+    ]
+
+    defs = {}
+    for f in skema.fields:
+        if not f.get("indexed") and not f.get("unique"):
+            continue
+
+        storing = f.get("storing", True)
+        if storing is True:
+            storing = overview
+        storing = [x for x in storing or [] if x != f["name"]]
+
+        name = f"{model_name}_{f['name']}_idx"
+        defs[name] = (
+            f"CREATE {'UNIQUE ' if f.get('unique') else ''}INDEX IF NOT EXISTS {name} "
+            f"ON {model_name} ({f['name']} {f.get('sort', 'asc').upper()})"
+            + (f" STORING ({', '.join(storing)})" if storing else "")
         )
 
-    for x, y in additions.items():
+    return defs
+
+
+def get_existing_indexes(model_name: str) -> set[str]:
+    rs = execute_stmt(
+        f"SELECT DISTINCT index_name FROM [SHOW INDEXES FROM {model_name}]",
+        (),
+        is_list=True,
+        model_name=model_name,
+    )
+    return {x[0] for x in rs or []}
+
+
+def drop_indexes(model_name: str, names: list[str]) -> None:
+    for x in names:
         execute_stmt(
-            f"ALTER TABLE {model.name} ADD COLUMN {x} {get_type(y)};",
+            f"DROP INDEX IF EXISTS {model_name}@{x}",
             returning_rs=False,
+            model_name=model_name,
         )
 
-    new_model = execute_stmt(
+
+def create_indexes(model_name: str) -> None:
+    """
+    Builds the declared indexes that don't exist yet.
+    Each CREATE INDEX blocks until the backfill is done.
+    """
+    model = get_model(model_name)
+    if not model:
+        return
+
+    existing = get_existing_indexes(model_name)
+
+    for k, v in get_index_defs(model_name, model.skema).items():
+        if k not in existing:
+            execute_stmt(v, returning_rs=False, model_name=model_name)
+
+
+def get_index_status(model_name: str) -> list[dict] | None:
+    model = get_model(model_name)
+    if not model:
+        return None
+
+    existing = get_existing_indexes(model_name)
+
+    l = []
+    for k, v in get_index_defs(model_name, model.skema).items():
+        # the latest schema change job building the index, if any
+        job = execute_stmt(
+            """
+            SELECT job_id, status, fraction_completed, created, error
+            FROM [SHOW JOBS]
+            WHERE job_type IN ('SCHEMA CHANGE', 'NEW SCHEMA CHANGE')
+                AND description LIKE %s
+            ORDER BY created DESC
+            LIMIT 1
+            """,
+            (f"%INDEX%{k} ON%",),
+        )
+
+        if job and job[1] in ("running", "pending", "paused"):
+            status = "building"
+        elif k in existing:
+            status = "live"
+        elif job and job[1] == "failed":
+            status = "failed"
+        else:
+            status = "pending"
+
+        l.append(
+            {
+                "name": k,
+                "stmt": v,
+                "status": status,
+                "fraction_completed": job[2] if job else None,
+                "job_id": job[0] if job else None,
+                "error": job[4] if job else None,
+            }
+        )
+
+    return l
+
+
+#################
+#  SCHEMA JOBS  #
+#################
+SCHEMA_JOB_COLS = get_fields(SchemaJob)
+
+
+def create_schema_job(model: Model) -> SchemaJob | None:
+    # only one pending or running job per model,
+    # as each job is diffed against the skema left by the previous one
+    return execute_stmt(
         f"""
-        UPDATE internal.models SET
-            (skema, updated_by, updated_at) = (%s, %s, %s)
-        WHERE name = %s 
-        RETURNING {MODEL_COLS}""",
-        (model.skema.model_dump_json(), model.updated_by, model.updated_at, model.name),
-        Model,
+        INSERT INTO internal.schema_jobs
+            (model_name, skema, created_by)
+        SELECT %s, %s::JSONB, %s
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM internal.schema_jobs
+            WHERE model_name = %s
+                AND status IN ('pending', 'running')
+        )
+        RETURNING {SCHEMA_JOB_COLS}
+        """,
+        (model.name, model.skema.model_dump_json(), model.updated_by, model.name),
+        SchemaJob,
     )
 
-    # trigger async App restart
-    update_watch()
 
-    return new_model
+def get_schema_jobs(model_name: str, limit: int) -> list[SchemaJob]:
+    return execute_stmt(
+        f"""
+        SELECT {SCHEMA_JOB_COLS}
+        FROM internal.schema_jobs
+        WHERE model_name = %s
+        ORDER BY created_at DESC
+        LIMIT %s
+        """,
+        (model_name, limit),
+        SchemaJob,
+        True,
+    )
+
+
+def get_schema_job(model_name: str, id: UUID) -> SchemaJob | None:
+    return execute_stmt(
+        f"""
+        SELECT {SCHEMA_JOB_COLS}
+        FROM internal.schema_jobs
+        WHERE (model_name, id) = (%s, %s)
+        """,
+        (model_name, id),
+        SchemaJob,
+    )
+
+
+def claim_schema_job(lease_seconds: int) -> SchemaJob | None:
+    # a running job whose lease expired was left by a crashed instance
+    return execute_stmt(
+        f"""
+        UPDATE internal.schema_jobs SET
+            status = 'running',
+            lease_until = now() + %s::INTERVAL
+        WHERE id = (
+            SELECT id
+            FROM internal.schema_jobs
+            WHERE status = 'pending'
+                OR (status = 'running' AND lease_until < now())
+            ORDER BY created_at
+            LIMIT 1
+        )
+        RETURNING {SCHEMA_JOB_COLS}
+        """,
+        (f"{lease_seconds}s",),
+        SchemaJob,
+    )
+
+
+def renew_schema_job(
+    id: UUID,
+    lease_seconds: int,
+    stmts: list[str],
+    crdb_job_id: int | None = None,
+    fraction_completed: float = 0,
+) -> None:
+    execute_stmt(
+        """
+        UPDATE internal.schema_jobs SET
+            lease_until = now() + %s::INTERVAL,
+            stmts = %s,
+            crdb_job_id = %s,
+            fraction_completed = %s
+        WHERE id = %s
+        """,
+        (f"{lease_seconds}s", stmts, crdb_job_id, fraction_completed, id),
+        returning_rs=False,
+    )
+
+
+def fail_schema_job(id: UUID, error: str) -> None:
+    execute_stmt(
+        """
+        UPDATE internal.schema_jobs SET
+            status = 'failed',
+            error = %s,
+            lease_until = NULL
+        WHERE id = %s
+        """,
+        (error, id),
+        returning_rs=False,
+    )
+
+
+def complete_schema_job(job: SchemaJob) -> Model | None:
+    """
+    Records the new skema and bumps the watch epoch,
+    together with the job status, once the DDL succeeded.
+    """
+
+    def complete_tx(cur) -> Model | None:
+        m = fetch_stmt(
+            cur,
+            f"""
+            UPDATE internal.models SET
+                (skema, updated_by, updated_at) = (%s::JSONB, %s, now())
+            WHERE name = %s
+            RETURNING {MODEL_COLS}
+            """,
+            (job.skema.model_dump_json(), job.created_by, job.model_name),
+            Model,
+        )
+        fetch_stmt(
+            cur,
+            """
+            UPDATE internal.schema_jobs SET
+                status = 'succeeded',
+                fraction_completed = 1,
+                lease_until = NULL
+            WHERE id = %s
+            """,
+            (job.id,),
+            returning_rs=False,
+        )
+        # trigger the reload of the models
+        fetch_stmt(
+            cur, "UPDATE internal.watch SET id=1 WHERE true", returning_rs=False
+        )
+
+        return m
+
+    return run_transaction(complete_tx, "complete_schema_job")
+
+
+def get_ddl_job_progress(model_name: str, since: dt.datetime) -> tuple | None:
+    # the latest schema change job on the table, started since the claim.
+    # Jobs are matched on the id of the table, as their description
+    # can also name other tables, e.g. 'acc' in 'ALTER TABLE account'
+    return execute_stmt(
+        """
+        SELECT job_id, fraction_completed
+        FROM crdb_internal.jobs
+        WHERE job_type IN ('SCHEMA CHANGE', 'NEW SCHEMA CHANGE')
+            AND (
+                SELECT table_id
+                FROM crdb_internal.tables
+                WHERE database_name = current_database()
+                    AND schema_name = 'public'
+                    AND name = %s
+                    AND drop_time IS NULL
+            ) = ANY(descriptor_ids)
+            AND created >= %s
+        ORDER BY created DESC
+        LIMIT 1
+        """,
+        (model_name, since),
+    )
 
 
 def delete_model(model_name: str) -> Model | None:
@@ -386,6 +910,17 @@ def delete_model(model_name: str) -> Model | None:
         SET sql_safe_updates = true;
         """,
         returning_rs=False,
+        model_name=model_name,
+    )
+
+    # the links from and to its instances
+    execute_stmt(
+        """
+        DELETE FROM internal.hierarchy
+        WHERE ancestor_type = %s OR descendant_type = %s
+        """,
+        (model_name, model_name),
+        returning_rs=False,
     )
 
     deleted_model = execute_stmt(
@@ -403,6 +938,128 @@ def delete_model(model_name: str) -> Model | None:
     return deleted_model
 
 
+############
+#  EVENTS  #
+############
+EVENT_COLS = get_fields(Event)
+
+
+def get_events(
+    model_name: str | None,
+    username: str | None,
+    action: str | None,
+    start: dt.datetime | None,
+    end: dt.datetime | None,
+    after: tuple[dt.datetime, UUID] | None,
+    limit: int,
+) -> list[Event]:
+    """
+    Events newest first, after the (ts, id) keyset of the previous page.
+    Filtering on the model, the user or the action is served by the
+    matching index.
+    """
+    where = []
+    bind_params: list[Any] = []
+
+    filters = [("object", model_name), ("username", username), ("action", action)]
+    for col, value in filters:
+        if value is not None:
+            where.append(f"{col} = %s")
+            bind_params.append(value)
+
+    if start:
+        where.append("ts >= %s")
+        bind_params.append(start)
+    if end:
+        where.append("ts < %s")
+        bind_params.append(end)
+    if after:
+        where.append("(ts, id) < (%s, %s)")
+        bind_params.extend(after)
+
+    return execute_stmt(
+        f"""
+        SELECT {EVENT_COLS}
+        FROM internal.events
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY ts DESC, id DESC
+        LIMIT %s
+        """,
+        (*bind_params, limit),
+        Event,
+        True,
+        read_only=True,
+    )
+
+
+def is_snapshot_due(model_name: str, id: UUID) -> bool:
+    """
+    True if none of the last EVENTS_SNAPSHOT_EVERY - 1 events
+    of the instance is a snapshot.
+    """
+    rs = execute_stmt(
+        """
+        SELECT kind
+        FROM internal.events
+        WHERE (object, instance_id) = (%s, %s)
+        ORDER BY ts DESC, id DESC
+        LIMIT %s
+        """,
+        (model_name, id, max(EVENTS_SNAPSHOT_EVERY - 1, 1)),
+        is_list=True,
+    )
+
+    return not rs or all(x[0] != "snapshot" for x in rs)
+
+
+def get_instance_events(
+    model_name: str, id: UUID, at: dt.datetime | None = None
+) -> list[Event]:
+    """
+    The events of an instance oldest first, up to 'at'.
+    """
+    return execute_stmt(
+        f"""
+        SELECT {EVENT_COLS}
+        FROM internal.events
+        WHERE (object, instance_id) = (%s, %s)
+        {"AND ts <= %s" if at else ""}
+        ORDER BY ts, id
+        """,
+        (model_name, id, at) if at else (model_name, id),
+        Event,
+        True,
+        read_only=True,
+    )
+
+
+def get_changes(model_names: list[str], cursor: str | None = None):
+    """
+    Yields (model_name, before, after) for each change of the instance
+    tables, and (None, resolved_ts, None) every few seconds:
+    all changes up to resolved_ts were yielded, so it can be passed
+    as 'cursor' to resume from there.
+    Runs a sinkless changefeed on a dedicated connection, which needs
+    the cluster setting kv.rangefeed.enabled.
+    """
+    options = "diff, resolved = '5s'"
+    if cursor:
+        options += f", cursor = '{cursor}'"
+
+    with psycopg.connect(DB_URL, autocommit=True) as conn, conn.cursor() as cur:
+        # the changefeed never ends: read the rows as they come
+        for table, _, value in cur.stream(
+            f"EXPERIMENTAL CHANGEFEED FOR TABLE {', '.join(model_names)} "
+            f"WITH {options}"
+        ):
+            v = json.loads(value)
+
+            if table is None:
+                yield None, v["resolved"], None
+            else:
+                yield table, v.get("before"), v.get("after")
+
+
 #############
 #  REPORTS  #
 #############
@@ -419,6 +1076,7 @@ def get_all_reports() -> list[Report]:
         (),
         Report,
         True,
+        read_only=True,
     )
 
 
@@ -430,6 +1088,7 @@ def get_report(name: str) -> Report | None:
         WHERE name = %s""",
         (name,),
         Report,
+        read_only=True,
     )
 
 
@@ -474,94 +1133,159 @@ def delete_report(name: str) -> Report | None:
 ###############
 #  INSTANCES  #
 ###############
-def get_all_instances(model_name: str) -> list[Type[BaseFields]]:
+def get_all_instances(
+    model_name: str,
+    staleness: str | None = None,
+    fields: list[str] | None = None,
+    tag_filter: dict[str, list[str]] | None = None,
+) -> list[Type[BaseFields]] | list[dict]:
+    # with 'fields', only those columns are fetched and returned as dicts
+    model = mdl.pyd_models[model_name]["overview"]
+    where, bind_args = get_tags_clause(tag_filter, model_name)
+
     return execute_stmt(
         f"""
-        SELECT *
+        SELECT {get_projection(model, fields)}
         FROM {model_name}
+        {get_as_of_clause(staleness)}
+        {"WHERE " + " AND ".join(where) if where else ""}
         ORDER BY name
         """,
-        (),
-        pyd_models[model_name]["overview"],
+        bind_args,
+        dict if fields else model,
         True,
+        read_only=True,
+        model_name=model_name,
+    )
+
+
+def get_tag_counts(
+    model_name: str,
+    tag_filter: dict[str, list[str]] | None = None,
+    staleness: str | None = None,
+    limit: int = 100,
+) -> dict[str, int] | None:
+    """
+    The number of instances of each tag, most used first,
+    among the instances matching 'tag_filter'.
+    """
+    where, bind_args = get_tags_clause(tag_filter, model_name)
+
+    rs = execute_stmt(
+        f"""
+        SELECT tag, count(*)
+        FROM {model_name}, unnest({model_name}.tags) AS tag
+        {get_as_of_clause(staleness)}
+        {"WHERE " + " AND ".join(where) if where else ""}
+        GROUP BY tag
+        ORDER BY count(*) DESC, tag
+        LIMIT %s
+        """,
+        (*bind_args, limit),
+        is_list=True,
+        read_only=True,
+        model_name=model_name,
     )
 
+    if rs is None:
+        return None
+
+    return {tag: n for tag, n in rs}
+
+
+def get_instance(
+    model_name: str,
+    id: UUID,
+    staleness: str | None = None,
+    fields: list[str] | None = None,
+) -> Type[BaseFields] | dict | None:
+    model = mdl.pyd_models[model_name]["default"]
 
-def get_instance(model_name: str, id: UUID) -> Type[BaseFields] | None:
     return execute_stmt(
         f"""
-        SELECT *
+        SELECT {get_projection(model, fields)}
         FROM {model_name}
+        {get_as_of_clause(staleness, True)}
         WHERE id = %s
         """,
         (id,),
-        pyd_models[model_name]["default"],
+        dict if fields else model,
+        read_only=True,
+        model_name=model_name,
     )
 
 
 def get_all_children(
     model_name: str,
     id: UUID,
-) -> dict[str, list[Type[BaseFields]]] | None:
+    staleness: str | None = None,
+    fields: list[str] | None = None,
+    tag_filter: dict[str, list[str]] | None = None,
+) -> dict[str, list[Type[BaseFields]] | list[dict]] | None:
     models = get_all_models()
 
     children = {}
 
     for m in models:
+        model = mdl.pyd_models[m.name]["overview"]
+        # each model gets the requested fields it has
+        model_fields = (
+            [x for x in fields if x in mdl.pyd_models[m.name]["default"].model_fields]
+            if fields
+            else None
+        )
+
+        where, bind_args = get_tags_clause(tag_filter, m.name)
+
         children[m.name] = execute_stmt(
             f"""
-            SELECT *
+            SELECT {get_projection(model, model_fields)}
             FROM {m.name}
+            {get_as_of_clause(staleness)}
             WHERE (parent_type, parent_id) = (%s, %s)
+            {"".join(" AND " + x for x in where)}
             """,
-            (model_name, id),
-            pyd_models[m.name]["overview"],
+            (model_name, id, *bind_args),
+            dict if fields else model,
             True,
+            read_only=True,
+            model_name=m.name,
         )
 
     return children
 
 
-def set_parent_to_null(
-    model_name: str,
-    id: UUID,
-) -> None:
-    models = get_all_models()
-
-    for m in models:
-        execute_stmt(
-            f"""
-            UPDATE {m.name}
-            SET parent_type = NULL, parent_id = NULL
-            WHERE (parent_type, parent_id) = (%s, %s)
-            """,
-            (model_name, id),
-            returning_rs=False,
-        )
-
-    return
-
-
 def get_all_children_for_model(
     model_name: str,
     id: UUID,
     children_model_name: str,
-) -> list[Type[BaseFields]] | None:
+    staleness: str | None = None,
+    fields: list[str] | None = None,
+    tag_filter: dict[str, list[str]] | None = None,
+) -> list[Type[BaseFields]] | list[dict] | None:
+    model = mdl.pyd_models[children_model_name]["overview"]
+    where, bind_args = get_tags_clause(tag_filter, children_model_name)
+
     return execute_stmt(
         f"""
-            SELECT *
+            SELECT {get_projection(model, fields)}
             FROM {children_model_name}
+            {get_as_of_clause(staleness)}
             WHERE (parent_type, parent_id) = (%s, %s)
+            {"".join(" AND " + x for x in where)}
             """,
-        (model_name, id),
-        pyd_models[children_model_name]["overview"],
+        (model_name, id, *bind_args),
+        dict if fields else model,
         True,
+        read_only=True,
+        model_name=children_model_name,
     )
 
 
 def get_parent_chain(
     model_name: str,
     id: UUID,
+    staleness: str | None = None,
 ) -> list | None:
     chain = []
 
@@ -569,13 +1293,16 @@ def get_parent_chain(
         f"""
         SELECT parent_type, parent_id::STRING, name
         FROM {model_name}
+        {get_as_of_clause(staleness, True)}
         WHERE id = %s
         """,
         (id,),
+        read_only=True,
+        model_name=model_name,
     )
 
     if p[0]:
-        chain.extend(get_parent_chain(p[0], p[1]))
+        chain.extend(get_parent_chain(p[0], p[1], staleness))
         chain.append(p)
 
     else:
@@ -588,181 +1315,1188 @@ def get_parent_chain(
 def create_instance(
     model_name: str, model_instance: Type[BaseFields]
 ) -> Type[BaseFields] | None:
-    cols = get_fields(pyd_models[model_name]["default"])
-    ph = get_placeholders(pyd_models[model_name]["default"])
-
-    return execute_stmt(
-        f"""
+    cols = get_fields(mdl.pyd_models[model_name]["default"])
+    ph = get_placeholders(mdl.pyd_models[model_name]["default"])
+    stmt = f"""
         INSERT INTO {model_name}
             ({cols})
         VALUES
             ({ph})
         RETURNING {cols}
-        """,
-        tuple(model_instance.model_dump().values()),
-        pyd_models[model_name]["default"],
-    )
+        """
+    bind_args = tuple(model_instance.model_dump().values())
 
+    # roots don't need a transaction
+    if not model_instance.parent_id:
+        return execute_stmt(
+            stmt,
+            bind_args,
+            mdl.pyd_models[model_name]["default"],
+            model_name=model_name,
+        )
+
+    def create_tx(cur) -> Type[BaseFields] | None:
+        x = fetch_stmt(cur, stmt, bind_args, mdl.pyd_models[model_name]["default"])
+        link_instance(
+            cur, model_name, x.id, model_instance.parent_type, model_instance.parent_id
+        )
+        return x
+
+    return run_transaction(create_tx, f"create_instance {model_name}", model_name)
 
-def update_instance(
-    model_name: str, model_instance: Type[BaseFields]
-) -> Type[BaseFields] | None:
-    cols = get_fields(pyd_models[model_name]["default"])
-    ph = get_placeholders(pyd_models[model_name]["default"])
 
-    if model_instance.id:
-        old_model_instance = get_instance(model_name, model_instance.id)
+def update_instance(
+    model_name: str,
+    id: UUID,
+    data: dict[str, Any],
+    if_updated_at: dt.datetime | None = None,
+) -> tuple[Type[BaseFields], dict[str, Any]] | None:
+    """
+    Writes only the fields in 'data' in a single statement.
+    If 'if_updated_at' is passed, the row is only updated if it
+    wasn't modified since, otherwise None is returned.
+    Returns the updated instance and the previous values of the fields
+    in 'data', read by the same statement.
+    """
+    model = mdl.pyd_models[model_name]["default"]
+    cols = get_fields(model)
+    set_clause = ", ".join([f"{k} = %s" for k in data.keys()])
+    old_cols = ", ".join(data.keys())
+    old_aliases = ", ".join([f"old.{k} AS __old_{k}" for k in data.keys()])
+    bind_args = (id, *tuple(data.values()), id)
+
+    where_clause = "WHERE id = %s"
+    if if_updated_at:
+        where_clause += " AND updated_at = %s"
+        bind_args += (if_updated_at,)
+
+    # the CTEs read the same snapshot, so 'old' holds the row before the update
+    stmt = f"""
+        WITH old AS (
+            SELECT {old_cols} FROM {model_name} WHERE id = %s
+        ), new AS (
+            UPDATE {model_name} SET
+                {set_clause}
+            {where_clause}
+            RETURNING {cols}
+        )
+        SELECT new.*, {old_aliases}
+        FROM new, old
+        """
+
+    def reparent_tx(cur) -> dict | None:
+        rs = fetch_stmt(cur, stmt, bind_args, dict)
+
+        parent_keys = [k for k in ["parent_type", "parent_id"] if k in data]
+        if rs and any(rs[k] != rs[f"__old_{k}"] for k in parent_keys):
+            unlink_instance(cur, model_name, id)
+            if rs["parent_id"]:
+                link_instance(
+                    cur, model_name, id, rs["parent_type"], rs["parent_id"], True
+                )
+
+        return rs
+
+    # only a new parent needs the hierarchy to be updated in a transaction
+    if "parent_type" in data or "parent_id" in data:
+        rs = run_transaction(reparent_tx, f"update_instance {model_name}", model_name)
     else:
+        rs = execute_stmt(stmt, bind_args, dict, model_name=model_name)
+
+    if not rs:
         return None
 
-    if old_model_instance:
-        old_model_instance = pyd_models[model_name]["default"](
-            **old_model_instance.model_dump()
-        )
-        update_data = model_instance.model_dump(exclude_unset=True)
-        new_model_instance = old_model_instance.model_copy(update=update_data)
+    old = {k[6:]: rs.pop(k) for k in list(rs.keys()) if k.startswith("__old_")}
+    x = __hydrate(model, list(rs.keys()), [tuple(rs.values())])[0]
 
-        return execute_stmt(
+    # the previous values are compared to the instance, so they get the
+    # types of the model whatever the hydration, e.g. float for a Decimal
+    for k, v in old.items():
+        fi = model.model_fields.get(k)
+        converter = __get_converter(fi.annotation) if fi else None
+        if converter and v is not None:
+            old[k] = converter(v)
+
+    return x, old
+
+
+def delete_instance(model_name: str, id: UUID) -> Type[BaseFields] | None:
+    cols = get_fields(mdl.pyd_models[model_name]["default"])
+    models = get_all_models()
+
+    def delete_tx(cur) -> Type[BaseFields] | None:
+        # set parent_type and parent_id to NULL for all children
+        for m in models:
+            fetch_stmt(
+                cur,
+                f"""
+                UPDATE {m.name}
+                SET parent_type = NULL, parent_id = NULL
+                WHERE (parent_type, parent_id) = (%s, %s)
+                """,
+                (model_name, id),
+                returning_rs=False,
+            )
+
+        x = fetch_stmt(
+            cur,
             f"""
-            UPDATE {model_name} SET
-                ({cols}) = ({ph})
+            DELETE FROM {model_name}
             WHERE id = %s
             RETURNING {cols}
             """,
-            (*tuple(new_model_instance.model_dump().values()), model_instance.id),
-            pyd_models[model_name]["default"],
+            (id,),
+            mdl.pyd_models[model_name]["default"],
         )
 
+        # queue the purge of all attachments of the instance
+        if x:
+            # its children become roots
+            unlink_instance(cur, model_name, id)
+            fetch_stmt(
+                cur,
+                """
+                DELETE FROM internal.hierarchy
+                WHERE (ancestor_type, ancestor_id) = (%s, %s)
+                """,
+                (model_name, id),
+                returning_rs=False,
+            )
+            fetch_stmt(
+                cur,
+                """
+                DELETE FROM internal.attachments
+                WHERE (model_name, id) = (%s, %s)
+                """,
+                (model_name, id),
+                returning_rs=False,
+            )
+            fetch_stmt(
+                cur,
+                "INSERT INTO internal.s3_purge_queue (folder) VALUES (%s)",
+                ("/".join([model_name, str(id)]),),
+                returning_rs=False,
+            )
+
+        return x
+
+    return run_transaction(delete_tx, f"delete_instance {model_name}", model_name)
+
+
+###############
+#  HIERARCHY  #
+###############
+# rebuilds stop at this depth, in case the parent links have a cycle
+HIERARCHY_MAX_DEPTH = 100
+
+# whether an instance is a descendant of another one
+IS_DESCENDANT_STMT = """
+    SELECT 1
+    FROM internal.hierarchy
+    WHERE (descendant_type, descendant_id) = (%s, %s)
+    AND (ancestor_type, ancestor_id) = (%s, %s)
+    """
+
+
+def link_instance(
+    cur,
+    model_name: str,
+    id: UUID,
+    parent_type: str,
+    parent_id: UUID,
+    check_cycle: bool = False,
+) -> None:
+    """
+    Links the instance and its descendants to its parent
+    and to the ancestors of the parent, in the caller's transaction.
+    """
+    # the new parent must not be in the subtree of the instance
+    if check_cycle and (
+        (parent_type, str(parent_id)) == (model_name, str(id))
+        or fetch_stmt(
+            cur, IS_DESCENDANT_STMT, (parent_type, parent_id, model_name, id)
+        )
+    ):
+        raise ValueError(f"{parent_type} {parent_id} is in the subtree of {id}")
+
+    fetch_stmt(
+        cur,
+        """
+        INSERT INTO internal.hierarchy
+            (ancestor_type, ancestor_id, depth, descendant_type, descendant_id)
+        SELECT
+            a.ancestor_type, a.ancestor_id, a.depth + s.depth + 1,
+            s.descendant_type, s.descendant_id
+        FROM (
+            SELECT ancestor_type, ancestor_id, depth
+            FROM internal.hierarchy
+            WHERE (descendant_type, descendant_id) = (%s, %s)
+            UNION ALL
+            SELECT %s::STRING, %s::UUID, 0
+        ) AS a, (
+            SELECT descendant_type, descendant_id, depth
+            FROM internal.hierarchy
+            WHERE (ancestor_type, ancestor_id) = (%s, %s)
+            UNION ALL
+            SELECT %s::STRING, %s::UUID, 0
+        ) AS s
+        """,
+        (parent_type, parent_id, parent_type, parent_id)
+        + (model_name, id, model_name, id),
+        returning_rs=False,
+    )
 
-def partial_update_instance(
-    model_name: str, user_id: str, id: UUID, field: str, value, ts: dt.datetime
-) -> Type[BaseFields] | None:
-    cols = get_fields(pyd_models[model_name]["default"])
+
+def unlink_instance(cur, model_name: str, id: UUID) -> None:
+    """
+    Removes the links of the instance and its descendants to the
+    ancestors of the instance, in the caller's transaction.
+    """
+    fetch_stmt(
+        cur,
+        """
+        DELETE FROM internal.hierarchy
+        WHERE (ancestor_type, ancestor_id) IN (
+            SELECT ancestor_type, ancestor_id
+            FROM internal.hierarchy
+            WHERE (descendant_type, descendant_id) = (%s, %s)
+        )
+        AND (
+            (descendant_type, descendant_id) = (%s, %s)
+            OR (descendant_type, descendant_id) IN (
+                SELECT descendant_type, descendant_id
+                FROM internal.hierarchy
+                WHERE (ancestor_type, ancestor_id) = (%s, %s)
+            )
+        )
+        """,
+        (model_name, id) * 3,
+        returning_rs=False,
+    )
+
+
+def is_in_subtree(
+    model_name: str, id: UUID, other_type: str, other_id: UUID
+) -> bool:
+    # True for the instance itself too
+    if (model_name, str(id)) == (other_type, str(other_id)):
+        return True
+
+    return bool(
+        execute_stmt(IS_DESCENDANT_STMT, (other_type, other_id, model_name, id))
+    )
+
+
+def __get_descendants_where(
+    max_depth: int | None, types: list[str] | None
+) -> tuple[str, tuple]:
+    where = "WHERE (ancestor_type, ancestor_id) = (%s, %s)"
+    bind_params: list[Any] = []
+
+    if max_depth:
+        where += " AND depth <= %s"
+        bind_params.append(max_depth)
+    if types:
+        where += f" AND descendant_type IN ({('%s, ' * len(types))[:-2]})"
+        bind_params += types
+
+    return where, tuple(bind_params)
+
+
+def get_descendants(
+    model_name: str,
+    id: UUID,
+    max_depth: int | None = None,
+    types: list[str] | None = None,
+    staleness: str | None = None,
+    limit: int = 1000,
+) -> list[Descendant] | None:
+    # a single scan of the primary key, already in order
+    where, bind_args = __get_descendants_where(max_depth, types)
 
     return execute_stmt(
         f"""
-        UPDATE {model_name} SET
-            {field} = %s,
-            updated_by = %s,
-            updated_at = %s
-        WHERE id = %s
-        RETURNING {cols}
+        SELECT descendant_type AS type, descendant_id AS id, depth
+        FROM internal.hierarchy
+        {get_as_of_clause(staleness)}
+        {where}
+        ORDER BY depth, descendant_type, descendant_id
+        LIMIT %s
         """,
-        (value, user_id, ts, id),
-        pyd_models[model_name]["default"],
+        (model_name, id, *bind_args, limit),
+        Descendant,
+        True,
+        read_only=True,
     )
 
 
-def delete_instance(model_name: str, id: UUID) -> Type[BaseFields] | None:
-    cols = get_fields(pyd_models[model_name]["default"])
-    return execute_stmt(
+def get_descendant_counts(
+    model_name: str,
+    id: UUID,
+    max_depth: int | None = None,
+    types: list[str] | None = None,
+    staleness: str | None = None,
+) -> dict[str, int] | None:
+    where, bind_args = __get_descendants_where(max_depth, types)
+
+    rs = execute_stmt(
         f"""
-        DELETE FROM {model_name}
-        WHERE id = %s
-        RETURNING {cols}
+        SELECT descendant_type, count(*)
+        FROM internal.hierarchy
+        {get_as_of_clause(staleness)}
+        {where}
+        GROUP BY descendant_type
         """,
-        (id,),
-        pyd_models[model_name]["default"],
+        (model_name, id, *bind_args),
+        is_list=True,
+        read_only=True,
     )
 
+    if rs is None:
+        return None
+
+    return {t: n for t, n in rs}
+
+
+def rebuild_hierarchy() -> int | None:
+    """
+    Recomputes the whole closure table from the parent links of the
+    instances, eg. for the instances created before it existed.
+    Runs in a single transaction over all the models, so the writes that
+    change the hierarchy (creates with a parent, moves, deletes) wait for
+    it or are retried: run it while these writes are paused.
+    Returns the number of rows.
+    """
+    models = get_all_models()
+
+    if not models:
+        return 0
+
+    edges = " UNION ALL ".join(
+        [
+            f"""SELECT parent_type, parent_id, '{m.name}' AS t, id
+            FROM {m.name} WHERE parent_id IS NOT NULL"""
+            for m in models
+        ]
+    )
+
+    def rebuild_tx(cur) -> int:
+        fetch_stmt(
+            cur, "DELETE FROM internal.hierarchy WHERE true", returning_rs=False
+        )
+        fetch_stmt(
+            cur,
+            f"""
+            WITH RECURSIVE edges AS (
+                {edges}
+            ), closure AS (
+                SELECT parent_type AS ancestor_type, parent_id AS ancestor_id,
+                    1 AS depth, t AS descendant_type, id AS descendant_id
+                FROM edges
+                UNION ALL
+                SELECT e.parent_type, e.parent_id,
+                    c.depth + 1, c.descendant_type, c.descendant_id
+                FROM closure AS c
+                JOIN edges AS e ON (e.t, e.id) = (c.ancestor_type, c.ancestor_id)
+                WHERE c.depth < %s
+            )
+            INSERT INTO internal.hierarchy
+                (ancestor_type, ancestor_id, depth, descendant_type, descendant_id)
+            SELECT ancestor_type, ancestor_id, depth, descendant_type, descendant_id
+            FROM closure
+            """,
+            (HIERARCHY_MAX_DEPTH,),
+            returning_rs=False,
+        )
+        return fetch_stmt(cur, "SELECT count(*) FROM internal.hierarchy")[0]
+
+    return run_transaction(rebuild_tx, "rebuild_hierarchy")
+
 
 ###############
 # ATTACHMENTS #
 ###############
-def add_attachment(model_name: str, id: UUID, s3_object_name: str) -> list[str]:
-    return execute_stmt(
+def get_attachments(model_name: str, id: UUID) -> list[str] | None:
+    rs = execute_stmt(
         f"""
-        UPDATE {model_name} SET
-            attachments = array_append(attachments, %s)
+        SELECT attachments
+        FROM {model_name}
         WHERE id = %s
-        RETURNING attachments
         """,
-        (s3_object_name, id),
+        (id,),
+        read_only=True,
+        model_name=model_name,
+    )
+
+    return rs[0] if rs else None
+
+
+def instance_exists(model_name: str, id: UUID) -> bool:
+    # unlike the reads through execute_stmt, an error is raised
+    # rather than being mistaken for a missing instance
+    return run_transaction(
+        lambda cur: fetch_stmt(cur, f"SELECT 1 FROM {model_name} WHERE id = %s", (id,))
+        is not None,
+        f"instance_exists {model_name}",
+        model_name,
+    )
+
+
+ATTACHMENT_INFO_COLS = get_fields(AttachmentInfo)
+
+
+def get_attachment_infos(model_name: str, id: UUID) -> list[AttachmentInfo]:
+    return execute_stmt(
+        f"""
+        SELECT {ATTACHMENT_INFO_COLS}
+        FROM internal.attachments
+        WHERE (model_name, id) = (%s, %s)
+        ORDER BY filename
+        """,
+        (model_name, id),
+        AttachmentInfo,
+        True,
+        read_only=True,
+    )
+
+
+def get_all_attachments_for_model(model_name: str) -> list[tuple] | None:
+    return execute_stmt(
+        f"""
+        SELECT id, attachments
+        FROM {model_name}
+        WHERE attachments != ARRAY[]
+        """,
+        is_list=True,
+        read_only=True,
+        model_name=model_name,
+    )
+
+
+def get_all_attachment_infos_for_model(model_name: str) -> list[tuple] | None:
+    return execute_stmt(
+        """
+        SELECT id, filename, created_at
+        FROM internal.attachments
+        WHERE model_name = %s
+        """,
+        (model_name,),
+        is_list=True,
+        read_only=True,
+    )
+
+
+def add_attachment(
+    model_name: str, id: UUID, s3_object_name: str
+) -> tuple | None:
+    def add_tx(cur) -> tuple | None:
+        rs = fetch_stmt(
+            cur,
+            f"""
+            UPDATE {model_name} SET
+                attachments = array_append(attachments, %s)
+            WHERE id = %s
+            RETURNING attachments
+            """,
+            (s3_object_name, id),
+        )
+
+        # the metadata is recorded when the upload is confirmed
+        if rs:
+            fetch_stmt(
+                cur,
+                """
+                INSERT INTO internal.attachments (model_name, id, filename)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (model_name, id, filename) DO NOTHING
+                """,
+                (model_name, id, s3_object_name),
+                returning_rs=False,
+            )
+
+        return rs
+
+    return run_transaction(add_tx, f"add_attachment {model_name}", model_name)
+
+
+def confirm_attachment(
+    model_name: str,
+    id: UUID,
+    s3_object_name: str,
+    size: int,
+    content_type: str | None,
+    etag: str | None,
+) -> AttachmentInfo | None:
+    def confirm_tx(cur) -> AttachmentInfo | None:
+        # make sure the attachment is listed only once
+        rs = fetch_stmt(
+            cur,
+            f"""
+            UPDATE {model_name} SET
+                attachments = CASE
+                    WHEN %s = ANY(attachments) THEN attachments
+                    ELSE array_append(attachments, %s)
+                END
+            WHERE id = %s
+            RETURNING id
+            """,
+            (s3_object_name, s3_object_name, id),
+        )
+
+        if not rs:
+            return None
+
+        return fetch_stmt(
+            cur,
+            f"""
+            INSERT INTO internal.attachments
+                (model_name, id, filename, size, content_type, etag, confirmed_at)
+            VALUES
+                (%s, %s, %s, %s, %s, %s, now())
+            ON CONFLICT (model_name, id, filename) DO UPDATE SET
+                size = excluded.size,
+                content_type = excluded.content_type,
+                etag = excluded.etag,
+                confirmed_at = excluded.confirmed_at
+            RETURNING {ATTACHMENT_INFO_COLS}
+            """,
+            (model_name, id, s3_object_name, size, content_type, etag),
+            AttachmentInfo,
+        )
+
+    return run_transaction(confirm_tx, f"confirm_attachment {model_name}", model_name)
+
+
+def remove_attachment(
+    model_name: str, id: UUID, s3_object_name: str
+) -> tuple | None:
+    def remove_tx(cur) -> tuple | None:
+        fetch_stmt(
+            cur,
+            """
+            DELETE FROM internal.attachments
+            WHERE (model_name, id, filename) = (%s, %s, %s)
+            """,
+            (model_name, id, s3_object_name),
+            returning_rs=False,
+        )
+
+        return fetch_stmt(
+            cur,
+            f"""
+            UPDATE {model_name} SET
+                attachments = array_remove(attachments, %s)
+            WHERE id = %s
+            RETURNING attachments
+            """,
+            (s3_object_name, id),
+        )
+
+    return run_transaction(remove_tx, f"remove_attachment {model_name}", model_name)
+
+
+# the parts are tracked by S3, not in the table
+UPLOAD_COLS = ", ".join([x for x in MultipartUpload.model_fields.keys() if x != "parts"])
+
+
+def create_upload(
+    upload_id: str, model_name: str, id: UUID, filename: str, username: str
+) -> MultipartUpload | None:
+    return execute_stmt(
+        f"""
+        INSERT INTO internal.uploads
+            (upload_id, model_name, id, filename, created_by)
+        VALUES
+            (%s, %s, %s, %s, %s)
+        RETURNING {UPLOAD_COLS}
+        """,
+        (upload_id, model_name, id, filename, username),
+        MultipartUpload,
+    )
+
+
+def get_upload(model_name: str, id: UUID, upload_id: str) -> MultipartUpload | None:
+    return execute_stmt(
+        f"""
+        SELECT {UPLOAD_COLS}
+        FROM internal.uploads
+        WHERE upload_id = %s AND (model_name, id) = (%s, %s)
+        """,
+        (upload_id, model_name, id),
+        MultipartUpload,
     )
 
 
-def remove_attachment(model_name: str, id: UUID, s3_object_name: str) -> list[str]:
+def set_upload_status(upload_id: str, status: str) -> MultipartUpload | None:
     return execute_stmt(
         f"""
-        UPDATE {model_name} SET
-            attachments = array_remove(attachments, %s)
+        UPDATE internal.uploads SET
+            status = %s
+        WHERE upload_id = %s
+        RETURNING {UPLOAD_COLS}
+        """,
+        (status, upload_id),
+        MultipartUpload,
+    )
+
+
+def get_stale_uploads(max_age_seconds: int, limit: int) -> list[MultipartUpload]:
+    # the uploads that were started, but neither completed nor aborted
+    return execute_stmt(
+        f"""
+        SELECT {UPLOAD_COLS}
+        FROM internal.uploads
+        WHERE status = 'in_progress'
+            AND updated_at < now() - %s::INTERVAL
+        ORDER BY updated_at
+        LIMIT %s
+        """,
+        (f"{max_age_seconds}s", limit),
+        MultipartUpload,
+        True,
+    )
+
+
+def queue_s3_purge(folder: str) -> None:
+    execute_stmt(
+        "INSERT INTO internal.s3_purge_queue (folder) VALUES (%s)",
+        (folder,),
+        returning_rs=False,
+    )
+
+
+############
+#  LEASES  #
+############
+# identifies this app instance as the holder of a lease
+LEASE_HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_lease(name: str, holder: str, lease_seconds: int) -> bool:
+    """
+    Claims the lease 'name' if it's free or expired, so that a background
+    task runs in only one of the app instances. The holder can renew it.
+    """
+    rs = execute_stmt(
+        """
+        INSERT INTO internal.leases (name, holder, lease_until)
+        VALUES (%s, %s, now() + %s::INTERVAL)
+        ON CONFLICT (name) DO UPDATE SET
+            holder = excluded.holder,
+            lease_until = excluded.lease_until
+        WHERE internal.leases.lease_until < now()
+            OR internal.leases.holder = excluded.holder
+        RETURNING name
+        """,
+        (name, holder, f"{lease_seconds}s"),
+    )
+
+    return rs is not None
+
+
+##################
+# S3 PURGE QUEUE #
+##################
+def claim_s3_purges(limit: int, lease_seconds: int) -> list[tuple]:
+    # leasing the rows lets several app instances drain the queue
+    return execute_stmt(
+        """
+        UPDATE internal.s3_purge_queue SET
+            next_attempt_at = now() + %s::INTERVAL
+        WHERE id IN (
+            SELECT id
+            FROM internal.s3_purge_queue
+            WHERE next_attempt_at <= now()
+            ORDER BY next_attempt_at
+            LIMIT %s
+        )
+        RETURNING id, folder, attempts
+        """,
+        (f"{lease_seconds}s", limit),
+        is_list=True,
+    )
+
+
+def complete_s3_purge(id: UUID) -> None:
+    execute_stmt(
+        "DELETE FROM internal.s3_purge_queue WHERE id = %s",
+        (id,),
+        returning_rs=False,
+    )
+
+
+def fail_s3_purge(id: UUID, error: str, retry_seconds: int) -> None:
+    execute_stmt(
+        """
+        UPDATE internal.s3_purge_queue SET
+            attempts = attempts + 1,
+            last_error = %s,
+            next_attempt_at = now() + %s::INTERVAL
         WHERE id = %s
-        RETURNING attachments
         """,
-        (s3_object_name, id),
+        (error, f"{retry_seconds}s", id),
+        returning_rs=False,
     )
 
 
+def get_s3_purge_lag() -> dict[str, Any]:
+    rs = execute_stmt(
+        """
+        SELECT
+            count(*),
+            COALESCE(EXTRACT(EPOCH FROM now() - min(created_at)), 0)::FLOAT8,
+            COALESCE(max(attempts), 0)
+        FROM internal.s3_purge_queue
+        """,
+        read_only=True,
+    )
+
+    if not rs:
+        return {}
+
+    return {"pending": rs[0], "lag_seconds": rs[1], "max_attempts": rs[2]}
+
+
 # ======================================================
 class DictJsonbDumper(JsonbDumper):
     def dump(self, obj):
         return super().dump(Jsonb(obj))
 
 
+@functools.lru_cache(maxsize=4096)
+def get_fingerprint(stmt: str) -> str:
+    """
+    Normalizes a statement so that calls of the same statement
+    are grouped together in the stats: literals become '_'
+    and lists of placeholders are collapsed.
+    """
+    fingerprint = " ".join(stmt.split())
+    fingerprint = re.sub(r"'(?:[^']|'')*'", "'_'", fingerprint)
+    fingerprint = re.sub(r"\b\d+(\.\d+)?\b", "_", fingerprint)
+    fingerprint = re.sub(r"%s(, %s)+", "%s, ...", fingerprint)
+    return fingerprint
+
+
+def get_stmt_id(fingerprint: str) -> str:
+    # a short, stable label for the statement in the metrics
+    return hashlib.sha1(fingerprint.encode()).hexdigest()[:12]
+
+
+def __get_stmt_stats(fingerprint: str, model_name: str) -> dict:
+    # must be called holding stmt_stats_lock
+    if fingerprint in stmt_stats:
+        stmt_stats.move_to_end(fingerprint)
+        return stmt_stats[fingerprint]
+
+    if len(stmt_stats) >= STMT_STATS_MAX_SIZE:
+        stmt_stats.popitem(last=False)
+
+    return stmt_stats.setdefault(
+        fingerprint,
+        {
+            "id": get_stmt_id(fingerprint),
+            "model": model_name,
+            "calls": 0,
+            "errors": 0,
+            "rows": 0,
+            "total_ms": 0.0,
+            "max_ms": 0.0,
+            **{f"{p}_ms": 0.0 for p in STMT_PHASES},
+            "retries": 0,
+            "retry_ms": 0.0,
+            "retry_failures": 0,
+        },
+    )
+
+
+def __record_stmt(
+    fingerprint: str, model_name: str, call_stats: dict, failed: bool
+) -> None:
+    total_ms = sum([call_stats.get(p, 0.0) for p in STMT_PHASES])
+
+    tracing.set_attributes(
+        {
+            "db.statement": fingerprint,
+            "db.model": model_name,
+            "db.rows": call_stats.get("rows", 0),
+            **{f"db.{p}_ms": call_stats.get(p, 0.0) for p in STMT_PHASES},
+        }
+    )
+    if failed:
+        tracing.set_error(fingerprint)
+
+    with stmt_stats_lock:
+        stats = __get_stmt_stats(fingerprint, model_name)
+        stats["calls"] += 1
+        stats["rows"] += call_stats.get("rows", 0)
+        stats["total_ms"] += total_ms
+        stats["max_ms"] = max(stats["max_ms"], total_ms)
+        for p in STMT_PHASES:
+            stats[f"{p}_ms"] += call_stats.get(p, 0.0)
+        if failed:
+            stats["errors"] += 1
+
+    if total_ms >= SLOW_QUERY_THRESHOLD_MS and random.random() < SLOW_QUERY_SAMPLE_RATE:
+        slow_query_logger.warning(
+            "slow query: %.1fms model=%s phases=%s stmt=%s",
+            total_ms,
+            model_name,
+            {p: round(call_stats.get(p, 0.0), 1) for p in STMT_PHASES},
+            fingerprint,
+        )
+
+
+def __get_pool(p: ConnectionPool) -> ConnectionPool:
+    # open the pool on first use, the first caller waits for a connection
+    if p.closed:
+        with pool_open_lock:
+            if p.closed:
+                p.open()
+    return p
+
+
+def __record_retries(fingerprint: str, retries: int, retry_ms: float, failed: bool):
+    with stmt_stats_lock:
+        stats = __get_stmt_stats(fingerprint, "")
+        stats["retries"] += retries
+        stats["retry_ms"] += retry_ms
+        if failed:
+            stats["retry_failures"] += 1
+
+
+def get_stmt_stats() -> dict[str, dict]:
+    with stmt_stats_lock:
+        return {k: dict(v) for k, v in stmt_stats.items()}
+
+
+def __lap(call_stats: dict | None, phase: str, start: float) -> float:
+    # adds the ms elapsed since 'start' to the phase, returns the current time
+    now = time.perf_counter()
+    if call_stats is not None:
+        call_stats[phase] = call_stats.get(phase, 0.0) + (now - start) * 1000
+    return now
+
+
+def __is_retryable(e: Exception) -> bool:
+    return isinstance(e, psycopg.Error) and e.sqlstate == SERIALIZATION_FAILURE
+
+
+def __get_retry_delay(attempt: int) -> float:
+    # exponential backoff with full jitter, in seconds
+    cap = min(DB_RETRY_MAX_DELAY_MS, DB_RETRY_BASE_DELAY_MS * 2**attempt)
+    return random.uniform(0, cap) / 1000
+
+
+def __register_dumpers(conn) -> None:
+    # convert a set to a psycopg list
+    conn.adapters.register_dumper(set, ListDumper)
+    conn.adapters.register_dumper(dict, DictJsonbDumper)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_row_mapping(returning_model: type, col_names: tuple[str, ...]) -> dict | None:
+    """
+    Precomputes how the columns of a ResultSet map to the fields
+    of an instance model:
+    - 'cols': (column index, field name, converter) for each field in the
+      ResultSet, the converter is only set for the types psycopg doesn't
+      return as the model expects (sets and floats),
+    - 'defaults': the fields not in the ResultSet.
+    Returns None if the rows must be validated.
+    """
+    if not DB_TRUSTED_HYDRATION or not issubclass(returning_model, BaseFields):
+        return None
+
+    cols = []
+    for i, k in enumerate(col_names):
+        fi = returning_model.model_fields.get(k)
+
+        # columns that are not in the model are dropped, as validation does
+        if not fi:
+            continue
+
+        cols.append((i, k, __get_converter(fi.annotation)))
+
+    defaults = [
+        (k, fi)
+        for k, fi in returning_model.model_fields.items()
+        if k not in col_names
+    ]
+
+    return {
+        "cols": cols,
+        "defaults": defaults,
+        "fields_set": {k for _, k, _ in cols},
+    }
+
+
+def __is_set(annotation) -> bool:
+    return get_origin(annotation) is set or any(
+        __is_set(x) for x in get_args(annotation)
+    )
+
+
+def __is_float(annotation) -> bool:
+    return annotation is float or float in get_args(annotation)
+
+
+def __get_converter(annotation) -> Callable | None:
+    # arrays are returned as lists
+    if __is_set(annotation):
+        return set
+    # DECIMAL columns are returned as Decimal, which is dumped as a string
+    if __is_float(annotation):
+        return float
+    return None
+
+
+def __hydrate(returning_model: type, col_names: list[str], rsl: list) -> list:
+    mapping = get_row_mapping(returning_model, tuple(col_names))
+
+    if mapping is None:
+        return [
+            returning_model(**{k: rs[i] for i, k in enumerate(col_names)})
+            for rs in rsl
+        ]
+
+    # same as returning_model.model_construct(), without its per-call overhead
+    l = []
+    for rs in rsl:
+        d = {
+            k: conv(rs[i]) if conv and rs[i] is not None else rs[i]
+            for i, k, conv in mapping["cols"]
+        }
+        for k, fi in mapping["defaults"]:
+            d[k] = fi.get_default(call_default_factory=True)
+
+        x = object.__new__(returning_model)
+        object.__setattr__(x, "__dict__", d)
+        object.__setattr__(x, "__pydantic_fields_set__", set(mapping["fields_set"]))
+        object.__setattr__(x, "__pydantic_extra__", None)
+        object.__setattr__(x, "__pydantic_private__", None)
+        l.append(x)
+
+    return l
+
+
+def fetch_stmt(
+    cur,
+    stmt: str,
+    bind_args: tuple = (),
+    returning_model: Type[BaseFields] = None,
+    is_list: bool = False,
+    returning_rs: bool = True,
+    call_stats: dict | None = None,
+) -> Type[BaseFields] | list[Type[BaseFields]] | list[tuple] | None:
+    """
+    Executes a statement on an open cursor and maps the ResultSet.
+    Errors are raised to the caller.
+    If passed, 'call_stats' collects the time spent in each phase.
+    """
+    t = time.perf_counter()
+    cur.execute(stmt, bind_args)  # type: ignore
+    t = __lap(call_stats, "execute", t)
+
+    if not returning_rs:
+        return
+
+    if not cur.description:
+        raise ValueError("Could not fetch column names from ResultSet")
+    col_names = [desc[0] for desc in cur.description]
+
+    if is_list:
+        rsl = cur.fetchall()
+        t = __lap(call_stats, "fetch", t)
+
+        if call_stats is not None:
+            call_stats["rows"] = len(rsl)
+
+        if returning_model:
+            l = __hydrate(returning_model, col_names, rsl)
+            __lap(call_stats, "hydrate", t)
+            return l
+        else:
+            return rsl
+    else:
+        rs = cur.fetchone()
+        t = __lap(call_stats, "fetch", t)
+
+        if rs:
+            if call_stats is not None:
+                call_stats["rows"] = 1
+
+            if returning_model:
+                x = __hydrate(returning_model, col_names, [rs])[0]
+                __lap(call_stats, "hydrate", t)
+                return x
+            else:
+                return rs
+        else:
+            return None
+
+
+@tracing.traced("db")
 def execute_stmt(
     stmt: str,
     bind_args: tuple = (),
     returning_model: Type[BaseFields] = None,
     is_list: bool = False,
     returning_rs: bool = True,
+    read_only: bool = False,
+    model_name: str = "",
 ) -> Type[BaseFields] | list[Type[BaseFields]] | list[tuple] | None:
-    with pool.connection() as conn:
-        # convert a set to a psycopg list
-        conn.adapters.register_dumper(set, ListDumper)
-        conn.adapters.register_dumper(dict, DictJsonbDumper)
+    """
+    'model_name' tags the stats of the statements on the table of a model.
+    """
+    fingerprint = get_fingerprint(stmt)
+    call_stats: dict = {}
+    attempt = 0
+    retry_start = 0.0
+
+    t = time.perf_counter()
+    with __get_pool(read_pool if read_only else pool).connection() as conn:
+        __lap(call_stats, "pool_wait", t)
+        __register_dumpers(conn)
+
+        while True:
+            with conn.cursor() as cur:
+                try:
+                    rs = fetch_stmt(
+                        cur,
+                        stmt,
+                        bind_args,
+                        returning_model,
+                        is_list,
+                        returning_rs,
+                        call_stats,
+                    )
+
+                    __record_stmt(fingerprint, model_name, call_stats, False)
+                    if attempt:
+                        __record_retries(
+                            fingerprint,
+                            attempt,
+                            (time.perf_counter() - retry_start) * 1000,
+                            False,
+                        )
+                    return rs
+
+                except Exception as e:
+                    # statements run in autocommit mode, so
+                    # a retry is just executing the statement again
+                    if __is_retryable(e) and attempt < DB_MAX_RETRIES:
+                        if not attempt:
+                            retry_start = time.perf_counter()
+                        time.sleep(__get_retry_delay(attempt))
+                        attempt += 1
+                        continue
+
+                    __record_stmt(fingerprint, model_name, call_stats, True)
+                    if attempt:
+                        __record_retries(
+                            fingerprint,
+                            attempt,
+                            (time.perf_counter() - retry_start) * 1000,
+                            True,
+                        )
+
+                    # the caller, or the app's handlers, map the error
+                    # to a response, e.g. 503 after too many retries
+                    logger.error("%s: %s", fingerprint, e)
+                    raise
+
+
+@tracing.traced("db")
+def run_transaction(
+    fn: Callable[[psycopg.Cursor], Any], name: str, model_name: str = ""
+) -> Any:
+    """
+    Runs fn(cur) in an explicit transaction using the 'cockroach_restart'
+    savepoint protocol: on a serialization failure the transaction is
+    rolled back to the savepoint and fn is executed again.
+    Any other error, or too many retries, is raised to the caller.
+    'name' is used to group the stats, 'model_name' tags them.
+    """
+    call_stats: dict = {}
+    attempt = 0
+    retry_start = 0.0
+
+    t = time.perf_counter()
+    with __get_pool(pool).connection() as conn:
+        t = __lap(call_stats, "pool_wait", t)
+        __register_dumpers(conn)
 
         with conn.cursor() as cur:
             try:
-                cur.execute(stmt, bind_args)  # type: ignore
-
-                if not returning_rs:
-                    return
+                cur.execute("BEGIN")
+                cur.execute("SAVEPOINT cockroach_restart")
+
+                while True:
+                    try:
+                        rs = fn(cur)
+                        cur.execute("RELEASE SAVEPOINT cockroach_restart")
+                        cur.execute("COMMIT")
+
+                        __lap(call_stats, "execute", t)
+                        __record_stmt(name, model_name, call_stats, False)
+                        if attempt:
+                            __record_retries(
+                                name,
+                                attempt,
+                                (time.perf_counter() - retry_start) * 1000,
+                                False,
+                            )
+                        return rs
 
-                if not cur.description:
-                    raise ValueError("Could not fetch column names from ResultSet")
-                col_names = [desc[0] for desc in cur.description]
+                    except Exception as e:
+                        if not __is_retryable(e) or attempt >= DB_MAX_RETRIES:
+                            raise
 
-                if is_list:
-                    rsl = cur.fetchall()
+                        cur.execute("ROLLBACK TO SAVEPOINT cockroach_restart")
+                        if not attempt:
+                            retry_start = time.perf_counter()
+                        time.sleep(__get_retry_delay(attempt))
+                        attempt += 1
 
-                    if returning_model:
-                        return [
-                            returning_model(
-                                **{k: rs[i] for i, k in enumerate(col_names)}
-                            )
-                            for rs in rsl
-                        ]
-                    else:
-                        return rsl
-                else:
-                    rs = cur.fetchone()
-                    if rs:
-                        if returning_model:
-                            return returning_model(
-                                **{k: rs[i] for i, k in enumerate(col_names)}
-                            )
-                        else:
-                            return rs
-                    else:
-                        return None
             except Exception as e:
-                # TODO correctly handle error such as PK violations
-                print(e)
-                return None
+                __lap(call_stats, "execute", t)
+                __record_stmt(name, model_name, call_stats, True)
+                if attempt:
+                    __record_retries(
+                        name, attempt, (time.perf_counter() - retry_start) * 1000, True
+                    )
+
+                if not conn.closed:
+                    cur.execute("ROLLBACK")
+
+                logger.error("%s: %s", name, e)
+                raise
 
 
 ###########
 #   SQL   #
 ###########
+@tracing.traced("db")
 def execute_sql(
     user_type: str,
     stmt: str,
     bind_params: tuple,
+    name: str | None = None,
 ) -> dict[str, Any] | None:
+    """
+    Executes a statement of the SQL endpoints or of a report.
+    The stats are grouped by 'name', the ad-hoc statements
+    without one are all grouped together.
+    """
+    call_stats: dict = {}
+    failed = False
+
+    t = time.perf_counter()
     if user_type == "dml":
-        conn = dml_pool.getconn()
+        conn = __get_pool(dml_pool).getconn()
     else:
-        conn = select_pool.getconn()
+        conn = __get_pool(select_pool).getconn()
+    t = __lap(call_stats, "pool_wait", t)
 
     conn.adapters.register_dumper(set, ListDumper)
     conn.adapters.register_dumper(dict, DictJsonbDumper)
@@ -770,6 +2504,7 @@ def execute_sql(
     with conn.cursor() as cur:
         try:
             cur.execute(stmt, bind_params)  # type: ignore
+            t = __lap(call_stats, "execute", t)
 
             if not cur.description:
                 return {"status": cur.statusmessage, "cols": [], "rows": []}
@@ -777,14 +2512,21 @@ def execute_sql(
             col_names = [desc[0] for desc in cur.description]
 
             rsl = cur.fetchall()
+            __lap(call_stats, "fetch", t)
+            call_stats["rows"] = len(rsl)
 
             return {"status": cur.statusmessage, "cols": col_names, "rows": rsl}
 
         except Exception as e:
+            failed = True
             # TODO correctly handle error such as PK violations
             return {"status": str(e), "cols": [], "rows": []}
 
         finally:
+            __record_stmt(
+                name or f"ad-hoc {user_type}", f"sql_{user_type}", call_stats, failed
+            )
+
             if user_type == "dml":
                 dml_pool.putconn(conn)
             else:
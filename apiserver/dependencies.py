@@ -1,9 +1,12 @@
 from apiserver import db
 from fastapi import Depends, HTTPException, status, BackgroundTasks, APIRouter
+from fastapi import Header, Query
 from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 import jwt
 from jwt.algorithms import RSAAlgorithm
+from minio.datatypes import Part
 from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
 from passlib.context import CryptContext
 from typing import Annotated
 import datetime as dt
@@ -12,6 +15,9 @@ import minio
 import os
 import validators
 from apiserver.models import User
+import apiserver.models as mdl
+import apiserver.metrics as metrics
+import apiserver.tracing as tracing
 
 
 JWKS = os.getenv("JWKS")
@@ -42,13 +48,36 @@ S3_USE_SECURE_TLS = (
     else False
 )
 S3_BUCKET = os.getenv("S3_BUCKET")
+# setting the region saves the bucket location lookup before presigning
+S3_REGION = os.getenv("S3_REGION")
 S3_PRESIGNED_URL_EXPIRY_SECONDS = int(os.getenv("S3_PRESIGNED_URL_EXPIRY_SECONDS", 5))
+# part URLs of multipart uploads are valid for longer, as parts can be large
+S3_MULTIPART_URL_EXPIRY_SECONDS = int(
+    os.getenv("S3_MULTIPART_URL_EXPIRY_SECONDS", 3600)
+)
+# S3 allows part numbers from 1 to 10000
+S3_MULTIPART_MAX_PARTS = 10000
+# multipart uploads not completed within this time are aborted,
+# so that S3 frees the storage of their parts
+S3_MULTIPART_MAX_AGE_SECONDS = int(os.getenv("S3_MULTIPART_MAX_AGE_SECONDS", 86400))
+S3_MULTIPART_SWEEP_BATCH_SIZE = int(os.getenv("S3_MULTIPART_SWEEP_BATCH_SIZE", 100))
+# S3 multi-object delete accepts up to 1000 keys per request
+S3_DELETE_BATCH_SIZE = 1000
+S3_PURGE_INTERVAL_SECONDS = int(os.getenv("S3_PURGE_INTERVAL_SECONDS", 5))
+S3_PURGE_BATCH_SIZE = int(os.getenv("S3_PURGE_BATCH_SIZE", 10))
+S3_PURGE_LEASE_SECONDS = int(os.getenv("S3_PURGE_LEASE_SECONDS", 300))
+S3_PURGE_MAX_RETRY_SECONDS = int(os.getenv("S3_PURGE_MAX_RETRY_SECONDS", 3600))
+S3_RECONCILE_INTERVAL_SECONDS = int(os.getenv("S3_RECONCILE_INTERVAL_SECONDS", 3600))
+# attachments not found in S3 are only removed once older than this,
+# so that uploads in progress are not affected
+S3_RECONCILE_GRACE_SECONDS = int(os.getenv("S3_RECONCILE_GRACE_SECONDS", 3600))
 
 minio_client = minio.Minio(
     endpoint=S3_ENDPOINT_URL,
     secure=S3_USE_SECURE_TLS,
     access_key=S3_ACCESS_KEY,
     secret_key=S3_SECRET_KEY,
+    region=S3_REGION,
 )
 
 
@@ -59,6 +88,8 @@ def get_api_router(name: str) -> APIRouter:
     )
 
 
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
 def get_presigned_get_url(filename: str) -> str:
     data = minio_client.presigned_get_object(
         S3_BUCKET,
@@ -72,6 +103,22 @@ def get_presigned_get_url(filename: str) -> str:
         raise ValueError(f"Could not generate presigned-get-url for {filename}")
 
 
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
+def get_presigned_get_urls(folder: str, filenames: list[str]) -> dict[str, str]:
+    # presigning is a local computation, no round trip to S3
+    expires = dt.timedelta(seconds=S3_PRESIGNED_URL_EXPIRY_SECONDS)
+
+    return {
+        f: minio_client.presigned_get_object(
+            S3_BUCKET, "/".join([folder, f]), expires=expires
+        )
+        for f in filenames
+    }
+
+
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
 def get_presigned_put_url(filename: str):
     data = minio_client.presigned_put_object(
         S3_BUCKET,
@@ -85,10 +132,99 @@ def get_presigned_put_url(filename: str):
         raise ValueError(f"Could not generate presigned-put-url for {filename}")
 
 
+# minio has no public API for multipart uploads driven by the client,
+# so the private methods of Minio are used: minio is pinned to an exact
+# version in pyproject.toml, check these calls before upgrading it.
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
+def s3_create_multipart_upload(filename: str) -> str:
+    return minio_client._create_multipart_upload(S3_BUCKET, filename, {})
+
+
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
+def get_presigned_part_urls(
+    filename: str, upload_id: str, part_numbers: range
+) -> dict[int, str]:
+    expires = dt.timedelta(seconds=S3_MULTIPART_URL_EXPIRY_SECONDS)
+
+    return {
+        n: minio_client.get_presigned_url(
+            "PUT",
+            S3_BUCKET,
+            filename,
+            expires=expires,
+            extra_query_params={"uploadId": upload_id, "partNumber": str(n)},
+        )
+        for n in part_numbers
+    }
+
+
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
+def s3_list_parts(filename: str, upload_id: str) -> list[dict]:
+    parts: list[dict] = []
+    marker = None
+
+    while True:
+        rs = minio_client._list_parts(
+            S3_BUCKET, filename, upload_id, part_number_marker=marker
+        )
+        parts.extend(
+            {"part_number": x.part_number, "etag": x.etag, "size": x.size}
+            for x in rs.parts
+        )
+
+        if not rs.is_truncated:
+            return parts
+
+        marker = rs.next_part_number_marker
+
+
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
+def s3_complete_multipart_upload(filename: str, upload_id: str, parts: list[dict]):
+    minio_client._complete_multipart_upload(
+        S3_BUCKET,
+        filename,
+        upload_id,
+        [Part(x["part_number"], x["etag"]) for x in parts],
+    )
+
+
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
+def s3_abort_multipart_upload(filename: str, upload_id: str):
+    try:
+        minio_client._abort_multipart_upload(S3_BUCKET, filename, upload_id)
+    except S3Error as e:
+        # already completed or aborted
+        if e.code != "NoSuchUpload":
+            raise
+
+
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
 def s3_remove_object(filename: str):
     minio_client.remove_object(S3_BUCKET, filename)
 
 
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
+def s3_stat_object(filename: str) -> dict | None:
+    # None if the object doesn't exist, e.g. the upload didn't happen
+    try:
+        x = minio_client.stat_object(S3_BUCKET, filename)
+    except S3Error as e:
+        if e.code == "NoSuchKey":
+            return None
+        raise
+
+    return {"size": x.size, "content_type": x.content_type, "etag": x.etag}
+
+
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
 def s3_list_all_objects(folder: str) -> list[str]:
     return [
         x.object_name
@@ -96,15 +232,98 @@ def s3_list_all_objects(folder: str) -> list[str]:
     ]
 
 
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
+def s3_list_all_object_stats(folder: str) -> list[dict]:
+    return [
+        {"object_name": x.object_name, "size": x.size, "etag": x.etag}
+        for x in minio_client.list_objects(S3_BUCKET, folder, recursive=True)
+    ]
+
+
+def __s3_remove_objects(delete_object_list: list[DeleteObject]):
+    errors = [
+        f"{e.name}: {e.message}"
+        for e in minio_client.remove_objects(S3_BUCKET, delete_object_list)
+    ]
+
+    if errors:
+        raise RuntimeError(f"Could not delete {len(errors)} objects: {errors[:5]}")
+
+
+@metrics.observe_dependency("minio")
+@tracing.traced("minio")
 def s3_delete_all_objects(folder: str):
-    delete_object_list = map(
-        lambda x: DeleteObject(x.object_name),
-        minio_client.list_objects(S3_BUCKET, folder, recursive=True),
-    )
+    delete_object_list: list[DeleteObject] = []
+
+    for x in minio_client.list_objects(S3_BUCKET, folder, recursive=True):
+        delete_object_list.append(DeleteObject(x.object_name))
+
+        if len(delete_object_list) == S3_DELETE_BATCH_SIZE:
+            __s3_remove_objects(delete_object_list)
+            delete_object_list = []
+
+    if delete_object_list:
+        __s3_remove_objects(delete_object_list)
+
+
+async def get_staleness(
+    staleness: Annotated[str | None, Query()] = None,
+    x_worst_staleness: Annotated[str | None, Header()] = None,
+) -> str | None:
+    # the query param takes precedence over the header
+    s = staleness or x_worst_staleness
+
+    if s and not db.is_valid_staleness(s):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Invalid staleness '{s}'. Use 'strong', 'follower' or an interval like '10s'",
+        )
+
+    return s
+
+
+async def check_model_name(model_name: str) -> str:
+    # the name goes into SQL statements and S3 object names
+    if model_name not in mdl.pyd_models:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Model {model_name} not found",
+        )
 
-    errors = minio_client.remove_objects(S3_BUCKET, delete_object_list)
-    for _ in errors:
-        pass
+    return model_name
+
+
+async def get_fields(
+    fields: Annotated[
+        str | None,
+        Query(description="Comma separated fields to return, besides `id`"),
+    ] = None,
+) -> list[str] | None:
+    # the names are checked against the model by the service
+    if not fields:
+        return None
+
+    return [x.strip() for x in fields.split(",") if x.strip()] or None
+
+
+async def get_tag_filter(
+    tags: Annotated[
+        str | None,
+        Query(description="Comma separated tags the instances must all have"),
+    ] = None,
+    tags_any: Annotated[
+        str | None,
+        Query(description="Comma separated tags the instances must have any of"),
+    ] = None,
+) -> dict[str, list[str]] | None:
+    f = {}
+    for k, v in [("tags", tags), ("tags_any", tags_any)]:
+        l = [x.strip() for x in v.split(",") if x.strip()] if v else []
+        if l:
+            f[k] = l
+
+    return f or None
 
 
 def decode_token(token: str):
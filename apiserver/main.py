@@ -1,21 +1,41 @@
 from apiserver import db
-from apiserver.routers import sql, search, reports, models, attachments
+from apiserver.routers import (
+    sql,
+    search,
+    reports,
+    models,
+    attachments,
+    admin,
+    events,
+    stream,
+)
 from apiserver.worstrouter import WorstRouter
 from apiserver.models import (
-    pyd_models,
+    fetch_schema_snapshot,
+    save_schema_snapshot,
+    schema_epoch,
     Token,
+    update_pyd_models,
     User,
 )
-from fastapi import FastAPI, Depends, HTTPException, Query, status, APIRouter
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Security, status, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
 from typing import Annotated
+import apiserver.broker as broker
 import apiserver.dependencies as dep
+import apiserver.metrics as metrics
+import apiserver.models as mdl
+import apiserver.tracing as tracing
 import apiserver.service as svc
+from opentelemetry.propagate import extract
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import hashlib
+import logging
 import os
+import psycopg
 import requests
 import threading
 import time
@@ -39,6 +59,8 @@ JWT_KEY = os.getenv("JWT_KEY")
 JWT_KEY_ALGORITHM = os.getenv("JWT_KEY_ALGORITHM")
 JWT_EXPIRY_SECONDS = int(os.getenv("JWT_EXPIRY_SECONDS", 1800))
 
+logger = logging.getLogger(__name__)
+
 
 app = FastAPI(
     title="Worst API",
@@ -61,6 +83,87 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+
+    # continue the trace of the caller, if any
+    with tracing.tracer.start_as_current_span(
+        f"{request.method} {request.url.path}",
+        context=extract(request.headers),
+    ) as span:
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            # label by route template, not by path, to keep cardinality low
+            route = request.scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            tags = getattr(route, "tags", None)
+            model = tags[0] if tags and tags[0] in mdl.pyd_models else ""
+
+            metrics.observe_request(
+                request.method, path, model, status_code, time.perf_counter() - start
+            )
+
+            span.update_name(f"{request.method} {path}")
+            span.set_attributes(
+                {
+                    "http.method": request.method,
+                    "http.route": path,
+                    "http.status_code": status_code,
+                    "worst.model": model,
+                }
+            )
+
+
+# the database errors the client can act on, the others are a 500.
+# Conflicts that still fail after the retries of the db layer are a 503,
+# so that the client retries later instead of getting a null or a 404
+@app.exception_handler(psycopg.Error)
+async def handle_db_error(request: Request, e: psycopg.Error) -> Response:
+    if e.sqlstate == db.SERIALIZATION_FAILURE:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"detail": "Too much contention, retry later"},
+            headers={"Retry-After": "1"},
+        )
+
+    if isinstance(e, (psycopg.errors.UniqueViolation, psycopg.errors.DuplicateTable)):
+        return JSONResponse(
+            status_code=status.HTTP_409_CONFLICT,
+            content={"detail": e.diag.message_primary or str(e)},
+        )
+
+    if isinstance(e, psycopg.IntegrityError):
+        return JSONResponse(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            content={"detail": e.diag.message_primary or str(e)},
+        )
+
+    raise e
+
+
+metrics.register_collector(
+    metrics.StatsCollector(
+        db.get_pool_stats, db.get_stmt_stats, svc.get_s3_purge_lag
+    )
+)
+
+
+# the metrics name the models, routes and statements of the app,
+# so scrapers authenticate like any other client
+@app.get(
+    "/metrics",
+    include_in_schema=False,
+    dependencies=[Security(dep.get_current_user, scopes=["worst_metrics_read"])],
+)
+async def get_metrics() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get(
     "/healthcheck",
 )
@@ -82,16 +185,63 @@ async def get_authorization_config() -> dict:
     }
 
 
-# add routers dynamically
-for k, v in pyd_models.items():
-    app.include_router(
+# routes of each model, so that they can be replaced on reload
+model_routes: dict[str, list] = {}
+# the other routes, before and after the ones of the models
+head_routes: list = list(app.router.routes)
+tail_routes: list = []
+
+
+def get_model_routes(model_name: str) -> list:
+    v = mdl.pyd_models[model_name]
+
+    # same as app.include_router(), but on a detached router
+    router = APIRouter(dependency_overrides_provider=app)
+    router.include_router(
         WorstRouter(
-            instance_type=k,
+            instance_type=model_name,
             default_model=v["default"],
             overview_model=v["overview"],
             update_model=v["update"],
+            patch_model=v["patch"],
         )
     )
+    return router.routes
+
+
+def get_routes() -> list:
+    # always in the same order, so that which route matches
+    # a path doesn't depend on the history of the reloads
+    return [
+        *head_routes,
+        *[r for k in sorted(model_routes.keys()) for r in model_routes[k]],
+        *tail_routes,
+    ]
+
+
+def reload_models(new_skemas: dict) -> None:
+    """
+    Recompiles the models whose skema changed and swaps their routes,
+    leaving the routes of the other models untouched.
+    """
+    changed, removed = update_pyd_models(new_skemas)
+
+    if not changed and not removed:
+        return
+
+    for k in removed:
+        model_routes.pop(k, None)
+    for k in changed:
+        model_routes[k] = get_model_routes(k)
+
+    # requests in flight keep using the old list
+    app.router.routes = get_routes()
+    app.openapi_schema = None
+
+
+# add routers dynamically
+for k in mdl.pyd_models.keys():
+    model_routes[k] = get_model_routes(k)
 
 
 app.include_router(attachments.router)
@@ -99,28 +249,155 @@ app.include_router(sql.router)
 app.include_router(search.router)
 app.include_router(reports.router)
 app.include_router(models.router)
+app.include_router(admin.router)
+app.include_router(events.router)
+app.include_router(stream.router)
+
+tail_routes = app.router.routes[len(head_routes) :]
+app.router.routes = get_routes()
 
 
-# uvicorn server is started and configured to reload
-# if file 'watch.txt' changes.
-# Thus, whenever the app wants to instruct uvicorn to reboot itself,
-# it just has to touch that file.
-# To make sure that every instance of the app reboots,
+# Whenever a model is created, updated or deleted,
 # the app updates a db entry that is periodically fetched by
 # every instance. If the value is different than the initial value,
-# the app touches file watch.txt which will cause uvicorn to reload the app.
+# the app reloads the models that changed, in place.
+# If that fails, it falls back to touching file watch.txt:
+# uvicorn is configured to reload the app if that file changes.
 
-# store initial value at startup
-watch_epoch = db.get_watch()
+# the epoch of the schema snapshot the app was started with
+watch_epoch = schema_epoch
 
 
 def watch_it(watch_epoch: int):
+    # first validate the snapshot loaded at startup against the db,
+    # then only refetch the model defs when the epoch moves on
+    validated = False
+
     while True:
-        if db.get_watch() > watch_epoch:
-            Path("watch.txt").touch()
+        try:
+            if not validated or db.get_watch() > watch_epoch:
+                snapshot = fetch_schema_snapshot()
+
+                if snapshot["epoch"] != watch_epoch or snapshot["skemas"] != mdl.skemas:
+                    save_schema_snapshot(snapshot)
+
+                if snapshot["skemas"] != mdl.skemas:
+                    try:
+                        reload_models(snapshot["skemas"])
+                    except Exception:
+                        logger.exception("reloading the models failed, restarting")
+                        Path("watch.txt").touch()
+
+                watch_epoch = snapshot["epoch"]
+                validated = True
+        except Exception:
+            logger.exception("checking the schema snapshot failed")
 
         time.sleep(15)
 
 
 # periodically check if a restart is needed
 threading.Thread(target=watch_it, args=(watch_epoch,), daemon=True).start()
+
+
+def purge_it():
+    while True:
+        # keep draining while there are queued purges
+        try:
+            svc.refresh_s3_purge_lag()
+
+            if svc.process_s3_purge_queue():
+                continue
+        except Exception:
+            logger.exception("processing the S3 purge queue failed")
+
+        time.sleep(dep.S3_PURGE_INTERVAL_SECONDS)
+
+
+# purge the attachments of deleted instances in the background
+threading.Thread(target=purge_it, daemon=True).start()
+
+
+def migrate_it():
+    while True:
+        # keep going while there are pending schema changes
+        try:
+            if svc.process_schema_jobs():
+                continue
+        except Exception:
+            logger.exception("processing the schema jobs failed")
+
+        time.sleep(db.SCHEMA_JOB_INTERVAL_SECONDS)
+
+
+# apply the schema changes of the models in the background
+threading.Thread(target=migrate_it, daemon=True).start()
+
+
+def reconcile_it():
+    while True:
+        time.sleep(dep.S3_RECONCILE_INTERVAL_SECONDS)
+
+        for model_name in list(mdl.pyd_models.keys()):
+            # each model is reconciled by one app instance per interval
+            if not db.claim_lease(
+                f"reconcile {model_name}",
+                db.LEASE_HOLDER,
+                dep.S3_RECONCILE_INTERVAL_SECONDS,
+            ):
+                continue
+
+            try:
+                svc.reconcile_attachments(model_name)
+            except Exception:
+                logger.exception("reconciling the attachments of %s failed", model_name)
+
+        if db.claim_lease(
+            "abort_stale_uploads", db.LEASE_HOLDER, dep.S3_RECONCILE_INTERVAL_SECONDS
+        ):
+            try:
+                # keep going while full batches are aborted
+                while (
+                    svc.abort_stale_uploads() == dep.S3_MULTIPART_SWEEP_BATCH_SIZE
+                ):
+                    pass
+            except Exception:
+                logger.exception("aborting the stale uploads failed")
+
+
+# periodically repair drift between S3 and the attachments columns,
+# and abort the abandoned multipart uploads
+threading.Thread(target=reconcile_it, daemon=True).start()
+
+
+def stream_it():
+    cursor = None
+
+    while True:
+        model_names = sorted(mdl.pyd_models.keys())
+
+        # a changefeed needs a table: wait for the first model to be loaded
+        if not model_names:
+            time.sleep(5)
+            continue
+
+        try:
+            for model_name, before, after in db.get_changes(model_names, cursor):
+                if model_name:
+                    # also writes of the other processes
+                    svc.bump_write_version(model_name)
+                    broker.publish_row(model_name, before, after)
+                    continue
+
+                cursor = before
+                # restart the changefeed on the new set of tables
+                if sorted(mdl.pyd_models.keys()) != model_names:
+                    break
+        except Exception:
+            logger.exception("the changefeed of %s failed", ", ".join(model_names))
+            time.sleep(5)
+
+
+# fan out the changes of all processes to the subscribers of the change stream
+if broker.STREAM_SOURCE == "changefeed":
+    threading.Thread(target=stream_it, daemon=True).start()
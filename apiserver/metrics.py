@@ -0,0 +1,239 @@
+from fastapi import BackgroundTasks
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from typing import Any, Callable
+import apiserver.tracing as tracing
+import functools
+import time
+
+REQUEST_LATENCY = Histogram(
+    "worst_request_duration_seconds",
+    "Latency of the HTTP requests",
+    ["method", "route", "model", "status"],
+)
+
+BACKGROUND_TASKS_QUEUED = Gauge(
+    "worst_background_tasks_queued",
+    "Background tasks waiting to be executed",
+    ["task"],
+)
+BACKGROUND_TASK_WAIT = Histogram(
+    "worst_background_task_wait_seconds",
+    "Time between queueing and executing a background task",
+    ["task"],
+)
+BACKGROUND_TASK_LATENCY = Histogram(
+    "worst_background_task_duration_seconds",
+    "Latency of the background tasks",
+    ["task"],
+)
+BACKGROUND_TASK_ERRORS = Counter(
+    "worst_background_task_errors_total",
+    "Failed background tasks",
+    ["task"],
+)
+
+DEPENDENCY_LATENCY = Histogram(
+    "worst_dependency_duration_seconds",
+    "Latency of the calls to external services",
+    ["dependency", "operation"],
+)
+DEPENDENCY_ERRORS = Counter(
+    "worst_dependency_errors_total",
+    "Failed calls to external services",
+    ["dependency", "operation"],
+)
+
+STREAM_SUBSCRIBERS = Gauge(
+    "worst_stream_subscribers",
+    "Open subscriptions to the change stream",
+)
+STREAM_MESSAGES = Counter(
+    "worst_stream_messages_total",
+    "Changes delivered to the subscribers of the change stream",
+    ["model"],
+)
+STREAM_RESETS = Counter(
+    "worst_stream_resets_total",
+    "Buffers of slow subscribers dropped",
+)
+
+
+def observe_request(
+    method: str, route: str, model: str, status: int, duration: float
+) -> None:
+    REQUEST_LATENCY.labels(method, route, model, status).observe(duration)
+
+
+def observe_dependency(dependency: str):
+    """
+    Decorator recording latency and errors of the calls to an external service.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                DEPENDENCY_ERRORS.labels(dependency, fn.__name__).inc()
+                raise
+            finally:
+                DEPENDENCY_LATENCY.labels(dependency, fn.__name__).observe(
+                    time.perf_counter() - start
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def __run_task(name: str, queued_at: float, fn: Callable, *args, **kwargs) -> None:
+    BACKGROUND_TASKS_QUEUED.labels(name).dec()
+    start = time.perf_counter()
+    BACKGROUND_TASK_WAIT.labels(name).observe(start - queued_at)
+
+    try:
+        fn(*args, **kwargs)
+    except Exception:
+        BACKGROUND_TASK_ERRORS.labels(name).inc()
+        raise
+    finally:
+        BACKGROUND_TASK_LATENCY.labels(name).observe(time.perf_counter() - start)
+
+
+def add_task(bg_task: BackgroundTasks, fn: Callable, *args, **kwargs) -> None:
+    """
+    Same as bg_task.add_task(), but tracks queue depth, wait time,
+    latency and errors of the task, and traces it in a span
+    linked to the request.
+    """
+    BACKGROUND_TASKS_QUEUED.labels(fn.__name__).inc()
+    bg_task.add_task(
+        __run_task,
+        fn.__name__,
+        time.perf_counter(),
+        tracing.linked(fn, f"background.{fn.__name__}"),
+        *args,
+        **kwargs,
+    )
+
+
+class StatsCollector:
+    """
+    Exposes the stats that are kept by the app itself,
+    collected on every scrape.
+    """
+
+    def __init__(
+        self,
+        get_pool_stats: Callable[[], dict[str, dict]],
+        get_stmt_stats: Callable[[], dict[str, dict]],
+        get_s3_purge_lag: Callable[[], dict[str, Any] | None],
+    ) -> None:
+        self.get_pool_stats = get_pool_stats
+        self.get_stmt_stats = get_stmt_stats
+        self.get_s3_purge_lag = get_s3_purge_lag
+
+    def describe(self):
+        # don't query the stats at registration time
+        return []
+
+    def collect(self):
+        pool_size = GaugeMetricFamily(
+            "worst_pool_size", "Connections in the pool", labels=["pool"]
+        )
+        pool_in_use = GaugeMetricFamily(
+            "worst_pool_in_use", "Connections in use", labels=["pool"]
+        )
+        pool_max = GaugeMetricFamily(
+            "worst_pool_max_size", "Max connections of the pool", labels=["pool"]
+        )
+        pool_waiting = GaugeMetricFamily(
+            "worst_pool_requests_waiting",
+            "Requests waiting for a connection",
+            labels=["pool"],
+        )
+        pool_wait = CounterMetricFamily(
+            "worst_pool_requests_wait_seconds",
+            "Total time spent waiting for a connection",
+            labels=["pool"],
+        )
+        pool_requests = CounterMetricFamily(
+            "worst_pool_requests",
+            "Connection requests to the pool",
+            labels=["pool"],
+        )
+
+        for name, stats in self.get_pool_stats().items():
+            size = stats.get("pool_size", 0)
+            pool_size.add_metric([name], size)
+            pool_in_use.add_metric([name], size - stats.get("pool_available", 0))
+            pool_max.add_metric([name], stats.get("pool_max", 0))
+            pool_waiting.add_metric([name], stats.get("requests_waiting", 0))
+            pool_wait.add_metric([name], stats.get("requests_wait_ms", 0) / 1000)
+            pool_requests.add_metric([name], stats.get("requests_num", 0))
+
+        yield from [
+            pool_size,
+            pool_in_use,
+            pool_max,
+            pool_waiting,
+            pool_wait,
+            pool_requests,
+        ]
+
+        calls = CounterMetricFamily(
+            "worst_stmt_calls", "Calls of statements", labels=["stmt_id", "model"]
+        )
+        errors = CounterMetricFamily(
+            "worst_stmt_errors", "Failed calls of statements", labels=["stmt_id", "model"]
+        )
+        duration = CounterMetricFamily(
+            "worst_stmt_seconds",
+            "Total time spent in statements, by phase",
+            labels=["stmt_id", "model", "phase"],
+        )
+        retries = CounterMetricFamily(
+            "worst_stmt_retries",
+            "Retries of statements after serialization failures",
+            labels=["stmt_id"],
+        )
+        retry_wait = CounterMetricFamily(
+            "worst_stmt_retry_seconds",
+            "Time spent retrying statements",
+            labels=["stmt_id"],
+        )
+        # labelled by a hash of the statement, the text is
+        # listed with the same id by GET /admin/statements
+        for stats in self.get_stmt_stats().values():
+            stmt = stats["id"]
+            model = stats.get("model", "")
+            calls.add_metric([stmt, model], stats.get("calls", 0))
+            errors.add_metric([stmt, model], stats.get("errors", 0))
+            for phase in ["pool_wait", "execute", "fetch", "hydrate"]:
+                duration.add_metric(
+                    [stmt, model, phase], stats.get(f"{phase}_ms", 0) / 1000
+                )
+            retries.add_metric([stmt], stats.get("retries", 0))
+            retry_wait.add_metric([stmt], stats.get("retry_ms", 0) / 1000)
+
+        yield from [calls, errors, duration, retries, retry_wait]
+
+        lag = self.get_s3_purge_lag()
+        if lag:
+            yield GaugeMetricFamily(
+                "worst_s3_purge_pending",
+                "S3 folders waiting to be purged",
+                value=lag["pending"],
+            )
+            yield GaugeMetricFamily(
+                "worst_s3_purge_lag_seconds",
+                "Age of the oldest S3 folder waiting to be purged",
+                value=lag["lag_seconds"],
+            )
+
+
+def register_collector(collector: StatsCollector) -> None:
+    REGISTRY.register(collector)
@@ -1,8 +1,11 @@
 from typing import Any
-from pydantic import create_model, BaseModel, EmailStr, Field
+from pydantic import create_model, BaseModel, ConfigDict, EmailStr, Field
 from pydantic.fields import FieldInfo
 from uuid import UUID
+import copy
 import datetime as dt
+import hashlib
+import json
 import os
 import psycopg
 
@@ -61,14 +64,80 @@ def extend_model(name: str, base: type, dict_def: dict):
     return create_model(name, __base__=base, **fields)
 
 
-# get all model defs from database
-with psycopg.connect(DB_URL, autocommit=True) as conn:
-    with conn.cursor() as cur:
-        rs = cur.execute("SELECT name, skema FROM internal.models", ()).fetchall()
-        skemas: dict = {}
-        if rs:
-            for n, s in rs:
-                skemas[n] = s
+def build_patch_model(name: str, model: type):
+    # every field can be left out, so that only the fields that are sent
+    # are validated, with their original annotation and constraints:
+    # a null is still rejected for a field that isn't nullable.
+    # The default isn't validated, and is dropped by exclude_unset.
+    fields = {}
+    for field_name, fi in model.model_fields.items():
+        if field_name == "id":
+            continue
+
+        fi = copy.copy(fi)
+        fi.default = None
+        fi.default_factory = None
+        fields[field_name] = (fi.annotation, fi)
+
+    # reject unknown fields instead of silently ignoring them
+    return create_model(name, __config__=ConfigDict(extra="forbid"), **fields)
+
+
+# the model defs are loaded from a local snapshot, so that
+# startup doesn't wait on the database.
+# The snapshot is validated against the database in the background
+# and rewritten, followed by a reload, if it's stale.
+SCHEMA_SNAPSHOT_FILE = os.getenv("SCHEMA_SNAPSHOT_FILE", "schema.snapshot.json")
+
+
+def fetch_schema_snapshot() -> dict:
+    """
+    Reads the watch epoch and all model defs in the same transaction,
+    so that the epoch matches the model defs.
+    """
+    with psycopg.connect(DB_URL) as conn:
+        with conn.cursor() as cur:
+            epoch = cur.execute(
+                "SELECT ts::INT8 FROM internal.watch LIMIT 1"
+            ).fetchone()
+            rs = cur.execute("SELECT name, skema FROM internal.models").fetchall()
+
+    return {"epoch": epoch[0] if epoch else 0, "skemas": {n: s for n, s in rs}}
+
+
+def load_schema_snapshot() -> dict | None:
+    try:
+        with open(SCHEMA_SNAPSHOT_FILE) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        not isinstance(snapshot, dict)
+        or not isinstance(snapshot.get("skemas"), dict)
+        or "epoch" not in snapshot
+    ):
+        return None
+
+    return snapshot
+
+
+def save_schema_snapshot(snapshot: dict) -> None:
+    # write and rename, so that other workers never read a partial file
+    tmp = f"{SCHEMA_SNAPSHOT_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, SCHEMA_SNAPSHOT_FILE)
+
+
+schema_snapshot = load_schema_snapshot()
+
+if not schema_snapshot:
+    schema_snapshot = fetch_schema_snapshot()
+    save_schema_snapshot(schema_snapshot)
+
+schema_epoch: int = schema_snapshot["epoch"]
+skemas: dict = schema_snapshot["skemas"]
 
 
 class AuditFields(BaseModel):
@@ -93,25 +162,82 @@ class Attachments(BaseModel):
 
 
 # for each model, create the Pydantic models
-
-pyd_models: dict = {}
-
-for n, s in skemas.items():
-    pyd_models[n] = {}
+def build_pyd_models(n: str, s: dict) -> dict:
+    m = {}
 
     # ModelUpdate
     f = build_model_tuple(s["fields"])
     model_update = extend_model(f"{n}Update", BaseFields, f)
-    pyd_models[n]["update"] = model_update
+    m["update"] = model_update
+
+    # ModelPatch
+    m["patch"] = build_patch_model(f"{n}Patch", model_update)
 
     # Model
     model = extend_model(n, (model_update, AuditFields, Attachments), {})
-    pyd_models[n]["default"] = model
+    m["default"] = model
 
     # # ModelOverview
     f = build_model_tuple(s["fields"], True)
     model = extend_model(f"{n}Overview", (BaseFields, AuditFields), f)
-    pyd_models[n]["overview"] = model
+    m["overview"] = model
+
+    # default staleness for reads, can be overridden per request
+    m["stale_reads"] = s.get("stale_reads", None)
+
+    return m
+
+
+def get_skema_hash(n: str, s: dict) -> str:
+    return hashlib.sha256(
+        json.dumps([n, s], sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+# compiled models, keyed by the hash of model name and skema,
+# so that a reload only compiles the models that changed
+compiled_models: dict[str, dict] = {}
+
+
+def get_pyd_models(n: str, s: dict) -> dict:
+    h = get_skema_hash(n, s)
+
+    if h not in compiled_models:
+        compiled_models[h] = build_pyd_models(n, s) | {"hash": h}
+
+    return compiled_models[h]
+
+
+def update_pyd_models(new_skemas: dict) -> tuple[list[str], list[str]]:
+    """
+    Replaces pyd_models and skemas to match new_skemas.
+    Returns the names of the models that were changed or added,
+    and of the models that were removed.
+    """
+    global pyd_models, skemas
+
+    changed = [
+        n
+        for n, s in new_skemas.items()
+        if n not in pyd_models or pyd_models[n]["hash"] != get_skema_hash(n, s)
+    ]
+    removed = [n for n in pyd_models.keys() if n not in new_skemas]
+
+    # the dicts are swapped, never changed in place, as they are
+    # read by the requests while the watch thread reloads them
+    pyd_models = {n: get_pyd_models(n, s) for n, s in new_skemas.items()}
+    skemas = dict(new_skemas)
+
+    # drop the classes that are no longer in use
+    in_use = {m["hash"] for m in pyd_models.values()}
+    for h in [h for h in compiled_models.keys() if h not in in_use]:
+        del compiled_models[h]
+
+    return changed, removed
+
+
+# read as models.pyd_models, as a reload replaces the dict
+pyd_models: dict = {n: get_pyd_models(n, s) for n, s in skemas.items()}
 
 
 ###################
@@ -135,6 +261,65 @@ class Report(AuditFields):
     sql_stmt: str
 
 
+class AttachmentInfo(BaseModel):
+    filename: str
+    size: int | None = None
+    content_type: str | None = None
+    etag: str | None = None
+    confirmed_at: dt.datetime | None = None
+    created_at: dt.datetime | None = None
+
+
+class UploadPart(BaseModel):
+    part_number: int
+    etag: str
+    size: int | None = None
+
+
+class MultipartUpload(BaseModel):
+    upload_id: str
+    model_name: str
+    id: UUID
+    filename: str
+    status: str
+    created_by: str | None = None
+    created_at: dt.datetime | None = None
+    updated_at: dt.datetime | None = None
+    parts: list[UploadPart] = []
+
+
+class Event(BaseModel):
+    id: UUID
+    ts: dt.datetime
+    object: str | None = None
+    instance_id: UUID | None = None
+    username: str | None = None
+    action: str | None = None
+    kind: str | None = None
+    details: str | None = None
+
+
+class Descendant(BaseModel):
+    type: str
+    id: UUID
+    # 1 for the children
+    depth: int
+
+
+class InstanceVersion(BaseModel):
+    ts: dt.datetime
+    username: str | None = None
+    action: str | None = None
+    # None once the instance is deleted
+    data: dict[str, Any] | None = None
+
+
+class EventPage(BaseModel):
+    events: list[Event]
+    # pass as 'cursor' to get the next page, None on the last page
+    next_cursor: str | None = None
+
+
 class TableData(BaseModel):
     status: str
     cols: list[str]
@@ -148,6 +333,7 @@ class TableData(BaseModel):
 
 class Skema(BaseModel):
     svg_path: str = ""
+    stale_reads: str | None = None
     fields: list[dict]
 
 
@@ -158,3 +344,19 @@ class ModelUpdate(BaseModel):
 
 class Model(ModelUpdate, AuditFields):
     pass
+
+
+class SchemaJob(BaseModel):
+    id: UUID
+    model_name: str
+    skema: Skema
+    status: str
+    stmts: list[str] | None = None
+    crdb_job_id: int | None = None
+    fraction_completed: float = 0
+    error: str | None = None
+    created_at: dt.datetime | None = None
+    created_by: str | None = None
+    updated_at: dt.datetime | None = None
+
+    model_config = ConfigDict(protected_namespaces=())
@@ -0,0 +1,58 @@
+from fastapi import APIRouter, Query, Security
+from typing import Annotated, Any, Literal
+import apiserver.dependencies as dep
+import apiserver.service as svc
+
+NAME = __name__.split(".", 2)[-1]
+
+router = APIRouter(
+    prefix=f"/{NAME}",
+    tags=[NAME],
+)
+
+
+@router.get(
+    "/pools",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_admin_read"])],
+    description="Required permission: `worst_admin_read`",
+)
+def get_pool_stats() -> dict[str, dict] | None:
+    return svc.get_pool_stats()
+
+
+@router.get(
+    "/statements",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_admin_read"])],
+    description="Required permission: `worst_admin_read`",
+)
+def get_top_stmts(
+    order_by: Literal[
+        "total_ms", "max_ms", "calls", "errors", "rows", "retries", "retry_ms"
+    ] = "total_ms",
+    limit: Annotated[int, Query(ge=1, le=1000)] = 20,
+) -> list[dict] | None:
+    return svc.get_top_stmts(order_by, limit)
+
+
+@router.get(
+    "/s3-purge-queue",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_admin_read"])],
+    description="Required permission: `worst_admin_read`",
+)
+def get_s3_purge_lag() -> dict[str, Any] | None:
+    return svc.get_s3_purge_lag()
+
+
+@router.post(
+    "/hierarchy",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_admin_write"])],
+    description="""Required permission: `worst_admin_write`
+
+Rebuilds the hierarchy of the instances from their parent links,
+eg. after upgrading from a version without it.
+The rebuild is a single transaction over all the models: the writes that
+create, move or delete instances with a parent are blocked until it ends,
+so run it while these writes are paused.""",
+)
+def rebuild_hierarchy() -> dict[str, int] | None:
+    return svc.rebuild_hierarchy()
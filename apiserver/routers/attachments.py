@@ -1,8 +1,9 @@
-from fastapi import APIRouter, Security, BackgroundTasks, Body
+from fastapi import APIRouter, Depends, Security, BackgroundTasks, Body, Query
 from typing import Annotated
-from apiserver.models import User, Report
+from apiserver.models import User, Report, AttachmentInfo, MultipartUpload
 import inspect
 import apiserver.dependencies as dep
+import apiserver.metrics as metrics
 import apiserver.service as svc
 import datetime as dt
 from fastapi.encoders import jsonable_encoder
@@ -15,6 +16,8 @@ NAME = __name__.split(".", 2)[-1]
 router = APIRouter(
     prefix=f"/{NAME}",
     tags=[NAME],
+    # all paths start with the model name
+    dependencies=[Depends(dep.check_model_name)],
 )
 
 
@@ -23,12 +26,30 @@ router = APIRouter(
     dependencies=[Security(dep.get_current_user, scopes=["worst_attachments_list"])],
     description="Required permission: `worst_attachments_list`",
 )
-async def get_attachment_list(
+def get_attachment_list(
     model_name: str,
     id: UUID,
 ) -> list[str] | None:
+    filenames = svc.get_attachment_list(model_name, id)
+
+    if filenames is None:
+        return None
+
+    # the full object names, as when the list was read from S3
     s3_folder_name = "/".join([model_name, str(id)])
-    return dep.s3_list_all_objects(s3_folder_name)
+    return ["/".join([s3_folder_name, x]) for x in filenames]
+
+
+@router.get(
+    "/{model_name}/{id}/details",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_attachments_list"])],
+    description="Required permission: `worst_attachments_list`",
+)
+def get_attachment_infos(
+    model_name: str,
+    id: UUID,
+) -> list[AttachmentInfo] | None:
+    return svc.get_attachment_infos(model_name, id)
 
 
 @router.get(
@@ -39,7 +60,7 @@ async def get_attachment_list(
     ],
     description="Required permission: `worst_attachments_download`",
 )
-async def get_presigned_get_url(
+def get_presigned_get_url(
     model_name: str,
     id: UUID,
     filename: str,
@@ -49,12 +70,27 @@ async def get_presigned_get_url(
     return HTMLResponse(content=data)
 
 
+@router.get(
+    "/{model_name}/{id}/presigned-get-urls",
+    name="Get pre-signed URLs for downloading all attachments",
+    dependencies=[
+        Security(dep.get_current_user, scopes=["worst_attachments_download"])
+    ],
+    description="Required permission: `worst_attachments_download`",
+)
+def get_presigned_get_urls(
+    model_name: str,
+    id: UUID,
+) -> dict[str, str] | None:
+    return svc.get_presigned_get_urls(model_name, id)
+
+
 @router.get(
     "/{model_name}/{id}/presigned-put-url",
     name="Get pre-signed URL for uploading an attachment",
     description="Required permission: `worst_attachments_upload`",
 )
-async def get_presigned_put_url(
+def get_presigned_put_url(
     model_name: str,
     id: UUID,
     filename: str,
@@ -68,7 +104,8 @@ async def get_presigned_put_url(
     data = dep.get_presigned_put_url(s3_object_name)
 
     if data:
-        bg_task.add_task(
+        metrics.add_task(
+            bg_task,
             svc.log_event,
             model_name,
             dt.datetime.utcnow(),
@@ -78,18 +115,136 @@ async def get_presigned_put_url(
         )
 
         # this should append to the new list...
-        bg_task.add_task(
+        metrics.add_task(
+            bg_task,
             svc.update_documents,
             [{"comp_id": model_name + "_" + str(id), "attachments": attachments}],
         )
     return HTMLResponse(content=data)
 
 
+@router.post(
+    "/{model_name}/{id}/confirm",
+    name="Confirm the upload of an attachment",
+    description="Required permission: `worst_attachments_upload`",
+)
+def confirm_attachment(
+    model_name: str,
+    id: UUID,
+    filename: str,
+    current_user: Annotated[
+        User, Security(dep.get_current_user, scopes=["worst_attachments_upload"])
+    ],
+) -> AttachmentInfo | None:
+    return svc.confirm_attachment(model_name, id, filename)
+
+
+@router.post(
+    "/{model_name}/{id}/multipart",
+    name="Start a multipart upload of an attachment",
+    description="Required permission: `worst_attachments_upload`",
+)
+def create_multipart_upload(
+    model_name: str,
+    id: UUID,
+    filename: str,
+    current_user: Annotated[
+        User, Security(dep.get_current_user, scopes=["worst_attachments_upload"])
+    ],
+) -> MultipartUpload | None:
+    return svc.create_multipart_upload(model_name, id, filename, current_user)
+
+
+@router.get(
+    "/{model_name}/{id}/multipart/{upload_id}",
+    name="Get the state of a multipart upload, including the uploaded parts",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_attachments_upload"])],
+    description="Required permission: `worst_attachments_upload`",
+)
+def get_multipart_upload(
+    model_name: str,
+    id: UUID,
+    upload_id: str,
+) -> MultipartUpload | None:
+    return svc.get_multipart_upload(model_name, id, upload_id)
+
+
+@router.get(
+    "/{model_name}/{id}/multipart/{upload_id}/part-urls",
+    name="Get pre-signed URLs for uploading a batch of parts",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_attachments_upload"])],
+    description="Required permission: `worst_attachments_upload`",
+)
+def get_presigned_part_urls(
+    model_name: str,
+    id: UUID,
+    upload_id: str,
+    first_part: Annotated[int, Query(ge=1, le=dep.S3_MULTIPART_MAX_PARTS)] = 1,
+    count: Annotated[int, Query(ge=1, le=1000)] = 100,
+) -> dict[int, str] | None:
+    return svc.get_presigned_part_urls(model_name, id, upload_id, first_part, count)
+
+
+@router.post(
+    "/{model_name}/{id}/multipart/{upload_id}/complete",
+    name="Complete a multipart upload",
+    description="Required permission: `worst_attachments_upload`",
+)
+def complete_multipart_upload(
+    model_name: str,
+    id: UUID,
+    upload_id: str,
+    current_user: Annotated[
+        User, Security(dep.get_current_user, scopes=["worst_attachments_upload"])
+    ],
+    bg_task: BackgroundTasks,
+) -> AttachmentInfo | None:
+    x = svc.complete_multipart_upload(model_name, id, upload_id)
+
+    if x:
+        metrics.add_task(
+            bg_task,
+            svc.log_event,
+            model_name,
+            dt.datetime.utcnow(),
+            current_user,
+            inspect.currentframe().f_code.co_name,  # type: ignore
+            "/".join([model_name, str(id), x.filename]),
+        )
+
+        metrics.add_task(
+            bg_task,
+            svc.update_documents,
+            [
+                {
+                    "comp_id": model_name + "_" + str(id),
+                    "attachments": svc.get_attachment_list(model_name, id),
+                }
+            ],
+        )
+
+    return x
+
+
+@router.delete(
+    "/{model_name}/{id}/multipart/{upload_id}",
+    name="Abort a multipart upload",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_attachments_upload"])],
+    description="Required permission: `worst_attachments_upload`",
+)
+def abort_multipart_upload(
+    model_name: str,
+    id: UUID,
+    upload_id: str,
+) -> MultipartUpload | None:
+    return svc.abort_multipart_upload(model_name, id, upload_id)
+
+
 @router.delete(
     "/{model_name}/{id}",
     description="Required permission: `worst_attachments_download`",
 )
-async def delete_attachement(
+def delete_attachement(
     model_name: str,
     id: UUID,
     filename: str,
@@ -102,7 +257,8 @@ async def delete_attachement(
     attachments = svc.remove_attachment(model_name, id, filename)
     dep.s3_remove_object(s3_object_name)
 
-    bg_task.add_task(
+    metrics.add_task(
+        bg_task,
         svc.log_event,
         model_name,
         dt.datetime.utcnow(),
@@ -112,7 +268,8 @@ async def delete_attachement(
     )
 
     # this should add the new list
-    bg_task.add_task(
+    metrics.add_task(
+        bg_task,
         svc.update_documents,
         [{"comp_id": model_name + "_" + str(id), "attachments": attachments}],
     )
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, Query, Security
+from typing import Annotated
+from apiserver.models import EventPage
+import apiserver.dependencies as dep
+import apiserver.service as svc
+import datetime as dt
+
+NAME = __name__.split(".", 2)[-1]
+
+router = APIRouter(
+    prefix=f"/{NAME}",
+    tags=[NAME],
+)
+
+
+@router.get(
+    "",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_events_read"])],
+    description="""Required permission: `worst_events_read`
+
+Audit events, newest first. `start` is inclusive, `end` exclusive.
+Pass the `next_cursor` of a page as `cursor` to get the next page.""",
+)
+def get_events(
+    model: str | None = None,
+    user: str | None = None,
+    action: str | None = None,
+    start: dt.datetime | None = None,
+    end: dt.datetime | None = None,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+) -> EventPage | None:
+    return svc.get_events(model, user, action, start, end, cursor, limit)
@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Security, BackgroundTasks
+from fastapi import APIRouter, Security, BackgroundTasks, Query, status
 from typing import Annotated
-from apiserver.models import User, Model, ModelUpdate
+from uuid import UUID
+from apiserver.models import User, Model, ModelUpdate, SchemaJob
 import inspect
 import apiserver.dependencies as dep
+import apiserver.metrics as metrics
 import apiserver.service as svc
 import datetime as dt
 
@@ -23,7 +25,7 @@ router = APIRouter(
     dependencies=[Security(dep.get_current_user, scopes=["worst_models_read"])],
     description="Required permission: `worst_models_read`",
 )
-async def get_all_models() -> dict[str, Model] | None:
+def get_all_models() -> dict[str, Model] | None:
     return JSONResponse(jsonable_encoder(svc.get_all_models()))
 
 
@@ -32,15 +34,30 @@ async def get_all_models() -> dict[str, Model] | None:
     dependencies=[Security(dep.get_current_user, scopes=["worst_models_read"])],
     description="Required permission: `worst_models_read`",
 )
-async def get_model(name: str) -> Model | None:
+def get_model(name: str) -> Model | None:
     return svc.get_model(name)
 
 
+@router.get(
+    "/{name}/indexes",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_models_read"])],
+    description="""Required permission: `worst_models_read`
+
+The secondary indexes declared in the skema and their build progress.""",
+)
+def get_index_status(name: str) -> list[dict] | None:
+    return svc.get_index_status(name)
+
+
 @router.post(
     "",
-    description="Required permission: `worst_models_create`",
+    description="""Required permission: `worst_models_create`
+
+Fields can declare `indexed`, `unique`, `sort` (`asc`, `desc`) and
+`storing` (by default the overview columns) to get a secondary index.
+Indexes are built in the background, see `GET /models/{name}/indexes`.""",
 )
-async def create_model(
+def create_model(
     model: ModelUpdate,
     current_user: Annotated[
         User, Security(dep.get_current_user, scopes=["worst_models_create"])
@@ -50,7 +67,8 @@ async def create_model(
     x = svc.create_model(model, current_user)
 
     if x:
-        bg_task.add_task(
+        metrics.add_task(
+            bg_task,
             svc.log_event,
             NAME,
             dt.datetime.utcnow(),
@@ -59,40 +77,71 @@ async def create_model(
             x.model_dump_json(),
         )
 
+        metrics.add_task(bg_task, svc.create_indexes, x.name)
+
     return x
 
 
 @router.put(
     "",
-    description="Required permission: `worst_models_update`",
+    status_code=status.HTTP_202_ACCEPTED,
+    description="""Required permission: `worst_models_update`
+
+The schema change is applied in the background as a job,
+see `GET /models/{name}/jobs/{job_id}`.
+The new skema is only in effect once the job succeeded.
+Indexes that changed are rebuilt, see `GET /models/{name}/indexes`.
+Returns 404 for an unknown model and 422 for an unchanged skema,
+no job is queued then.""",
 )
-async def update_model(
+def update_model(
     model: ModelUpdate,
     current_user: Annotated[
         User, Security(dep.get_current_user, scopes=["worst_models_update"])
     ],
     bg_task: BackgroundTasks,
-) -> Model | None:
+) -> SchemaJob:
     x = svc.update_model(model, current_user)
 
-    if x:
-        bg_task.add_task(
-            svc.log_event,
-            NAME,
-            dt.datetime.utcnow(),
-            current_user,
-            inspect.currentframe().f_code.co_name,  # type: ignore
-            x.model_dump_json(),
-        )
+    metrics.add_task(
+        bg_task,
+        svc.log_event,
+        NAME,
+        dt.datetime.utcnow(),
+        current_user,
+        inspect.currentframe().f_code.co_name,  # type: ignore
+        x.model_dump_json(),
+    )
 
     return x
 
 
+@router.get(
+    "/{name}/jobs",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_models_read"])],
+    description="Required permission: `worst_models_read`",
+)
+def get_schema_jobs(
+    name: str,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+) -> list[SchemaJob] | None:
+    return svc.get_schema_jobs(name, limit)
+
+
+@router.get(
+    "/{name}/jobs/{job_id}",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_models_read"])],
+    description="Required permission: `worst_models_read`",
+)
+def get_schema_job(name: str, job_id: UUID) -> SchemaJob | None:
+    return svc.get_schema_job(name, job_id)
+
+
 @router.delete(
     "/{name}",
     description="Required permission: `worst_models_delete`",
 )
-async def delete_model(
+def delete_model(
     name: str,
     current_user: Annotated[
         User, Security(dep.get_current_user, scopes=["worst_models_delete"])
@@ -102,7 +151,8 @@ async def delete_model(
     x = svc.delete_model(name)
 
     if x:
-        bg_task.add_task(
+        metrics.add_task(
+            bg_task,
             svc.log_event,
             NAME,
             dt.datetime.utcnow(),
@@ -3,6 +3,7 @@ from typing import Annotated
 from apiserver.models import User, Report
 import inspect
 import apiserver.dependencies as dep
+import apiserver.metrics as metrics
 import apiserver.service as svc
 import datetime as dt
 from fastapi.encoders import jsonable_encoder
@@ -21,7 +22,7 @@ router = APIRouter(
     dependencies=[Security(dep.get_current_user, scopes=["worst_reports_read"])],
     description="Required permission: `worst_reports_read`",
 )
-async def get_all_reports() -> list[Report] | None:
+def get_all_reports() -> list[Report] | None:
     return svc.get_all_reports()
 
 
@@ -30,7 +31,7 @@ async def get_all_reports() -> list[Report] | None:
     dependencies=[Security(dep.get_current_user, scopes=["worst_reports_read"])],
     description="Required permission: `worst_reports_read`",
 )
-async def get_report(name: str) -> Report | None:
+def get_report(name: str) -> Report | None:
     return svc.get_report(name)
 
 
@@ -38,7 +39,7 @@ async def get_report(name: str) -> Report | None:
     "",
     description="Required permission: `worst_reports_create`",
 )
-async def create_report(
+def create_report(
     name: Annotated[str, Body()],
     sql_stmt: Annotated[str, Body()],
     current_user: Annotated[
@@ -49,7 +50,8 @@ async def create_report(
     x = svc.create_report(name, sql_stmt, current_user)
 
     if x:
-        bg_task.add_task(
+        metrics.add_task(
+            bg_task,
             svc.log_event,
             NAME,
             dt.datetime.utcnow(),
@@ -65,7 +67,7 @@ async def create_report(
     "/{name}",
     description="Required permission: `worst_reports_update`",
 )
-async def update_report(
+def update_report(
     name: str,
     sql_stmt: Annotated[str, Body()],
     current_user: Annotated[
@@ -76,7 +78,8 @@ async def update_report(
     x = svc.update_report(name, sql_stmt, current_user)
 
     if x:
-        bg_task.add_task(
+        metrics.add_task(
+            bg_task,
             svc.log_event,
             NAME,
             dt.datetime.utcnow(),
@@ -92,7 +95,7 @@ async def update_report(
     "/{name}",
     description="Required permission: `worst_reports_delete`",
 )
-async def delete_report(
+def delete_report(
     name: str,
     current_user: Annotated[
         User, Security(dep.get_current_user, scopes=["worst_reports_delete"])
@@ -102,7 +105,8 @@ async def delete_report(
     x = svc.delete_report(name)
 
     if x:
-        bg_task.add_task(
+        metrics.add_task(
+            bg_task,
             svc.log_event,
             NAME,
             dt.datetime.utcnow(),
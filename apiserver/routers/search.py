@@ -18,7 +18,7 @@ router = APIRouter(
     dependencies=[Security(dep.get_current_user, scopes=["worst_search"])],
     description="Required permission: `worst_search`",
 )
-async def execute_search(
+def execute_search(
     search_queries: Annotated[dict, Body()],
 ) -> dict | None:
     return svc.execute_search(search_queries["queries"])
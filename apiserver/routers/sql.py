@@ -19,7 +19,7 @@ router = APIRouter(
     dependencies=[Security(dep.get_current_user, scopes=["worst_sql_report"])],
     description="Required permission: `worst_sql_report`",
 )
-async def execute_sql_report(
+def execute_sql_report(
     name: str,
     bind_params: Annotated[tuple, Body()],
 ) -> TableData | None:
@@ -31,7 +31,7 @@ async def execute_sql_report(
     dependencies=[Security(dep.get_current_user, scopes=["worst_sql_select"])],
     description="Required permission: `worst_sql_select`",
 )
-async def execute_sql_select(
+def execute_sql_select(
     stmt: Annotated[str, Body()],
     bind_params: Annotated[tuple, Body()],
 ) -> TableData | None:
@@ -43,7 +43,7 @@ async def execute_sql_select(
     dependencies=[Security(dep.get_current_user, scopes=["worst_sql_dml"])],
     description="Required permission: `worst_sql_dml`",
 )
-async def execute_sql_dml(
+def execute_sql_dml(
     stmt: Annotated[str, Body()],
     bind_params: Annotated[tuple, Body()],
 ) -> TableData | None:
@@ -0,0 +1,46 @@
+from fastapi import APIRouter, HTTPException, Security, status
+from fastapi.responses import StreamingResponse
+from uuid import UUID
+import apiserver.models as mdl
+import apiserver.broker as broker
+import apiserver.dependencies as dep
+
+NAME = __name__.split(".", 2)[-1]
+
+router = APIRouter(
+    prefix=f"/{NAME}",
+    tags=[NAME],
+)
+
+
+@router.get(
+    "",
+    dependencies=[Security(dep.get_current_user, scopes=["worst_instances_read"])],
+    description="""Required permission: `worst_instances_read`
+
+Server-sent events of the instances that are created (`create`),
+updated (`update`) or deleted (`delete`), with the row as data.
+Filter by `model`, by `id` or by parent (`parent_type`, `parent_id`).
+Clients that read too slowly get a `reset` event: the changes
+before it were dropped and must be fetched again.""",
+)
+# unlike the other endpoints, async: the subscription is bound to the event loop
+async def stream(
+    model: str | None = None,
+    id: UUID | None = None,
+    parent_type: str | None = None,
+    parent_id: UUID | None = None,
+) -> StreamingResponse:
+    if model and model not in mdl.pyd_models:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown model: {model}",
+        )
+
+    sub = broker.subscribe(model, id, parent_type, parent_id)
+
+    return StreamingResponse(
+        broker.listen(sub),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,3 +1,5 @@
+import apiserver.metrics as metrics
+import apiserver.tracing as tracing
 import meilisearch
 import os
 
@@ -11,17 +13,25 @@ client = meilisearch.Client(MEILISEARCH_URL, MEILISEARCH_KEY)
 index = client.index(MEILISEARCH_INDEX)
 
 
+@metrics.observe_dependency("meilisearch")
+@tracing.traced("meilisearch")
 def execute_search(search_queries: dict) -> dict | None:
     return client.multi_search(search_queries)
 
 
+@metrics.observe_dependency("meilisearch")
+@tracing.traced("meilisearch")
 def add_documents(documents: list[dict]):
     return index.add_documents(documents)
 
 
+@metrics.observe_dependency("meilisearch")
+@tracing.traced("meilisearch")
 def update_documents(documents: list[dict]):
     return index.update_documents(documents)
 
 
+@metrics.observe_dependency("meilisearch")
+@tracing.traced("meilisearch")
 def delete_document(comp_id: any):
     return index.delete_document(comp_id)
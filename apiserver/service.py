@@ -1,52 +1,188 @@
 from typing import Any, Type
 from uuid import UUID, uuid4
 
+from fastapi import HTTPException, status
 from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from pydantic_core import to_json
 from apiserver import db
 from apiserver import search
 from apiserver.models import (
+    AttachmentInfo,
     BaseFields,
-    pyd_models,
+    Descendant,
+    Event,
+    EventPage,
+    InstanceVersion,
     Model,
     ModelUpdate,
+    MultipartUpload,
     Report,
+    SchemaJob,
+    Skema,
     TableData,
+    UploadPart,
 )
+import base64
+import concurrent.futures
 import datetime as dt
+import json
+import logging
+import time
+import zlib
 import apiserver.dependencies as dep
+import apiserver.models as mdl
+import apiserver.tracing as tracing
 
+logger = logging.getLogger(__name__)
 
-def get_all_instances(model_name: str) -> list[Type[BaseFields]] | None:
-    return db.get_all_instances(model_name)
 
+@tracing.traced("service")
+def get_staleness(model_name: str, staleness: str | None) -> str:
+    # the request value wins over the model default
+    return staleness or mdl.pyd_models[model_name].get("stale_reads") or "strong"
 
+
+@tracing.traced("service")
+def pin_staleness(
+    staleness: str, point_lookup: bool = False
+) -> tuple[str, dt.datetime | None]:
+    """
+    Replaces the staleness by the timestamp the read will be served at,
+    if it is known before reading.
+    """
+    ts = db.get_read_timestamp(staleness, point_lookup)
+    return (ts.isoformat(), ts) if ts else (staleness, None)
+
+
+def __check_staleness(skema: Skema) -> None:
+    if skema.stale_reads and not db.is_valid_staleness(skema.stale_reads):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Invalid stale_reads '{skema.stale_reads}'. Use 'strong', 'follower' or an interval like '10s'",
+        )
+
+
+def __check_fields(model_names: list[str], fields: list[str] | None) -> None:
+    # the fields must be columns of at least one of the models
+    if not fields:
+        return
+
+    columns = set()
+    for n in model_names:
+        columns.update(mdl.pyd_models[n]["default"].model_fields.keys())
+
+    unknown = [x for x in fields if x not in columns]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown fields: {', '.join(unknown)}",
+        )
+
+
+# bumped on every write to the instances of a model,
+# to invalidate what is cached for it
+write_versions: dict[str, int] = {}
+
+# (model, filter, staleness, limit) -> (write version, cached at, tag counts)
+tag_counts_cache: dict[tuple, tuple[int, float, dict[str, int]]] = {}
+TAG_COUNTS_CACHE_MAX_ENTRIES = 1000
+
+
+def bump_write_version(model_name: str) -> None:
+    write_versions[model_name] = write_versions.get(model_name, 0) + 1
+
+
+@tracing.traced("service")
+def get_all_instances(
+    model_name: str,
+    staleness: str | None = None,
+    fields: list[str] | None = None,
+    tag_filter: dict[str, list[str]] | None = None,
+) -> list[Type[BaseFields]] | list[dict] | None:
+    __check_fields([model_name], fields)
+    return db.get_all_instances(model_name, staleness, fields, tag_filter)
+
+
+@tracing.traced("service")
+def get_tag_counts(
+    model_name: str,
+    tag_filter: dict[str, list[str]] | None = None,
+    staleness: str | None = None,
+    limit: int = 100,
+) -> dict[str, int] | None:
+    key = (
+        model_name,
+        json.dumps(tag_filter, sort_keys=True),
+        get_staleness(model_name, staleness),
+        limit,
+    )
+    version = write_versions.get(model_name, 0)
+
+    hit = tag_counts_cache.get(key)
+    if (
+        hit
+        and hit[0] == version
+        and time.monotonic() - hit[1] < db.TAG_COUNTS_CACHE_TTL_SECONDS
+    ):
+        return hit[2]
+
+    counts = db.get_tag_counts(model_name, tag_filter, staleness, limit)
+
+    if counts is not None:
+        # the filters are up to the clients, so don't let the cache grow unbounded
+        if len(tag_counts_cache) >= TAG_COUNTS_CACHE_MAX_ENTRIES:
+            tag_counts_cache.clear()
+        tag_counts_cache[key] = (version, time.monotonic(), counts)
+
+    return counts
+
+
+@tracing.traced("service")
 def get_instance(
     model_name: str,
     id: UUID,
-) -> Type[BaseFields] | None:
-    return db.get_instance(model_name, id)
+    staleness: str | None = None,
+    fields: list[str] | None = None,
+) -> Type[BaseFields] | dict | None:
+    __check_fields([model_name], fields)
+    return db.get_instance(model_name, id, staleness, fields)
 
 
+@tracing.traced("service")
 def get_all_children(
     model_name: str,
     id: UUID,
-) -> dict[str, list[Type[BaseFields]]] | None:
-    return db.get_all_children(model_name, id)
+    staleness: str | None = None,
+    fields: list[str] | None = None,
+    tag_filter: dict[str, list[str]] | None = None,
+) -> dict[str, list[Type[BaseFields]] | list[dict]] | None:
+    __check_fields(list(mdl.pyd_models.keys()), fields)
+    return db.get_all_children(model_name, id, staleness, fields, tag_filter)
 
 
+@tracing.traced("service")
 def get_all_children_for_model(
     model_name: str,
     id: UUID,
     children_model_name: str,
-) -> list[Type[BaseFields]] | None:
-    return db.get_all_children_for_model(model_name, id, children_model_name)
+    staleness: str | None = None,
+    fields: list[str] | None = None,
+    tag_filter: dict[str, list[str]] | None = None,
+) -> list[Type[BaseFields]] | list[dict] | None:
+    __check_fields([children_model_name], fields)
+    return db.get_all_children_for_model(
+        model_name, id, children_model_name, staleness, fields, tag_filter
+    )
 
 
+@tracing.traced("service")
 def get_parent_chain(
     model_name: str,
     id: UUID,
+    staleness: str | None = None,
 ) -> list | None:
-    raw_list = db.get_parent_chain(model_name, id)
+    raw_list = db.get_parent_chain(model_name, id, staleness)
 
     # [ [ null, null, "acc3" ], [ "account", "3fa85f64-5717-4562-b3fc-2c963f66afa4", "prog3-acc3" ] ]
 
@@ -60,12 +196,13 @@ def get_parent_chain(
     return l
 
 
+@tracing.traced("service")
 def create_instance(
     model_name: str,
     user_id: str,
     model: Type[BaseFields],
 ) -> Type[BaseFields] | None:
-    m: Type[BaseFields] = pyd_models[model_name]["default"](
+    m: Type[BaseFields] = mdl.pyd_models[model_name]["default"](
         **model.model_dump(exclude_unset=True),
         created_by=user_id,
         updated_by=user_id,
@@ -76,58 +213,582 @@ def create_instance(
     if not m.id:
         m.id = uuid4()
 
-    return db.create_instance(model_name, m)
+    x = db.create_instance(model_name, m)
+    # after the write, so that nothing older gets cached under the new version
+    if x:
+        bump_write_version(model_name)
+
+    return x
+
 
+def __get_changes(old: dict[str, Any], x: Type[BaseFields]) -> dict[str, list]:
+    # {field: [old, new]} of the fields whose value changed
+    changes = {}
+    for k, v in old.items():
+        # the previous values have the types of the model, see db.update_instance
+        new = getattr(x, k)
+        if v != new:
+            changes[k] = [v, new]
 
+    return changes
+
+
+def __update_instance(
+    model_name: str,
+    id: UUID,
+    data: dict[str, Any],
+    if_updated_at: dt.datetime | None,
+) -> tuple[Type[BaseFields] | None, dict[str, list] | None]:
+    # a new parent must not be in the subtree of the instance.
+    # The parent is the one of the row after the update, so a field
+    # that is not in 'data' keeps its stored value
+    if "parent_type" in data or "parent_id" in data:
+        stored = (
+            db.get_instance(model_name, id)
+            if "parent_type" not in data or "parent_id" not in data
+            else None
+        )
+        parent_type = data.get("parent_type", stored.parent_type if stored else None)
+        parent_id = data.get("parent_id", stored.parent_id if stored else None)
+
+        if (
+            parent_type
+            and parent_id
+            and db.is_in_subtree(model_name, id, parent_type, parent_id)
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="The new parent is in the subtree of the instance",
+            )
+
+    try:
+        rs = db.update_instance(model_name, id, data, if_updated_at)
+    except ValueError as e:
+        # the check in the transaction, for a concurrent move of the parent
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+
+    # no row was updated: tell apart a missing row from a concurrent update
+    if not rs:
+        if if_updated_at and db.get_instance(model_name, id):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"{model_name} {id} was modified after {if_updated_at}",
+            )
+        return None, None
+
+    # only a written row invalidates the cached reads
+    bump_write_version(model_name)
+
+    x, old = rs
+    return x, __get_changes(old, x)
+
+
+@tracing.traced("service")
 def update_instance(
-    model_name: str, user_id: str, model: Type[BaseFields]
-) -> Type[BaseFields] | None:
-    m = pyd_models[model_name]["default"](
-        **model.model_dump(exclude_unset=True),
-        updated_by=user_id,
-        updated_at=dt.datetime.utcnow(),
-    )
+    model_name: str,
+    user_id: str,
+    model: Type[BaseFields],
+    if_updated_at: dt.datetime | None = None,
+) -> tuple[Type[BaseFields] | None, dict[str, list] | None]:
+    """
+    Returns the updated instance and its changed fields, for the audit event.
+    """
+    if not model.id:
+        return None, None
+
+    data = model.model_dump(exclude_unset=True, exclude={"id"})
+    data["updated_by"] = user_id
+    data["updated_at"] = dt.datetime.utcnow()
 
-    return db.update_instance(model_name, m)
+    return __update_instance(model_name, model.id, data, if_updated_at)
 
 
+@tracing.traced("service")
 def partial_update_instance(
-    model_name: str, user_id: str, id: UUID, field: str, value
-) -> Type[BaseFields] | None:
-    return db.partial_update_instance(
-        model_name, user_id, id, field, value, dt.datetime.utcnow()
+    model_name: str,
+    user_id: str,
+    id: UUID,
+    model: BaseModel,
+    if_updated_at: dt.datetime | None = None,
+) -> tuple[Type[BaseFields] | None, dict[str, list] | None]:
+    data = model.model_dump(exclude_unset=True)
+    data["updated_by"] = user_id
+    data["updated_at"] = dt.datetime.utcnow()
+
+    return __update_instance(model_name, id, data, if_updated_at)
+
+
+def __get_types(types: str | None) -> list[str] | None:
+    # comma separated model names
+    if not types:
+        return None
+
+    l = [x.strip() for x in types.split(",") if x.strip()]
+    unknown = [x for x in l if x not in mdl.pyd_models]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown models: {', '.join(unknown)}",
+        )
+
+    return l or None
+
+
+@tracing.traced("service")
+def get_descendants(
+    model_name: str,
+    id: UUID,
+    max_depth: int | None,
+    types: str | None,
+    staleness: str | None,
+    limit: int,
+) -> list[Descendant] | None:
+    return db.get_descendants(
+        model_name, id, max_depth, __get_types(types), staleness, limit
     )
 
 
+@tracing.traced("service")
+def get_descendant_counts(
+    model_name: str,
+    id: UUID,
+    max_depth: int | None,
+    types: str | None,
+    staleness: str | None,
+) -> dict[str, int] | None:
+    return db.get_descendant_counts(
+        model_name, id, max_depth, __get_types(types), staleness
+    )
+
+
+@tracing.traced("service")
+def rebuild_hierarchy() -> dict[str, int] | None:
+    n = db.rebuild_hierarchy()
+    return {"rows": n} if n is not None else None
+
+
+@tracing.traced("service")
 def delete_instance(model_name: str, id: UUID) -> Type[BaseFields] | None:
-    # delete all attachments from the instance
+    # detach all children, delete the instance and queue
+    # the purge of its attachments in one transaction
+    x = db.delete_instance(model_name, id)
+    if x:
+        bump_write_version(model_name)
+
+    return x
+
+
+@tracing.traced("service")
+def get_attachment_list(model_name: str, id: UUID) -> list[str] | None:
+    return db.get_attachments(model_name, id)
+
+
+@tracing.traced("service")
+def get_attachment_infos(model_name: str, id: UUID) -> list[AttachmentInfo] | None:
+    return db.get_attachment_infos(model_name, id)
+
+
+@tracing.traced("service")
+def confirm_attachment(
+    model_name: str, id: UUID, filename: str
+) -> AttachmentInfo | None:
+    s3_object_name = "/".join([model_name, str(id), filename])
+    stat = dep.s3_stat_object(s3_object_name)
+
+    if not stat:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"{s3_object_name} was not uploaded",
+        )
+
+    return db.confirm_attachment(
+        model_name, id, filename, stat["size"], stat["content_type"], stat["etag"]
+    )
+
+
+@tracing.traced("service")
+def create_multipart_upload(
+    model_name: str, id: UUID, filename: str, user_id: str
+) -> MultipartUpload | None:
+    s3_object_name = "/".join([model_name, str(id), filename])
+
+    if db.get_attachments(model_name, id) is None:
+        return None
+
+    upload_id = dep.s3_create_multipart_upload(s3_object_name)
+
+    return db.create_upload(upload_id, model_name, id, filename, user_id)
+
+
+@tracing.traced("service")
+def get_multipart_upload(
+    model_name: str, id: UUID, upload_id: str
+) -> MultipartUpload | None:
+    upload = db.get_upload(model_name, id, upload_id)
+
+    # S3 keeps track of the parts already uploaded,
+    # so clients can resume by uploading only the missing ones
+    if upload and upload.status == "in_progress":
+        s3_object_name = "/".join([model_name, str(id), upload.filename])
+        upload.parts = [
+            UploadPart(**x) for x in dep.s3_list_parts(s3_object_name, upload_id)
+        ]
+
+    return upload
+
+
+@tracing.traced("service")
+def get_presigned_part_urls(
+    model_name: str, id: UUID, upload_id: str, first_part: int, count: int
+) -> dict[int, str] | None:
+    upload = db.get_upload(model_name, id, upload_id)
+
+    if not upload or upload.status != "in_progress":
+        return None
+
+    last_part = min(first_part + count, dep.S3_MULTIPART_MAX_PARTS + 1)
+    s3_object_name = "/".join([model_name, str(id), upload.filename])
+
+    return dep.get_presigned_part_urls(
+        s3_object_name, upload_id, range(first_part, last_part)
+    )
+
+
+@tracing.traced("service")
+def complete_multipart_upload(
+    model_name: str, id: UUID, upload_id: str
+) -> AttachmentInfo | None:
+    upload = db.get_upload(model_name, id, upload_id)
+
+    if not upload or upload.status != "in_progress":
+        return None
+
+    s3_object_name = "/".join([model_name, str(id), upload.filename])
+    parts = dep.s3_list_parts(s3_object_name, upload_id)
+
+    if not parts:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"No parts of upload {upload_id} were uploaded",
+        )
+
+    dep.s3_complete_multipart_upload(s3_object_name, upload_id, parts)
+
+    db.set_upload_status(upload_id, "completed")
+
+    return confirm_attachment(model_name, id, upload.filename)
+
+
+@tracing.traced("service")
+def abort_multipart_upload(
+    model_name: str, id: UUID, upload_id: str
+) -> MultipartUpload | None:
+    upload = db.get_upload(model_name, id, upload_id)
+
+    if not upload or upload.status != "in_progress":
+        return None
+
+    s3_object_name = "/".join([model_name, str(id), upload.filename])
+    dep.s3_abort_multipart_upload(s3_object_name, upload_id)
+
+    return db.set_upload_status(upload_id, "aborted")
+
+
+@tracing.traced("service")
+def abort_stale_uploads() -> int:
+    """
+    Aborts the multipart uploads that were abandoned by the clients.
+    Returns the count of aborted uploads.
+    """
+    uploads = db.get_stale_uploads(
+        dep.S3_MULTIPART_MAX_AGE_SECONDS, dep.S3_MULTIPART_SWEEP_BATCH_SIZE
+    )
+
+    n = 0
+    for upload in uploads or []:
+        s3_object_name = "/".join([upload.model_name, str(upload.id), upload.filename])
+
+        try:
+            dep.s3_abort_multipart_upload(s3_object_name, upload.upload_id)
+            if db.set_upload_status(upload.upload_id, "expired"):
+                n += 1
+        except Exception:
+            logger.exception("aborting the upload %s failed", upload.upload_id)
+
+    return n
+
+
+@tracing.traced("service")
+def reconcile_attachments(model_name: str) -> None:
+    """
+    Repairs drift between the objects in S3 and
+    the 'attachments' column of the model table.
+    """
+    # {id: {filename: object stat}}
+    s3_objects: dict[str, dict[str, dict]] = {}
+    for x in dep.s3_list_all_object_stats(model_name + "/"):
+        parts = x["object_name"].split("/", 2)
+        if len(parts) == 3:
+            s3_objects.setdefault(parts[1], {})[parts[2]] = x
+
+    attachments = db.get_all_attachments_for_model(model_name)
+    infos = db.get_all_attachment_infos_for_model(model_name)
+
+    # a failed read must not look like an empty table,
+    # which would drop or purge attachments that are fine
+    if attachments is None or infos is None:
+        raise RuntimeError(f"Could not read the attachments of {model_name}")
+
+    db_attachments: dict[str, list[str]] = {str(id): l for id, l in attachments}
+    created_at: dict[tuple[str, str], dt.datetime] = {
+        (str(id), filename): ts for id, filename, ts in infos
+    }
+
+    grace_ts = dt.datetime.now(dt.timezone.utc) - dt.timedelta(
+        seconds=dep.S3_RECONCILE_GRACE_SECONDS
+    )
+
+    for id, objects in s3_objects.items():
+        missing = {
+            k: x for k, x in objects.items() if k not in db_attachments.get(id, [])
+        }
+        if not missing:
+            continue
+
+        try:
+            # the objects of a deleted instance are purged, but only
+            # if the instance is known to be gone: on an error, skip it
+            if id not in db_attachments and not db.instance_exists(
+                model_name, UUID(id)
+            ):
+                db.queue_s3_purge("/".join([model_name, id]))
+                continue
+
+            # record the objects missing from the table
+            for filename, x in missing.items():
+                db.confirm_attachment(
+                    model_name, UUID(id), filename, x["size"], None, x["etag"]
+                )
+        except Exception:
+            logger.exception("reconciling %s %s failed", model_name, id)
+
+    for id, filenames in db_attachments.items():
+        for filename in filenames:
+            if filename in s3_objects.get(id, {}):
+                continue
+
+            ts = created_at.get((id, filename))
+            if ts is None or ts < grace_ts:
+                db.remove_attachment(model_name, UUID(id), filename)
+
+
+@tracing.traced("service")
+def get_presigned_get_urls(model_name: str, id: UUID) -> dict[str, str] | None:
+    filenames = db.get_attachments(model_name, id)
+
+    if filenames is None:
+        return None
+
     s3_folder_name = "/".join([model_name, str(id)])
-    dep.s3_delete_all_objects(s3_folder_name)
+    return dep.get_presigned_get_urls(s3_folder_name, filenames)
+
+
+@tracing.traced("service")
+def add_attachment(model_name: str, id: UUID, filename: str) -> list[str] | None:
+    rs = db.add_attachment(model_name, id, filename)
+    return rs[0] if rs else None
 
-    # set parent_type and parent_id to NULL for all children
-    db.set_parent_to_null(model_name, id)
 
-    # finally, delete the instance itself
-    return db.delete_instance(model_name, id)
+@tracing.traced("service")
+def remove_attachment(model_name: str, id: UUID, filename: str) -> list[str] | None:
+    rs = db.remove_attachment(model_name, id, filename)
+    return rs[0] if rs else None
 
 
-def add_attachment(model_name: str, id: UUID, filename: str) -> list[str]:
-    return db.add_attachment(model_name, id, filename)[0]
+@tracing.traced("service")
+def process_s3_purge_queue() -> int:
+    """
+    Purges the S3 folders of deleted instances.
+    Returns the count of processed entries.
+    """
+    purges = db.claim_s3_purges(dep.S3_PURGE_BATCH_SIZE, dep.S3_PURGE_LEASE_SECONDS)
 
+    if not purges:
+        return 0
 
-def remove_attachment(model_name: str, id: UUID, filename: str) -> list[str]:
-    return db.remove_attachment(model_name, id, filename)[0]
+    for id, folder, attempts in purges:
+        try:
+            dep.s3_delete_all_objects(folder)
+            db.complete_s3_purge(id)
+        except Exception as e:
+            logger.exception("purge of %s failed", folder)
+            db.fail_s3_purge(
+                id, str(e), min(dep.S3_PURGE_MAX_RETRY_SECONDS, 10 * 2**attempts)
+            )
 
+    return len(purges)
 
+
+@tracing.traced("service")
 def log_event(
     model_name: str, ts: dt.datetime, username: str, action: str, details: str
 ):
     return db.log_event(model_name, ts, username, action, details)
 
 
+def __pack(v: Any) -> Any:
+    # large values, mostly texts, are stored compressed
+    s = to_json(v, fallback=str)
+    if len(s) < db.EVENTS_COMPRESS_MIN_BYTES:
+        return v
+
+    return {"$zlib": base64.b64encode(zlib.compress(s)).decode()}
+
+
+def __unpack(v: Any) -> Any:
+    if isinstance(v, dict) and len(v) == 1 and "$zlib" in v:
+        return json.loads(zlib.decompress(base64.b64decode(v["$zlib"])))
+
+    return v
+
+
+def __decode_details(kind: str | None, details: str | None) -> Any:
+    # the details of the events of the instances, with the values uncompressed
+    d = json.loads(details) if details else None
+
+    if kind == "snapshot":
+        return {k: __unpack(v) for k, v in d.items()}
+    if kind == "diff":
+        return {k: [__unpack(o), __unpack(n)] for k, (o, n) in d.items()}
+
+    return d
+
+
+@tracing.traced("service")
+def log_instance_event(
+    model_name: str,
+    ts: dt.datetime,
+    username: str,
+    action: str,
+    x: Type[BaseFields],
+    changes: dict[str, list] | None = None,
+):
+    """
+    Logs the changed fields of an update, or the full row on create
+    and whenever the last snapshot of the instance is too far back.
+    Deletes are logged without details.
+    """
+    if action == "delete_instance":
+        kind, details = "delete", None
+
+    elif changes is not None and not db.is_snapshot_due(model_name, x.id):
+        kind = "diff"
+        details = to_json(
+            {k: [__pack(o), __pack(n)] for k, (o, n) in changes.items()},
+            fallback=str,
+        ).decode()
+
+    else:
+        kind = "snapshot"
+        details = to_json(
+            {k: __pack(v) for k, v in x.model_dump().items()}, fallback=str
+        ).decode()
+
+    return db.log_event(model_name, ts, username, action, details, x.id, kind)
+
+
+@tracing.traced("service")
+def get_instance_versions(
+    model_name: str, id: UUID, at: dt.datetime | None, limit: int
+) -> list[InstanceVersion] | None:
+    """
+    Rebuilds the versions of an instance from its events, newest last:
+    each diff is applied to the version before it, starting from the
+    first snapshot that is still kept.
+    """
+    events = db.get_instance_events(model_name, id, at)
+
+    if events is None:
+        return None
+
+    versions: list[InstanceVersion] = []
+    data: dict[str, Any] | None = None
+
+    for e in events:
+        d = __decode_details(e.kind, e.details)
+
+        if e.kind == "snapshot":
+            data = d
+        elif e.kind == "diff" and data is not None:
+            data = {**data, **{k: n for k, (_, n) in d.items()}}
+        elif e.kind == "delete":
+            data = None
+        else:
+            # diffs older than the first snapshot can't be applied
+            continue
+
+        versions.append(
+            InstanceVersion(ts=e.ts, username=e.username, action=e.action, data=data)
+        )
+
+    return versions[-limit:]
+
+
+def __encode_cursor(e: Event) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([e.ts.isoformat(), str(e.id)]).encode()
+    ).decode()
+
+
+def __decode_cursor(cursor: str) -> tuple[dt.datetime, UUID]:
+    try:
+        ts, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return dt.datetime.fromisoformat(ts), UUID(id)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Invalid cursor",
+        )
+
+
+@tracing.traced("service")
+def get_events(
+    model_name: str | None,
+    username: str | None,
+    action: str | None,
+    start: dt.datetime | None,
+    end: dt.datetime | None,
+    cursor: str | None,
+    limit: int,
+) -> EventPage | None:
+    after = __decode_cursor(cursor) if cursor else None
+
+    # one more row tells if there is a next page
+    events = db.get_events(
+        model_name, username, action, start, end, after, limit + 1
+    )
+
+    if events is None:
+        return None
+
+    for e in events:
+        if e.kind in ["snapshot", "diff"]:
+            e.details = json.dumps(__decode_details(e.kind, e.details))
+
+    if len(events) > limit:
+        return EventPage(
+            events=events[:limit], next_cursor=__encode_cursor(events[limit - 1])
+        )
+
+    return EventPage(events=events)
+
+
 ###########
 #  MODEL  #
 ###########
+@tracing.traced("service")
 def get_all_models() -> dict[str, Model] | None:
     models = db.get_all_models()
 
@@ -139,11 +800,35 @@ def get_all_models() -> dict[str, Model] | None:
     return m
 
 
+@tracing.traced("service")
 def get_model(model_name: str) -> Model | None:
     # TODO sanitize name
     return db.get_model(model_name.lower())
 
 
+def __check_index_options(skema: Skema) -> None:
+    names = {f["name"] for f in skema.fields} | set(db.INDEX_STORING_COLS)
+
+    for f in skema.fields:
+        errors = []
+
+        if f.get("sort", "asc") not in ("asc", "desc"):
+            errors.append("'sort' must be 'asc' or 'desc'")
+
+        storing = f.get("storing", True)
+        if not isinstance(storing, bool) and (
+            not isinstance(storing, list) or not set(storing) <= names
+        ):
+            errors.append("'storing' must be a boolean or a list of fields")
+
+        if errors:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Field {f['name']}: {', '.join(errors)}",
+            )
+
+
+@tracing.traced("service")
 def create_model(
     model: ModelUpdate,
     user_id: str,
@@ -159,13 +844,22 @@ def create_model(
     # TODO sanitize incoming name
     m.name = m.name.lower()
 
+    __check_index_options(m.skema)
+    __check_staleness(m.skema)
+
     return db.create_model(m)
 
 
+@tracing.traced("service")
 def update_model(
     model: ModelUpdate,
     user_id: str,
-) -> Model | None:
+) -> SchemaJob:
+    """
+    Submits the schema change as a job, applied in the background
+    by process_schema_jobs().
+    An unchanged skema is rejected, as there is nothing to apply.
+    """
     m = Model(
         **model.model_dump(exclude_unset=True),
         updated_by=user_id,
@@ -175,17 +869,114 @@ def update_model(
     # TODO sanitize incoming name
     m.name = m.name.lower()
 
-    return db.update_model(m)
+    __check_index_options(m.skema)
+    __check_staleness(m.skema)
+
+    current = db.get_model(m.name)
+
+    if not current:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Model {m.name} not found",
+        )
+
+    if current.skema == m.skema:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"The skema of {m.name} is unchanged",
+        )
+
+    job = db.create_schema_job(m)
+
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"A schema change of {m.name} is already in progress",
+        )
+
+    return job
+
+
+@tracing.traced("service")
+def get_schema_jobs(model_name: str, limit: int) -> list[SchemaJob] | None:
+    return db.get_schema_jobs(model_name.lower(), limit)
+
+
+@tracing.traced("service")
+def get_schema_job(model_name: str, id: UUID) -> SchemaJob | None:
+    return db.get_schema_job(model_name.lower(), id)
+
+
+@tracing.traced("service")
+def process_schema_jobs() -> int:
+    """
+    Applies the oldest pending schema change, if any.
+    The job progress is polled from the CockroachDB jobs while the DDL runs.
+    The new skema is recorded, and the models reloaded, only on success.
+    Returns the count of processed jobs.
+    """
+    job = db.claim_schema_job(db.SCHEMA_JOB_LEASE_SECONDS)
+
+    if not job:
+        return 0
+
+    # a job left running would block the next changes of the model
+    try:
+        __run_schema_job(job)
+    except Exception as e:
+        logger.exception("schema job %s of %s failed", job.id, job.model_name)
+        db.fail_schema_job(job.id, str(e))
+        # restore the indexes dropped for the new skema
+        db.create_indexes(job.model_name)
+
+    return 1
 
 
+def __run_schema_job(job: SchemaJob) -> None:
+    model = db.get_model(job.model_name)
+    if not model:
+        raise ValueError(f"Model {job.model_name} not found")
+
+    stmts = db.get_schema_change_stmts(model, job.skema)
+    db.renew_schema_job(job.id, db.SCHEMA_JOB_LEASE_SECONDS, stmts)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        f = executor.submit(db.execute_ddl, stmts)
+
+        while True:
+            try:
+                f.result(timeout=db.SCHEMA_JOB_POLL_SECONDS)
+                break
+            except concurrent.futures.TimeoutError:
+                progress = db.get_ddl_job_progress(job.model_name, job.updated_at)
+                db.renew_schema_job(
+                    job.id, db.SCHEMA_JOB_LEASE_SECONDS, stmts, *(progress or ())
+                )
+
+    db.complete_schema_job(job)
+    db.create_indexes(job.model_name)
+
+
+@tracing.traced("service")
 def delete_model(model_name: str) -> Model | None:
     # TODO sanitize name
     return db.delete_model(model_name.lower())
 
 
+@tracing.traced("service")
+def create_indexes(model_name: str) -> None:
+    db.create_indexes(model_name.lower())
+
+
+@tracing.traced("service")
+def get_index_status(model_name: str) -> list[dict] | None:
+    return db.get_index_status(model_name.lower())
+
+
 ##################
 #  CRUD REPORTS  #
 ##################
+@tracing.traced("service")
 def get_all_reports() -> list[Report] | None:
     reports = db.get_all_reports()
 
@@ -194,10 +985,12 @@ def get_all_reports() -> list[Report] | None:
     return x
 
 
+@tracing.traced("service")
 def get_report(name: str) -> Report | None:
     return db.get_report(name)
 
 
+@tracing.traced("service")
 def create_report(
     name: str,
     sql_stmt: str,
@@ -215,6 +1008,7 @@ def create_report(
     return db.create_report(r)
 
 
+@tracing.traced("service")
 def update_report(
     name: str,
     sql_stmt: str,
@@ -230,6 +1024,7 @@ def update_report(
     return db.update_report(r)
 
 
+@tracing.traced("service")
 def delete_report(name: str) -> Report | None:
     return db.delete_report(name)
 
@@ -237,10 +1032,11 @@ def delete_report(name: str) -> Report | None:
 ###########
 #   SQL   #
 ###########
+@tracing.traced("service")
 def execute_sql_report(name: str, bind_params: tuple) -> TableData | None:
     report = db.get_report(name)
     if report:
-        d = db.execute_sql("dml", report.sql_stmt, bind_params)
+        d = db.execute_sql("dml", report.sql_stmt, bind_params, f"report {name}")
 
         return TableData(
             status=d["status"],
@@ -253,6 +1049,7 @@ def execute_sql_report(name: str, bind_params: tuple) -> TableData | None:
     return None
 
 
+@tracing.traced("service")
 def execute_sql_select(stmt: str, bind_params: tuple) -> TableData | None:
     d = db.execute_sql("select", stmt, bind_params)
 
@@ -265,6 +1062,7 @@ def execute_sql_select(stmt: str, bind_params: tuple) -> TableData | None:
     )
 
 
+@tracing.traced("service")
 def execute_sql_dml(stmt: str, bind_params: tuple) -> TableData | None:
     d = db.execute_sql("dml", stmt, bind_params)
 
@@ -280,17 +1078,56 @@ def execute_sql_dml(stmt: str, bind_params: tuple) -> TableData | None:
 ############
 #  SEARCH  #
 ############
+@tracing.traced("service")
 def execute_search(search_queries: dict) -> dict | None:
     return search.execute_search(search_queries)
 
 
+@tracing.traced("service")
 def add_documents(documents: list[dict]):
     return search.add_documents(documents)
 
 
+@tracing.traced("service")
 def update_documents(documents: list[dict]):
     return search.update_documents(documents)
 
 
+@tracing.traced("service")
 def delete_document(comp_id: str):
     return search.delete_document(comp_id)
+
+
+###########
+#  ADMIN  #
+###########
+@tracing.traced("service")
+def get_pool_stats() -> dict[str, dict] | None:
+    return db.get_pool_stats()
+
+
+@tracing.traced("service")
+def get_top_stmts(order_by: str, limit: int) -> list[dict] | None:
+    stats = [{"stmt": k} | v for k, v in db.get_stmt_stats().items()]
+
+    return sorted(stats, key=lambda x: x.get(order_by, 0), reverse=True)[:limit]
+
+
+# refreshed by the purge thread, so that scrapes don't query the database
+s3_purge_lag: dict[str, Any] = {}
+s3_purge_lag_ts = 0.0
+
+
+def refresh_s3_purge_lag() -> None:
+    global s3_purge_lag, s3_purge_lag_ts
+
+    # at most once per interval, also while draining the queue
+    if time.monotonic() - s3_purge_lag_ts < dep.S3_PURGE_INTERVAL_SECONDS:
+        return
+
+    s3_purge_lag = db.get_s3_purge_lag()
+    s3_purge_lag_ts = time.monotonic()
+
+
+def get_s3_purge_lag() -> dict[str, Any] | None:
+    return s3_purge_lag
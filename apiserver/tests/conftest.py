@@ -0,0 +1,15 @@
+import atexit
+import json
+import os
+import tempfile
+
+# the tests that never connect run without a database:
+# the app then loads an empty schema snapshot instead
+if not os.getenv("DB_URL"):
+    fd, snapshot_file = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"epoch": 0, "skemas": {}}, f)
+    atexit.register(os.remove, snapshot_file)
+
+    os.environ["DB_URL"] = "postgresql://worst@localhost/worst"
+    os.environ["SCHEMA_SNAPSHOT_FILE"] = snapshot_file
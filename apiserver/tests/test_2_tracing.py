@@ -0,0 +1,41 @@
+import importlib
+import json
+import apiserver.tracing
+import pytest
+
+
+@pytest.fixture
+def file_tracing(tmp_path, monkeypatch):
+    # the module is configured at import time, so it's reloaded
+    # with the file exporter, and reloaded back on teardown
+    traces_file = tmp_path / "traces.jsonl"
+    monkeypatch.setenv("TRACES_EXPORTER", "file")
+    monkeypatch.setenv("TRACES_FILE", str(traces_file))
+    tracing = importlib.reload(apiserver.tracing)
+
+    yield tracing, traces_file
+
+    tracing.shutdown()
+    monkeypatch.undo()
+    importlib.reload(apiserver.tracing)
+
+
+def test_file_exporter(file_tracing):
+    tracing, traces_file = file_tracing
+
+    @tracing.traced("service")
+    def get_instance():
+        return tracing.linked(lambda: None, "background.log_event")
+
+    get_instance()()
+    tracing.provider.force_flush()
+
+    spans = [json.loads(x) for x in traces_file.read_text().splitlines()]
+    names = [x["name"] for x in spans]
+
+    assert names == ["service.get_instance", "background.log_event"]
+
+    # the background task runs in its own trace, linked to the parent span
+    parent, task = spans
+    assert task["parent_id"] is None
+    assert task["links"][0]["context"]["span_id"] == parent["context"]["span_id"]
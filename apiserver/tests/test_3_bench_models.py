@@ -0,0 +1,137 @@
+# pytest apiserver/tests/test_3_bench_models.py --benchmark-only
+# --benchmark-autosave / --benchmark-compare to track regressions
+# the benchmarks build their own models and never connect,
+# see conftest.py for running them without a database
+from apiserver import db
+from apiserver.models import build_pyd_models
+from decimal import Decimal
+from uuid import uuid4
+import datetime as dt
+import pytest
+
+# the benchmark fixture comes with the pytest-benchmark plugin,
+# a dev dependency the rest of the suite doesn't need
+pytest.importorskip("pytest_benchmark")
+
+TYPES = ["string", "integer", "date", "datetime", "decimal", "markdown"]
+
+VALUES = {
+    "string": "a string value",
+    "integer": 12345,
+    "date": dt.date(2023, 1, 1),
+    "datetime": dt.datetime(2023, 1, 1, 12, 30),
+    # DECIMAL columns are returned as Decimal
+    "decimal": Decimal("123.45"),
+    "markdown": "# Title\n\n" + "some text " * 100,
+}
+
+
+def get_skema(nr_fields: int) -> dict:
+    return {
+        "svg_path": "",
+        "fields": [
+            {
+                "name": f"field_{i}",
+                "type": TYPES[i % len(TYPES)],
+                "nullable": i % 3 != 0,
+                "in_overview": i % 2 == 0,
+                "args": {"max_length": 1000} if TYPES[i % len(TYPES)] == "string" else {},
+            }
+            for i in range(nr_fields)
+        ],
+    }
+
+
+def get_row(skema: dict, is_overview: bool = False) -> dict:
+    # the columns as returned by the database, including the base fields
+    row = {
+        "id": uuid4(),
+        "name": "bench",
+        "owned_by": "dummyadmin",
+        "permissions": None,
+        "tags": ["t1", "t2"],
+        "parent_type": None,
+        "parent_id": None,
+        "created_by": "dummyadmin",
+        "created_at": dt.datetime(2023, 1, 1),
+        "updated_by": "dummyadmin",
+        "updated_at": dt.datetime(2023, 1, 1),
+    }
+    if not is_overview:
+        row["attachments"] = ["a.pdf", "b.png"]
+
+    for f in skema["fields"]:
+        if not is_overview or f["in_overview"]:
+            row[f["name"]] = VALUES[f["type"]]
+
+    return row
+
+
+@pytest.fixture(params=[5, 20, 50], ids=lambda x: f"{x}_fields")
+def skema(request):
+    return get_skema(request.param)
+
+
+@pytest.fixture
+def models(skema):
+    return build_pyd_models("bench", skema)
+
+
+def test_build_models(benchmark, skema):
+    benchmark(build_pyd_models, "bench", skema)
+
+
+@pytest.mark.parametrize("nr_models", [1, 10, 50])
+def test_build_all_models(benchmark, nr_models):
+    skemas = {f"bench_{i}": get_skema(20) for i in range(nr_models)}
+
+    def build():
+        return {n: build_pyd_models(n, s) for n, s in skemas.items()}
+
+    benchmark(build)
+
+
+@pytest.mark.parametrize("kind", ["default", "overview"])
+def test_hydrate_rows(benchmark, skema, models, kind):
+    # same as execute_stmt: one model instance per row, 100 rows
+    row = get_row(skema, kind == "overview")
+    col_names = list(row.keys())
+    rsl = [tuple(row.values())] * 100
+
+    def hydrate():
+        return [
+            models[kind](**{k: rs[i] for i, k in enumerate(col_names)})
+            for rs in rsl
+        ]
+
+    x = benchmark(hydrate)
+
+    assert len(x) == 100
+
+
+@pytest.mark.parametrize("kind", ["default", "overview"])
+def test_hydrate_rows_trusted(benchmark, skema, models, kind):
+    # same as execute_stmt for the rows of the instance tables
+    row = get_row(skema, kind == "overview")
+    col_names = list(row.keys())
+    rsl = [tuple(row.values())] * 100
+
+    x = benchmark(db.__hydrate, models[kind], col_names, rsl)
+
+    assert len(x) == 100
+    assert x[0].model_dump() == models[kind](**row).model_dump()
+    assert not any(isinstance(v, Decimal) for v in x[0].model_dump().values())
+
+
+@pytest.mark.parametrize("kind", ["default", "overview"])
+def test_model_dump(benchmark, skema, models, kind):
+    instances = [models[kind](**get_row(skema, kind == "overview"))] * 100
+
+    benchmark(lambda: [x.model_dump() for x in instances])
+
+
+@pytest.mark.parametrize("kind", ["default", "overview"])
+def test_model_dump_json(benchmark, skema, models, kind):
+    instances = [models[kind](**get_row(skema, kind == "overview"))] * 100
+
+    benchmark(lambda: [x.model_dump_json() for x in instances])
@@ -0,0 +1,46 @@
+from fastapi.testclient import TestClient
+from apiserver.main import app
+from apiserver.models import User
+from unittest import mock
+import apiserver.db as db
+import apiserver.dependencies as dep
+import psycopg
+import pytest
+
+
+@pytest.fixture
+def conflicting_db(monkeypatch):
+    # every statement fails with a serialization failure, without a database
+    calls = []
+
+    def fetch_stmt(*args, **kwargs):
+        calls.append(args[1])
+        raise psycopg.errors.SerializationFailure("restart transaction")
+
+    monkeypatch.setattr(db, "__get_pool", lambda p: mock.MagicMock())
+    monkeypatch.setattr(db, "fetch_stmt", fetch_stmt)
+    monkeypatch.setattr(db, "DB_MAX_RETRIES", 2)
+    monkeypatch.setattr(db, "DB_RETRY_MAX_DELAY_MS", 0)
+
+    async def get_current_user():
+        return User(user_id="dummyadmin", scopes=["worst_models_read"])
+
+    app.dependency_overrides[dep.get_current_user] = get_current_user
+    yield calls
+    app.dependency_overrides.pop(dep.get_current_user)
+
+
+def test_execute_stmt_raises_after_retries(conflicting_db):
+    with pytest.raises(psycopg.errors.SerializationFailure):
+        db.get_all_models()
+
+    # the first attempt and the retries
+    assert len(conflicting_db) == 3
+
+
+def test_conflict_is_a_503(conflicting_db):
+    r = TestClient(app).get("/models")
+
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == "1"
+    assert r.json() == {"detail": "Too much contention, retry later"}
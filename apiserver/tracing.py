@@ -0,0 +1,94 @@
+from opentelemetry import trace
+from opentelemetry.context import Context
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    ConsoleSpanExporter,
+    SimpleSpanProcessor,
+)
+from opentelemetry.trace import Link, Status, StatusCode
+from typing import Callable
+import functools
+import os
+
+# 'otlp' exports to OTEL_EXPORTER_OTLP_ENDPOINT,
+# 'file' writes one JSON span per line to TRACES_FILE
+TRACES_EXPORTER = os.getenv("TRACES_EXPORTER", "none").lower()
+TRACES_FILE = os.getenv("TRACES_FILE", "traces.jsonl")
+
+provider = TracerProvider(resource=Resource.create({"service.name": "worst"}))
+# the file of the 'file' exporter
+traces_out = None
+
+if TRACES_EXPORTER == "otlp":
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+        OTLPSpanExporter,
+    )
+
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+
+elif TRACES_EXPORTER == "file":
+    traces_out = open(TRACES_FILE, "a")
+    provider.add_span_processor(
+        SimpleSpanProcessor(
+            ConsoleSpanExporter(
+                out=traces_out,
+                formatter=lambda span: span.to_json(indent=None) + os.linesep,
+            )
+        )
+    )
+
+tracer = provider.get_tracer("apiserver")
+
+
+def traced(component: str):
+    """
+    Decorator wrapping each call in a span named '<component>.<function>'.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.start_as_current_span(f"{component}.{fn.__name__}"):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def linked(fn: Callable, name: str) -> Callable:
+    """
+    Wraps fn so that it runs in a new span linked to the span
+    that is current now, eg. for background tasks that run
+    after the request span has ended.
+    """
+    ctx = trace.get_current_span().get_span_context()
+    links = [Link(ctx)] if ctx.is_valid else []
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # start a new trace, not a child of whatever span is current
+        with tracer.start_as_current_span(name, context=Context(), links=links):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def set_attributes(attributes: dict) -> None:
+    trace.get_current_span().set_attributes(attributes)
+
+
+def set_error(description: str) -> None:
+    trace.get_current_span().set_status(Status(StatusCode.ERROR, description))
+
+
+def shutdown() -> None:
+    """
+    Exports the pending spans and closes the exporters.
+    """
+    provider.shutdown()
+
+    if traces_out:
+        traces_out.close()
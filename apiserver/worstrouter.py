@@ -1,10 +1,14 @@
-from fastapi import APIRouter, BackgroundTasks, Security, Body
+from fastapi import APIRouter, BackgroundTasks, Depends, Security, Body, Query, Response
 from fastapi.responses import HTMLResponse
 from typing import Annotated, Any, Type
 from uuid import UUID
-from apiserver.models import User, BaseFields
+from apiserver.models import User, BaseFields, Descendant, InstanceVersion
+from pydantic import BaseModel
+from pydantic_core import to_json
 import inspect
+import apiserver.broker as broker
 import apiserver.dependencies as dep
+import apiserver.metrics as metrics
 import apiserver.service as svc
 import datetime as dt
 
@@ -16,6 +20,7 @@ class WorstRouter(APIRouter):
         default_model: Type[BaseFields],
         overview_model: Type[BaseFields],
         update_model: Type[BaseFields],
+        patch_model: Type[BaseModel],
     ) -> None:
         super().__init__(
             prefix=f"/{instance_type}",
@@ -29,8 +34,44 @@ class WorstRouter(APIRouter):
             ],
             description="Required permission: `worst_instances_read`",
         )
-        async def get_all_instances() -> list[overview_model] | None:
-            return svc.get_all_instances(instance_type)
+        def get_all_instances(
+            response: Response,
+            staleness: Annotated[str | None, Depends(dep.get_staleness)],
+            fields: Annotated[list[str] | None, Depends(dep.get_fields)],
+            tag_filter: Annotated[dict | None, Depends(dep.get_tag_filter)],
+        ) -> list[overview_model] | None:
+            staleness = self.__set_staleness(instance_type, staleness, response)
+            return self.__json_response(
+                svc.get_all_instances(instance_type, staleness, fields, tag_filter),
+                response,
+            )
+
+        # before '/{id}', which would match it
+        @self.get(
+            "/tags",
+            dependencies=[
+                Security(dep.get_current_user, scopes=["worst_instances_read"])
+            ],
+            description="""Required permission: `worst_instances_read`
+
+The number of instances of each tag, most used first, among the instances
+matching `tags` and `tags_any`. The counts are cached until the model
+is written to.""",
+        )
+        def get_tag_counts(
+            response: Response,
+            staleness: Annotated[str | None, Depends(dep.get_staleness)],
+            tag_filter: Annotated[dict | None, Depends(dep.get_tag_filter)],
+            limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+        ) -> dict[str, int] | None:
+            # cached by staleness mode, so not pinned to a timestamp
+            staleness = self.__set_staleness(
+                instance_type, staleness, response, pin=False
+            )
+            return self.__json_response(
+                svc.get_tag_counts(instance_type, tag_filter, staleness, limit),
+                response,
+            )
 
         @self.get(
             "/{id}",
@@ -39,10 +80,18 @@ class WorstRouter(APIRouter):
             ],
             description="Required permission: `worst_instances_read`",
         )
-        async def get_instance(
+        def get_instance(
             id: UUID,
+            response: Response,
+            staleness: Annotated[str | None, Depends(dep.get_staleness)],
+            fields: Annotated[list[str] | None, Depends(dep.get_fields)],
         ) -> default_model | None:
-            return svc.get_instance(instance_type, id)
+            staleness = self.__set_staleness(
+                instance_type, staleness, response, point_lookup=True
+            )
+            return self.__json_response(
+                svc.get_instance(instance_type, id, staleness, fields), response
+            )
 
         @self.get(
             "/{id}/children",
@@ -51,10 +100,18 @@ class WorstRouter(APIRouter):
             ],
             description="Required permission: `worst_instances_read`",
         )
-        async def get_all_children(
+        def get_all_children(
             id: UUID,
+            response: Response,
+            staleness: Annotated[str | None, Depends(dep.get_staleness)],
+            fields: Annotated[list[str] | None, Depends(dep.get_fields)],
+            tag_filter: Annotated[dict | None, Depends(dep.get_tag_filter)],
         ) -> dict | None:
-            return svc.get_all_children(instance_type, id)
+            staleness = self.__set_staleness(instance_type, staleness, response)
+            return self.__json_response(
+                svc.get_all_children(instance_type, id, staleness, fields, tag_filter),
+                response,
+            )
 
         @self.get(
             "/{id}/parent_chain",
@@ -63,10 +120,85 @@ class WorstRouter(APIRouter):
             ],
             description="Required permission: `worst_instances_read`",
         )
-        async def get_parent_chain(
+        def get_parent_chain(
             id: UUID,
+            response: Response,
+            staleness: Annotated[str | None, Depends(dep.get_staleness)],
         ) -> list | None:
-            return svc.get_parent_chain(instance_type, id)
+            staleness = self.__set_staleness(
+                instance_type, staleness, response, point_lookup=True
+            )
+            return self.__json_response(
+                svc.get_parent_chain(instance_type, id, staleness), response
+            )
+
+        @self.get(
+            "/{id}/descendants",
+            dependencies=[
+                Security(dep.get_current_user, scopes=["worst_instances_read"])
+            ],
+            description="""Required permission: `worst_instances_read`
+
+All the descendants of the instance, closest first, up to `max_depth`
+(1 for the children) and of the comma separated model names in `types`.""",
+        )
+        def get_descendants(
+            id: UUID,
+            response: Response,
+            staleness: Annotated[str | None, Depends(dep.get_staleness)],
+            max_depth: Annotated[int | None, Query(ge=1)] = None,
+            types: str | None = None,
+            limit: Annotated[int, Query(ge=1, le=10000)] = 1000,
+        ) -> list[Descendant] | None:
+            staleness = self.__set_staleness(instance_type, staleness, response)
+            return self.__json_response(
+                svc.get_descendants(
+                    instance_type, id, max_depth, types, staleness, limit
+                ),
+                response,
+            )
+
+        @self.get(
+            "/{id}/descendants/count",
+            dependencies=[
+                Security(dep.get_current_user, scopes=["worst_instances_read"])
+            ],
+            description="""Required permission: `worst_instances_read`
+
+The number of descendants of the instance by model,
+with the same filters as `/{id}/descendants`.""",
+        )
+        def get_descendant_counts(
+            id: UUID,
+            response: Response,
+            staleness: Annotated[str | None, Depends(dep.get_staleness)],
+            max_depth: Annotated[int | None, Query(ge=1)] = None,
+            types: str | None = None,
+        ) -> dict[str, int] | None:
+            staleness = self.__set_staleness(instance_type, staleness, response)
+            return self.__json_response(
+                svc.get_descendant_counts(
+                    instance_type, id, max_depth, types, staleness
+                ),
+                response,
+            )
+
+        @self.get(
+            "/{id}/versions",
+            dependencies=[
+                Security(dep.get_current_user, scopes=["worst_events_read"])
+            ],
+            description="""Required permission: `worst_events_read`
+
+The versions of the instance rebuilt from its audit events, oldest first,
+up to `at` if passed. Only the versions still kept in the events are listed.""",
+        )
+        def get_instance_versions(
+            id: UUID,
+            at: Annotated[dt.datetime | None, Query()] = None,
+            limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+        ) -> list[InstanceVersion] | None:
+            return svc.get_instance_versions(instance_type, id, at, limit)
 
         @self.get(
             "/{id}/{children_instance_type}",
@@ -75,19 +207,34 @@ class WorstRouter(APIRouter):
             ],
             description="Required permission: `worst_instances_read`",
         )
-        async def get_all_children_for_model(
+        def get_all_children_for_model(
             id: UUID,
             children_instance_type: str,
+            response: Response,
+            staleness: Annotated[str | None, Depends(dep.get_staleness)],
+            fields: Annotated[list[str] | None, Depends(dep.get_fields)],
+            tag_filter: Annotated[dict | None, Depends(dep.get_tag_filter)],
         ) -> list | None:
-            return svc.get_all_children_for_model(
-                instance_type, id, children_instance_type
+            staleness = self.__set_staleness(
+                children_instance_type, staleness, response
+            )
+            return self.__json_response(
+                svc.get_all_children_for_model(
+                    instance_type,
+                    id,
+                    children_instance_type,
+                    staleness,
+                    fields,
+                    tag_filter,
+                ),
+                response,
             )
 
         @self.post(
             "",
             description="Required permission: `worst_instances_create`",
         )
-        async def create_instance(
+        def create_instance(
             model: update_model,
             current_user: Annotated[
                 User, Security(dep.get_current_user, scopes=["worst_instances_create"])
@@ -97,88 +244,115 @@ class WorstRouter(APIRouter):
             x = svc.create_instance(instance_type, current_user, model)
 
             if x:
-                bg_task.add_task(
-                    svc.log_event,
+                broker.publish_instance(instance_type, "create", x)
+
+                metrics.add_task(
+                    bg_task,
+                    svc.log_instance_event,
                     instance_type,
                     dt.datetime.utcnow(),
                     current_user,
                     inspect.currentframe().f_code.co_name,  # type: ignore
-                    x.model_dump_json(),
+                    x,
                 )
 
-                bg_task.add_task(
-                    svc.add_documents, self.__get_search_documents(instance_type, x)
+                metrics.add_task(
+                    bg_task,
+                    svc.add_documents,
+                    self.__get_search_documents(instance_type, x),
                 )
 
-            return x
+            return self.__json_response(x)
 
         @self.put(
             "",
-            description="Required permission: `worst_instances_update`",
+            description="""Required permission: `worst_instances_update`
+
+Pass `if_updated_at` to only update the instance if it wasn't
+modified since, otherwise `409 Conflict` is returned.""",
         )
-        async def update_instance(
+        def update_instance(
             model: update_model,
             current_user: Annotated[
                 User, Security(dep.get_current_user, scopes=["worst_instances_update"])
             ],
             bg_task: BackgroundTasks,
+            if_updated_at: Annotated[dt.datetime | None, Query()] = None,
         ) -> default_model | None:
-            x = svc.update_instance(instance_type, current_user, model)
+            x, changes = svc.update_instance(
+                instance_type, current_user, model, if_updated_at
+            )
 
             if x:
-                bg_task.add_task(
-                    svc.log_event,
+                broker.publish_instance(instance_type, "update", x)
+
+                metrics.add_task(
+                    bg_task,
+                    svc.log_instance_event,
                     instance_type,
                     dt.datetime.utcnow(),
                     current_user,
                     inspect.currentframe().f_code.co_name,  # type: ignore
-                    x.model_dump_json(),
+                    x,
+                    changes,
                 )
 
-                bg_task.add_task(
-                    svc.add_documents, self.__get_search_documents(instance_type, x)
+                metrics.add_task(
+                    bg_task,
+                    svc.add_documents,
+                    self.__get_search_documents(instance_type, x),
                 )
 
-            return x
+            return self.__json_response(x)
 
         @self.patch(
             "/{id}",
-            description="Required permission: `worst_instances_patch`",
+            description="""Required permission: `worst_instances_patch`
+
+The body is an object of the fields to update, e.g. `{"name": "x"}`.
+Only the fields in the body are updated, in a single statement;
+a null is rejected for a field that isn't nullable.""",
         )
-        async def partial_update_instance(
+        def partial_update_instance(
             id: UUID,
-            field: Annotated[str, Body()],
-            value: Annotated[Any, Body()],
+            model: patch_model,
             current_user: Annotated[
                 User, Security(dep.get_current_user, scopes=["worst_instances_patch"])
             ],
             bg_task: BackgroundTasks,
+            if_updated_at: Annotated[dt.datetime | None, Query()] = None,
         ) -> default_model | None:
-            x = svc.partial_update_instance(
-                instance_type, current_user, id, field, value
+            x, changes = svc.partial_update_instance(
+                instance_type, current_user, id, model, if_updated_at
             )
 
             if x:
-                bg_task.add_task(
-                    svc.log_event,
+                broker.publish_instance(instance_type, "update", x)
+
+                metrics.add_task(
+                    bg_task,
+                    svc.log_instance_event,
                     instance_type,
                     dt.datetime.utcnow(),
                     current_user,
                     inspect.currentframe().f_code.co_name,  # type: ignore
-                    x.model_dump_json(),
+                    x,
+                    changes,
                 )
 
-                bg_task.add_task(
-                    svc.add_documents, self.__get_search_documents(instance_type, x)
+                metrics.add_task(
+                    bg_task,
+                    svc.add_documents,
+                    self.__get_search_documents(instance_type, x),
                 )
 
-            return x
+            return self.__json_response(x)
 
         @self.delete(
             "/{id}",
             description="Required permission: `worst_instances_delete`",
         )
-        async def delete_instance(
+        def delete_instance(
             id: UUID,
             current_user: Annotated[
                 User, Security(dep.get_current_user, scopes=["worst_instances_delete"])
@@ -188,17 +362,54 @@ class WorstRouter(APIRouter):
             x: default_model = svc.delete_instance(instance_type, id)
 
             if x:
-                bg_task.add_task(
-                    svc.log_event,
+                broker.publish_instance(instance_type, "delete", x)
+
+                metrics.add_task(
+                    bg_task,
+                    svc.log_instance_event,
                     instance_type,
                     dt.datetime.utcnow(),
                     current_user,
                     inspect.currentframe().f_code.co_name,  # type: ignore
-                    x.model_dump_json(),
+                    x,
+                )
+
+                metrics.add_task(
+                    bg_task, svc.delete_document, instance_type + "_" + str(x.id)
                 )
+            return self.__json_response(x)
+
+    def __json_response(self, x: Any, response: Response | None = None) -> Response:
+        # the instances come from the db, so the response_model,
+        # used for the docs, doesn't validate them again.
+        # Plain rows ('fields') can hold UUIDs, which are written as strings
+        return Response(
+            to_json(x, fallback=str),
+            media_type="application/json",
+            headers=dict(response.headers) if response else None,
+        )
+
+    def __set_staleness(
+        self,
+        instance_type: str,
+        staleness: str | None,
+        response: Response,
+        point_lookup: bool = False,
+        pin: bool = True,
+    ) -> str:
+        # report the staleness mode, and the timestamp the read is
+        # served at, if it is pinned to one
+        staleness = svc.get_staleness(instance_type, staleness)
+        response.headers["X-Worst-Staleness"] = staleness
+
+        if not pin:
+            return staleness
+
+        staleness, ts = svc.pin_staleness(staleness, point_lookup)
+        if ts:
+            response.headers["X-Worst-Read-Timestamp"] = ts.isoformat()
 
-                bg_task.add_task(svc.delete_document, instance_type + "_" + str(x.id))
-            return x
+        return staleness
 
     def __get_search_documents(self, instance_type: str, x: Type[BaseFields]) -> list:
         return [
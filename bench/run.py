@@ -0,0 +1,533 @@
+"""
+Load-test and benchmark harness.
+
+Runs the app against a local single-node CockroachDB
+(see the 'cockroach' service in docker-compose.yaml),
+with Meilisearch and MinIO replaced by in-memory stubs
+and authentication disabled.
+
+    # on a fresh cluster, load misc/worst.ddl.sql and create the bench models
+    python -m bench.run setup --reset
+    # seed the bench models with fake data
+    python -m bench.run seed --scale 1000
+    # run the scenarios and write the results
+    python -m bench.run run --requests 500 --concurrency 8 --out bench_output.json
+    # same, failing if p99 regressed more than 20% against a baseline
+    python -m bench.run run --baseline bench_baseline.json --tolerance 0.2
+    # all of the above
+    python -m bench.run all --reset --scale 1000
+
+Each step runs in its own process, as the app compiles the models at import.
+"""
+from pathlib import Path
+from typing import Callable
+from uuid import UUID
+import argparse
+import concurrent.futures
+import datetime as dt
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DB_URL = "postgresql://root@localhost:26257/worst?sslmode=disable"
+
+BENCH_ENV = {
+    "DB_URL": BENCH_DB_URL,
+    "DB_URL_DML": BENCH_DB_URL,
+    "DB_URL_SELECT": BENCH_DB_URL,
+    "JWKS": '{"keys": []}',
+    "ALGORITHM": "RS256",
+    "MEILISEARCH_URL": "http://localhost:7700",
+    "MEILISEARCH_INDEX": "worst",
+    "S3_ACCESS_KEY": "bench",
+    "S3_SECRET_KEY": "bench",
+    "S3_ENDPOINT_URL": "localhost:9000",
+    "S3_BUCKET": "worst",
+    "S3_REGION": "us-east-1",
+    "S3_USE_SECURE_TLS": "false",
+}
+
+DDL_FILE = Path(__file__).parent.parent / "misc" / "worst.ddl.sql"
+
+
+def field(
+    name: str, type: str, in_overview: bool = True, nullable: bool = True, **kwargs
+) -> dict:
+    return {
+        "name": name,
+        "type": type,
+        "nullable": nullable,
+        "in_overview": in_overview,
+        "args": {},
+        **kwargs,
+    }
+
+
+# bench_program <- bench_account <- bench_contact
+BENCH_MODELS = {
+    "bench_program": [
+        field("status", "string"),
+        field("description", "markdown", in_overview=False),
+    ],
+    "bench_account": [
+        field("status", "string", indexed=True),
+        field("amount", "integer"),
+        field("close_date", "date", indexed=True, sort="desc"),
+        field("notes", "markdown", in_overview=False),
+    ],
+    "bench_contact": [
+        field("email", "string"),
+        field("phone", "string"),
+        field("title", "string", in_overview=False),
+    ],
+}
+
+BENCH_REPORT = "bench_accounts_by_status"
+BENCH_REPORT_SQL = "SELECT status, count(*), sum(amount) FROM bench_account GROUP BY status"
+
+
+###########
+#  SETUP  #
+###########
+def setup(reset: bool) -> None:
+    import psycopg
+
+    if reset:
+        with psycopg.connect(
+            BENCH_DB_URL.replace("/worst?", "/defaultdb?"), autocommit=True
+        ) as conn:
+            conn.execute(DDL_FILE.read_text())
+
+    from apiserver import db
+    from apiserver.models import ModelUpdate, Skema
+    import apiserver.service as svc
+
+    __check_local(db.DB_URL)
+
+    for name, fields in BENCH_MODELS.items():
+        if not db.get_model(name):
+            svc.create_model(
+                ModelUpdate(name=name, skema=Skema(fields=fields)), "bench"
+            )
+            svc.create_indexes(name)
+
+    if not db.get_report(BENCH_REPORT):
+        svc.create_report(BENCH_REPORT, BENCH_REPORT_SQL, "bench")
+
+
+def seed(scale: int) -> None:
+    """
+    Creates 'scale' accounts, one program every 10 accounts
+    and 3 contacts per account.
+    """
+    from faker import Faker
+    from apiserver import db
+    from apiserver.models import pyd_models
+    import apiserver.service as svc
+
+    __check_local(db.DB_URL)
+    fake = Faker()
+    Faker.seed(0)
+
+    def create(model_name: str, parent: tuple[str, UUID] | None, **kwargs):
+        m = pyd_models[model_name]["update"](
+            name=fake.company()[:50],
+            tags={fake.word() for _ in range(3)},
+            parent_type=parent[0] if parent else None,
+            parent_id=parent[1] if parent else None,
+            **kwargs,
+        )
+        return svc.create_instance(model_name, "bench", m)
+
+    program = None
+    for i in range(scale):
+        if i % 10 == 0:
+            program = create(
+                "bench_program",
+                None,
+                status=random.choice(["NEW", "ACTIVE", "CLOSED"]),
+                description=fake.text(1000),
+            )
+
+        account = create(
+            "bench_account",
+            ("bench_program", program.id),
+            status=random.choice(["NEW", "OPPORTUNITY", "WON", "LOST"]),
+            amount=random.randint(0, 1_000_000),
+            close_date=fake.date_between("-1y", "+1y"),
+            notes=fake.text(2000),
+        )
+
+        for _ in range(3):
+            create(
+                "bench_contact",
+                ("bench_account", account.id),
+                email=fake.email(),
+                phone=fake.phone_number(),
+                title=fake.job(),
+            )
+
+
+###############
+#  SCENARIOS  #
+###############
+def get_scenarios(ids: dict[str, list[str]]) -> dict[str, Callable]:
+    import httpx
+    from faker import Faker
+
+    fake = Faker()
+
+    def account_id() -> str:
+        return random.choice(ids["bench_account"])
+
+    def account_body() -> dict:
+        return {
+            "name": fake.company()[:50],
+            "status": "NEW",
+            "amount": random.randint(0, 1_000_000),
+            "close_date": fake.date_between("-1y", "+1y").isoformat(),
+            "notes": fake.text(2000),
+            "tags": [fake.word()],
+        }
+
+    def create(c: httpx.Client) -> httpx.Response:
+        return c.post("/bench_account", json=account_body())
+
+    def get(c: httpx.Client) -> httpx.Response:
+        return c.get(f"/bench_account/{account_id()}")
+
+    def update(c: httpx.Client) -> httpx.Response:
+        return c.put("/bench_account", json={"id": account_id()} | account_body())
+
+    def patch(c: httpx.Client) -> httpx.Response:
+        return c.patch(
+            f"/bench_account/{account_id()}",
+            json={"status": "WON", "amount": random.randint(0, 1_000_000)},
+        )
+
+    def list_all(c: httpx.Client) -> httpx.Response:
+        return c.get("/bench_contact")
+
+    def list_fields(c: httpx.Client) -> httpx.Response:
+        return c.get("/bench_contact", params={"fields": "name,email"})
+
+    def children(c: httpx.Client) -> httpx.Response:
+        return c.get(f"/bench_program/{random.choice(ids['bench_program'])}/children")
+
+    def children_for_model(c: httpx.Client) -> httpx.Response:
+        return c.get(f"/bench_account/{account_id()}/bench_contact")
+
+    def parent_chain(c: httpx.Client) -> httpx.Response:
+        return c.get(
+            f"/bench_contact/{random.choice(ids['bench_contact'])}/parent_chain"
+        )
+
+    def report(c: httpx.Client) -> httpx.Response:
+        return c.post(f"/sql/report/{BENCH_REPORT}", json=[])
+
+    def search(c: httpx.Client) -> httpx.Response:
+        return c.post(
+            "/search/multi-search",
+            json={"queries": [{"indexUid": "worst", "q": fake.word()}]},
+        )
+
+    return {
+        "create": create,
+        "get": get,
+        "update": update,
+        "patch": patch,
+        "list": list_all,
+        "list_fields": list_fields,
+        "children": children,
+        "children_for_model": children_for_model,
+        "parent_chain": parent_chain,
+        "report": report,
+        "search": search,
+    }
+
+
+def schema_reload() -> None:
+    """
+    Compiles the pydantic models and the routers of all models,
+    which is what a worker restart costs the app.
+    """
+    from apiserver.models import build_pyd_models, skemas
+    from apiserver.worstrouter import WorstRouter
+
+    for n, s in skemas.items():
+        m = build_pyd_models(n, s)
+        WorstRouter(
+            instance_type=n,
+            default_model=m["default"],
+            overview_model=m["overview"],
+            update_model=m["update"],
+            patch_model=m["patch"],
+        )
+
+
+def cold_start(use_snapshot: bool) -> float:
+    """
+    Time to import the app in a new process, with the schema snapshot
+    on disk or, without it, loading the model defs from the database.
+    """
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as tmp:
+        if not use_snapshot:
+            env["SCHEMA_SNAPSHOT_FILE"] = os.path.join(tmp, "schema.snapshot.json")
+
+        out = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import time; t = time.perf_counter(); import apiserver.main; "
+                "print(time.perf_counter() - t)",
+            ],
+            env=env,
+            text=True,
+        )
+
+    return float(out.strip().splitlines()[-1])
+
+
+def schema_reload_one(i: int) -> None:
+    """
+    Reloads the app after a change to a single model,
+    adding and removing a field on alternate calls.
+    """
+    from apiserver.main import reload_models
+    from apiserver.models import skemas
+
+    new_skemas = dict(skemas)
+    s = dict(new_skemas["bench_contact"])
+    s["fields"] = BENCH_MODELS["bench_contact"] + (
+        [field("reload", "string")] if i % 2 == 0 else []
+    )
+    new_skemas["bench_contact"] = s
+
+    reload_models(new_skemas)
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    # latencies in seconds, results in ms
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(q[49] * 1000, 3),
+        "p90_ms": round(q[89] * 1000, 3),
+        "p99_ms": round(q[98] * 1000, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+def run_scenario(
+    base_url: str, fn: Callable, requests: int, concurrency: int
+) -> dict:
+    import httpx
+
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def call(_):
+        nonlocal errors
+
+        if not hasattr(local, "client"):
+            local.client = httpx.Client(base_url=base_url, timeout=60)
+
+        start = time.perf_counter()
+        r = fn(local.client)
+        duration = time.perf_counter() - start
+
+        with lock:
+            latencies.append(duration)
+            if r.status_code >= 400 or r.text == "null":
+                errors += 1
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(call, range(requests)))
+
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def start_server(port: int):
+    import uvicorn
+    from bench import stubs
+    import apiserver.dependencies as dep
+    import apiserver.search as search
+
+    # replace the external services before the app serves any request
+    index = stubs.StubIndex()
+    search.index = index
+    search.client = stubs.StubMeilisearch(index)
+    dep.minio_client = stubs.StubMinio()
+
+    from apiserver.main import app
+
+    app.dependency_overrides[dep.get_current_user] = lambda: "bench"
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    return server
+
+
+def run(args) -> dict:
+    from apiserver import db
+
+    __check_local(db.DB_URL)
+
+    ids = {
+        m: [
+            str(x[0])
+            for x in db.execute_stmt(f"SELECT id FROM {m} LIMIT 1000", is_list=True)
+        ]
+        for m in BENCH_MODELS.keys()
+    }
+    if not all(ids.values()):
+        sys.exit("No bench data found, run 'python -m bench.run seed' first")
+
+    server = start_server(args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    results: dict[str, dict] = {}
+    scenarios = get_scenarios(ids)
+    selected = args.scenarios.split(",") if args.scenarios else scenarios.keys()
+
+    for name in selected:
+        # warm up the connections and the code paths
+        run_scenario(base_url, scenarios[name], args.concurrency, args.concurrency)
+        results[name] = run_scenario(
+            base_url, scenarios[name], args.requests, args.concurrency
+        )
+        print(name, results[name])
+
+    latencies = []
+    for _ in range(args.reload_iterations):
+        start = time.perf_counter()
+        schema_reload()
+        latencies.append(time.perf_counter() - start)
+    results["schema_reload"] = summarize(latencies, 0, sum(latencies))
+    print("schema_reload", results["schema_reload"])
+
+    server.should_exit = True
+
+    # after stopping the server, as this changes the models of the app
+    latencies = []
+    for i in range(args.reload_iterations):
+        start = time.perf_counter()
+        schema_reload_one(i)
+        latencies.append(time.perf_counter() - start)
+    results["schema_reload_one"] = summarize(latencies, 0, sum(latencies))
+    print("schema_reload_one", results["schema_reload_one"])
+
+    for name, use_snapshot in [
+        ("cold_start", True),
+        ("cold_start_no_snapshot", False),
+    ]:
+        latencies = [
+            cold_start(use_snapshot) for _ in range(args.cold_start_iterations)
+        ]
+        results[name] = summarize(latencies, 0, sum(latencies))
+        print(name, results[name])
+
+    return {
+        "meta": {
+            "ts": dt.datetime.now(dt.timezone.utc).isoformat(),
+            "git_rev": __get_git_rev(),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "rows": {m: len(x) for m, x in ids.items()},
+        },
+        "scenarios": results,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+
+    for name, b in baseline["scenarios"].items():
+        r = results["scenarios"].get(name)
+        if r and r["p99_ms"] > b["p99_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p99 {r['p99_ms']}ms > baseline {b['p99_ms']}ms"
+            )
+
+    return regressions
+
+
+def __get_git_rev() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except Exception:
+        return ""
+
+
+def __check_local(db_url: str) -> None:
+    # apiserver loads .env on import, which could point to a real cluster
+    if "@localhost:" not in db_url and "@127.0.0.1:" not in db_url:
+        sys.exit(f"Refusing to benchmark against a non-local database: {db_url}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("step", choices=["setup", "seed", "run", "all"])
+    parser.add_argument("--reset", action="store_true", help="recreate the schema")
+    parser.add_argument("--scale", type=int, default=1000, help="accounts to seed")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--reload-iterations", type=int, default=10)
+    parser.add_argument("--cold-start-iterations", type=int, default=5)
+    parser.add_argument("--scenarios", help="comma separated, default all")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--out", default="bench_output.json")
+    parser.add_argument("--baseline", help="results file to compare p99 against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    for k, v in BENCH_ENV.items():
+        os.environ.setdefault(k, v)
+
+    if args.step == "all":
+        # each step in a new process, so that the app sees the new models
+        for step in ["setup", "seed", "run"]:
+            subprocess.run(
+                [sys.executable, "-m", "bench.run", step, *sys.argv[2:]], check=True
+            )
+        return
+
+    if args.step == "setup":
+        setup(args.reset)
+    elif args.step == "seed":
+        seed(args.scale)
+    else:
+        results = run(args)
+        Path(args.out).write_text(json.dumps(results, indent=2))
+
+        if args.baseline:
+            regressions = compare(
+                results, json.loads(Path(args.baseline).read_text()), args.tolerance
+            )
+            if regressions:
+                sys.exit("Regressions found:\n" + "\n".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+In-memory stand-ins for Meilisearch and MinIO, so that the benchmarks
+measure the app and the database only.
+"""
+from minio.datatypes import Object
+import datetime as dt
+import minio
+
+
+class StubIndex:
+    def __init__(self) -> None:
+        self.documents: dict[str, dict] = {}
+
+    def add_documents(self, documents: list[dict]):
+        for d in documents:
+            self.documents[d["comp_id"]] = d
+        return {"taskUid": 0}
+
+    def update_documents(self, documents: list[dict]):
+        for d in documents:
+            self.documents.setdefault(d["comp_id"], {}).update(d)
+        return {"taskUid": 0}
+
+    def delete_document(self, comp_id: str):
+        self.documents.pop(comp_id, None)
+        return {"taskUid": 0}
+
+
+class StubMeilisearch:
+    def __init__(self, index: StubIndex) -> None:
+        self.index = index
+
+    def multi_search(self, queries: list[dict]) -> dict:
+        results = []
+        for q in queries:
+            term = q.get("q", "").lower()
+            hits = [
+                d for d in self.index.documents.values() if term in str(d).lower()
+            ]
+            results.append({"indexUid": q.get("indexUid"), "hits": hits[:20]})
+        return {"results": results}
+
+
+class StubMinio(minio.Minio):
+    """
+    Presigning is a local computation, so it is inherited from the real client.
+    The calls that would reach the object store are served from memory.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(
+            "localhost:9000",
+            access_key="bench",
+            secret_key="bench",
+            secure=False,
+            region="us-east-1",
+        )
+        self.objects: dict[str, int] = {}
+
+    def put(self, object_name: str, size: int) -> None:
+        self.objects[object_name] = size
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False, **kwargs):
+        for k, v in list(self.objects.items()):
+            if k.startswith(prefix or ""):
+                yield Object(bucket_name, k, size=v, etag="bench")
+
+    def stat_object(self, bucket_name, object_name, **kwargs):
+        return Object(
+            bucket_name,
+            object_name,
+            last_modified=dt.datetime.now(dt.timezone.utc),
+            size=self.objects.get(object_name, 0),
+            etag="bench",
+            content_type="application/octet-stream",
+        )
+
+    def remove_object(self, bucket_name, object_name, **kwargs):
+        self.objects.pop(object_name, None)
+
+    def remove_objects(self, bucket_name, delete_object_list, **kwargs):
+        for x in delete_object_list:
+            self.objects.pop(x._name, None)
+        return iter([])
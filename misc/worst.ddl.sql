@@ -70,15 +70,121 @@ INSERT INTO
 VALUES
     (1);
 
+-- audit log.
+-- The pk is hash-sharded on ts, so that the time ordered inserts
+-- are spread over 16 buckets instead of landing on a single range.
+-- The secondary indexes cover the queries of GET /events,
+-- they are hash-sharded too as they are also written in ts order.
 CREATE TABLE internal.events (
-    object STRING,
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
     ts TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    -- fields
+    object STRING,
+    instance_id UUID,
     username STRING,
-    ACTION STRING,
+    action STRING,
+    -- 'snapshot': the full row, 'diff': {field: [old, new]}, 'delete'
+    kind STRING,
     details STRING,
-    CONSTRAINT pk PRIMARY KEY (object, ts, username)
+    CONSTRAINT pk PRIMARY KEY (ts DESC, id DESC) USING HASH WITH (bucket_count = 16),
+    INDEX events_object_ts (object, ts DESC, id DESC) USING HASH WITH (bucket_count = 16)
+        STORING (instance_id, username, action, kind, details),
+    INDEX events_username_ts (username, ts DESC, id DESC) USING HASH WITH (bucket_count = 16)
+        STORING (object, instance_id, action, kind, details),
+    INDEX events_action_ts (action, ts DESC, id DESC) USING HASH WITH (bucket_count = 16)
+        STORING (object, instance_id, username, kind, details),
+    INDEX events_instance_ts (object, instance_id, ts DESC, id DESC) STORING (kind)
 ) WITH (
     ttl = 'on',
     ttl_expiration_expression = '(ts::INT8 + 86400 * 30)::TIMESTAMPTZ',
     ttl_job_cron = '15 5 * * *'
 );
+
+-- closure table of the parent links of the instances: one row for each
+-- ancestor of each instance, maintained in the transactions that write them
+CREATE TABLE internal.hierarchy (
+    ancestor_type STRING NOT NULL,
+    ancestor_id UUID NOT NULL,
+    -- 1 for the parent
+    depth INT8 NOT NULL,
+    descendant_type STRING NOT NULL,
+    descendant_id UUID NOT NULL,
+    CONSTRAINT pk PRIMARY KEY (ancestor_type, ancestor_id, depth, descendant_type, descendant_id),
+    INDEX hierarchy_descendant (descendant_type, descendant_id)
+);
+
+-- schema changes of the models, applied in the background
+CREATE TABLE internal.schema_jobs (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    -- fields
+    model_name STRING NOT NULL,
+    skema JSONB NOT NULL,
+    status STRING NOT NULL DEFAULT 'pending',
+    stmts STRING [] NULL,
+    crdb_job_id INT8 NULL,
+    fraction_completed FLOAT8 NOT NULL DEFAULT 0,
+    error STRING NULL,
+    lease_until TIMESTAMPTZ NULL,
+    -- audit info
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    created_by STRING NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+    CONSTRAINT pk PRIMARY KEY (id),
+    INDEX schema_jobs_model_name (model_name, created_at DESC),
+    INDEX schema_jobs_status (status, created_at)
+);
+
+-- outbox of S3 folders to purge after an instance is deleted
+CREATE TABLE internal.s3_purge_queue (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    -- fields
+    folder STRING NOT NULL,
+    attempts INT8 NOT NULL DEFAULT 0,
+    last_error STRING NULL,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    -- audit info
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CONSTRAINT pk PRIMARY KEY (id),
+    INDEX s3_purge_queue_next_attempt_at (next_attempt_at)
+);
+
+-- leases of the background tasks that must run in only one app instance
+CREATE TABLE internal.leases (
+    name STRING NOT NULL,
+    -- fields
+    holder STRING NOT NULL,
+    lease_until TIMESTAMPTZ NOT NULL,
+    CONSTRAINT pk PRIMARY KEY (name)
+);
+
+-- metadata of the attachments, recorded when the upload is confirmed
+CREATE TABLE internal.attachments (
+    model_name STRING NOT NULL,
+    id UUID NOT NULL,
+    filename STRING NOT NULL,
+    -- fields
+    size INT8 NULL,
+    content_type STRING NULL,
+    etag STRING NULL,
+    confirmed_at TIMESTAMPTZ NULL,
+    -- audit info
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CONSTRAINT pk PRIMARY KEY (model_name, id, filename)
+);
+
+-- state of the multipart uploads of attachments
+CREATE TABLE internal.uploads (
+    upload_id STRING NOT NULL,
+    -- fields
+    model_name STRING NOT NULL,
+    id UUID NOT NULL,
+    filename STRING NOT NULL,
+    status STRING NOT NULL DEFAULT 'in_progress',
+    -- audit info
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    created_by STRING NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+    CONSTRAINT pk PRIMARY KEY (upload_id),
+    INDEX uploads_instance (model_name, id),
+    INDEX uploads_status (status, updated_at)
+);
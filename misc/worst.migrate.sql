@@ -0,0 +1,118 @@
+-- as user root
+-- Upgrades a database created with an earlier worst.ddl.sql.
+-- Every statement can be run again, on an up to date database too.
+USE worst;
+
+-- audit log: the events of the instances are logged as snapshots or diffs.
+-- The rows logged before keep a NULL instance_id and kind, they are
+-- returned as is by GET /events and ignored by the instance history.
+ALTER TABLE internal.events ADD COLUMN IF NOT EXISTS id UUID NOT NULL DEFAULT gen_random_uuid();
+ALTER TABLE internal.events ADD COLUMN IF NOT EXISTS instance_id UUID;
+ALTER TABLE internal.events ADD COLUMN IF NOT EXISTS kind STRING;
+
+-- The pk is hash-sharded on ts, see worst.ddl.sql.
+-- Dropping and adding the constraint in one statement doesn't keep the
+-- old pk as a unique index. This rewrites the table, also when the pk
+-- is already the new one, so it is best run off-peak.
+ALTER TABLE internal.events
+    DROP CONSTRAINT pk,
+    ADD CONSTRAINT pk PRIMARY KEY (ts DESC, id DESC) USING HASH WITH (bucket_count = 16);
+
+-- The indexes of GET /events store all the columns of the events. They are
+-- recreated, as CREATE INDEX IF NOT EXISTS keeps an existing index as is
+DROP INDEX IF EXISTS internal.events@events_object_ts;
+CREATE INDEX events_object_ts ON internal.events (object, ts DESC, id DESC)
+    USING HASH WITH (bucket_count = 16)
+    STORING (instance_id, username, action, kind, details);
+DROP INDEX IF EXISTS internal.events@events_username_ts;
+CREATE INDEX events_username_ts ON internal.events (username, ts DESC, id DESC)
+    USING HASH WITH (bucket_count = 16)
+    STORING (object, instance_id, action, kind, details);
+CREATE INDEX IF NOT EXISTS events_action_ts ON internal.events (action, ts DESC, id DESC)
+    USING HASH WITH (bucket_count = 16)
+    STORING (object, instance_id, username, kind, details);
+CREATE INDEX IF NOT EXISTS events_instance_ts ON internal.events (object, instance_id, ts DESC, id DESC)
+    STORING (kind);
+
+-- the tables added since, as in worst.ddl.sql
+CREATE TABLE IF NOT EXISTS internal.hierarchy (
+    ancestor_type STRING NOT NULL,
+    ancestor_id UUID NOT NULL,
+    -- 1 for the parent
+    depth INT8 NOT NULL,
+    descendant_type STRING NOT NULL,
+    descendant_id UUID NOT NULL,
+    CONSTRAINT pk PRIMARY KEY (ancestor_type, ancestor_id, depth, descendant_type, descendant_id),
+    INDEX hierarchy_descendant (descendant_type, descendant_id)
+);
+
+CREATE TABLE IF NOT EXISTS internal.schema_jobs (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    -- fields
+    model_name STRING NOT NULL,
+    skema JSONB NOT NULL,
+    status STRING NOT NULL DEFAULT 'pending',
+    stmts STRING [] NULL,
+    crdb_job_id INT8 NULL,
+    fraction_completed FLOAT8 NOT NULL DEFAULT 0,
+    error STRING NULL,
+    lease_until TIMESTAMPTZ NULL,
+    -- audit info
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    created_by STRING NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+    CONSTRAINT pk PRIMARY KEY (id),
+    INDEX schema_jobs_model_name (model_name, created_at DESC),
+    INDEX schema_jobs_status (status, created_at)
+);
+
+CREATE TABLE IF NOT EXISTS internal.s3_purge_queue (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    -- fields
+    folder STRING NOT NULL,
+    attempts INT8 NOT NULL DEFAULT 0,
+    last_error STRING NULL,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    -- audit info
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CONSTRAINT pk PRIMARY KEY (id),
+    INDEX s3_purge_queue_next_attempt_at (next_attempt_at)
+);
+
+CREATE TABLE IF NOT EXISTS internal.leases (
+    name STRING NOT NULL,
+    -- fields
+    holder STRING NOT NULL,
+    lease_until TIMESTAMPTZ NOT NULL,
+    CONSTRAINT pk PRIMARY KEY (name)
+);
+
+CREATE TABLE IF NOT EXISTS internal.attachments (
+    model_name STRING NOT NULL,
+    id UUID NOT NULL,
+    filename STRING NOT NULL,
+    -- fields
+    size INT8 NULL,
+    content_type STRING NULL,
+    etag STRING NULL,
+    confirmed_at TIMESTAMPTZ NULL,
+    -- audit info
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CONSTRAINT pk PRIMARY KEY (model_name, id, filename)
+);
+
+CREATE TABLE IF NOT EXISTS internal.uploads (
+    upload_id STRING NOT NULL,
+    -- fields
+    model_name STRING NOT NULL,
+    id UUID NOT NULL,
+    filename STRING NOT NULL,
+    status STRING NOT NULL DEFAULT 'in_progress',
+    -- audit info
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    created_by STRING NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+    CONSTRAINT pk PRIMARY KEY (upload_id),
+    INDEX uploads_instance (model_name, id),
+    INDEX uploads_status (status, updated_at)
+);